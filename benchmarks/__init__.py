@@ -0,0 +1,7 @@
+"""
+    zabbix-alerta benchmarks
+
+    Run offline against a local stub Alerta API:
+
+        $ python -m benchmarks --output bench.json
+"""
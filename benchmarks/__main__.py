@@ -0,0 +1,46 @@
+import argparse
+import json
+import platform
+import sys
+import time
+
+from benchmarks import bench_parse, bench_send, bench_startup, loadgen
+from zabbix_alerta import __version__
+
+BENCHMARKS = {
+    'parse': bench_parse.run,
+    'startup': bench_startup.run,
+    'send': bench_send.run,
+    'load': loadgen.run,
+}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='zabbix-alerta benchmarks')
+    parser.add_argument('--only', choices=sorted(BENCHMARKS), action='append', help='run selected benchmarks')
+    parser.add_argument('--quick', action='store_true', help='fewer iterations, for smoke testing')
+    parser.add_argument('--output', '-o', help='write JSON results to file (default: stdout)')
+    args = parser.parse_args()
+
+    results = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'results': {},
+    }
+    for name in args.only or sorted(BENCHMARKS):
+        print('running %s benchmark...' % name, file=sys.stderr)
+        results['results'][name] = BENCHMARKS[name](quick=args.quick)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+    parse_zabbix throughput for realistic and pathological messages
+"""
+
+import json
+import timeit
+
+from zabbix_alerta import parse_zabbix
+
+SUBJECT = 'PROBLEM: Temperature is above threshold'
+
+FIELDS = [
+    ('resource', 'hostname1'),
+    ('event', 'sensor.temp[psu0]'),
+    ('environment', 'Production'),
+    ('severity', 'High'),
+    ('status', 'PROBLEM'),
+    ('ack', 'No'),
+    ('service', 'Linux servers,Hypervisors'),
+    ('group', 'Zabbix'),
+    ('value', '61'),
+    ('text', 'PROBLEM: Temperature is above threshold'),
+    ('tags', 'scope:availability,component:hardware'),
+    ('attributes.ip', '10.1.1.1'),
+    ('attributes.thresholdInfo', 'Template Module Hardware: {hostname1:sensor.temp[psu0].last()}>60'),
+    ('attributes.eventId', '12345'),
+    ('attributes.triggerId', '6789'),
+    ('type', 'zabbixAlert'),
+    ('dateTime', '2020.12.01T13:04:30Z'),
+]
+
+
+def text_message(fields):
+    return ''.join('%s=%s\r\n' % field for field in fields)
+
+
+def json_message(fields):
+    return json.dumps(dict(fields), indent=2)
+
+
+def replace(fields, **values):
+    return [(macro, values.get(macro, value)) for macro, value in fields]
+
+
+MESSAGES = {
+    'realistic': text_message(FIELDS),
+    'realistic_json': json_message(FIELDS),
+    'many_attributes': text_message(FIELDS + [('attributes.extra%d' % i, 'value%d' % i) for i in range(500)]),
+    'huge_value': text_message(replace(FIELDS, value='x' * 1024 * 1024)),
+    'multiline_value': text_message(replace(FIELDS, value='\n'.join('log line %d' % i for i in range(10000)))),
+    'long_tags': text_message(replace(FIELDS, tags=','.join('tag%d:value' % i for i in range(10000)))),
+}
+
+
+def run(quick=False):
+
+    results = {}
+    for name, message in MESSAGES.items():
+        timer = timeit.Timer(lambda: parse_zabbix(SUBJECT, message))
+        number, _ = timer.autorange()
+        if quick:
+            number = max(1, number // 10)
+        best = min(timer.repeat(repeat=3 if quick else 5, number=number)) / number
+        results[name] = {
+            'bytes': len(message.encode('utf-8')),
+            'seconds_per_parse': best,
+            'parses_per_second': 1.0 / best,
+        }
+    return results
@@ -0,0 +1,73 @@
+"""
+    End-to-end alerts/sec for the zabbix-alerta script against a stub Alerta
+"""
+
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from click.testing import CliRunner
+
+from benchmarks.bench_parse import FIELDS, SUBJECT, text_message
+from benchmarks.bench_startup import ROOT
+from benchmarks.stub_alerta import StubAlerta
+from zabbix_alerta import cli
+
+
+def in_process(endpoint, count):
+    """
+    Per-alert cost of the cli command without interpreter start-up.
+    """
+    runner = CliRunner()
+    message = text_message(FIELDS)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        result = runner.invoke(cli, [endpoint, SUBJECT, message])
+        if result.exit_code != 0:
+            raise RuntimeError(result.output)
+    return time.perf_counter() - start
+
+
+def forked(endpoint, count, concurrency):
+    """
+    One process per alert, like the Zabbix alerter processes.
+    """
+    env = dict(os.environ, ZABBIX_ALERTA_SOCKET=os.devnull)
+    message = text_message(FIELDS)
+
+    def send(_):
+        subprocess.run(
+            [sys.executable, '-m', 'zabbix_alerta', endpoint, SUBJECT, message],
+            cwd=ROOT,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(count)))
+    return time.perf_counter() - start
+
+
+def run(quick=False, concurrency=4):
+
+    results = {}
+    with StubAlerta() as stub:
+        count = 50 if quick else 500
+        elapsed = in_process(stub.endpoint, count)
+        results['in_process'] = {'alerts': count, 'seconds': elapsed, 'alerts_per_second': count / elapsed}
+
+        count = 10 if quick else 100
+        elapsed = forked(stub.endpoint, count, concurrency)
+        results['forked'] = {
+            'alerts': count,
+            'concurrency': concurrency,
+            'seconds': elapsed,
+            'alerts_per_second': count / elapsed,
+        }
+        results['requests_received'] = stub.requests
+    return results
@@ -0,0 +1,66 @@
+"""
+    Cold start of the zabbix-alerta script, broken down by import
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOP_IMPORTS = 15
+
+
+def python(*args, env=None):
+
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable] + list(args),
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return time.perf_counter() - start, proc.stderr
+
+
+def import_times():
+    """
+    Cumulative import time in seconds of the slowest modules, from -X importtime.
+    """
+    _, stderr = python('-X', 'importtime', '-c', 'import zabbix_alerta')
+
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [f.strip() for f in line[len('import time:'):].split('|')]
+        modules.append((int(cumulative) / 1e6, name))
+
+    # only report top-level packages, their imports are included
+    top_level = {}
+    for seconds, name in modules:
+        package = name.split('.')[0]
+        top_level[package] = max(top_level.get(package, 0), seconds)
+    return dict(sorted(top_level.items(), key=lambda m: m[1], reverse=True)[:TOP_IMPORTS])
+
+
+def run(quick=False):
+
+    runs = 5 if quick else 20
+    env = dict(os.environ, ZABBIX_ALERTA_SOCKET=os.devnull)
+
+    def sample(*args):
+        times = [python(*args, env=env)[0] for _ in range(runs)]
+        return {'median': statistics.median(times), 'min': min(times), 'max': max(times), 'runs': runs}
+
+    return {
+        'interpreter': sample('-c', 'pass'),
+        'import': sample('-c', 'import zabbix_alerta'),
+        'help': sample('-m', 'zabbix_alerta', '--help'),
+        'imports': import_times(),
+    }
@@ -0,0 +1,351 @@
+"""
+    Synthetic Zabbix alert load against a stub Alerta API
+
+    Alerts are rendered from the default alert message template that `zac`
+    configures, with a configurable severity mix, share of flapping triggers
+    and item value size, and are sent at a target rate through one of the
+    zabbix-alerta ingest modes:
+
+        script  one `zabbix-alerta` process per alert, like Zabbix alerters
+        daemon  the script hands each alert to `zabbix-alerta serve`
+        batch   all alerts through one `zabbix-alerta batch` process
+
+    Run with `python -m benchmarks.loadgen --help`.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.bench_startup import ROOT
+from benchmarks.stub_alerta import StubAlerta
+from zabbix_config import message_fields
+
+SUBJECT = '{TRIGGER.STATUS}: {TRIGGER.NAME}'
+
+TRIGGERS = [
+    ('Template OS Linux', 'system.cpu.load[percpu,avg1]', 'Processor load is too high on {HOST.NAME}'),
+    ('Template OS Linux', 'vfs.fs.size[/,pfree]', 'Free disk space is less than 20% on volume /'),
+    ('Template OS Linux', 'vm.memory.size[available]', 'Lack of available memory on server {HOST.NAME}'),
+    ('Template App Zabbix Agent', 'agent.ping', 'Zabbix agent on {HOST.NAME} is unreachable for 5 minutes'),
+    ('Template Net ICMP Ping', 'icmpping', '{HOST.NAME} is unavailable by ICMP'),
+    ('Template App HTTP Service', 'net.tcp.service[http]', 'HTTP service is down on {HOST.NAME}'),
+    ('Template DB MySQL', 'mysql.status[Slave_running]', 'MySQL replication is not running'),
+]
+
+GROUPS = ['Linux servers', 'Hypervisors', 'Databases', 'Web servers', 'Network']
+
+DEFAULT_SEVERITY_MIX = 'Disaster:1,High:4,Average:10,Warning:20,Information:5'
+
+# latency histogram bucket upper bounds in milliseconds
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+MACRO_RE = re.compile(r'{[A-Z0-9.$]+}')
+
+
+def parse_mix(value):
+    """
+    Parse "Severity:weight,..." into (severities, weights).
+    """
+    mix = [item.split(':') for item in value.split(',')]
+    return [name for name, _ in mix], [float(weight) for _, weight in mix]
+
+
+class AlertGenerator:
+    def __init__(self, hosts=1000, severity_mix=DEFAULT_SEVERITY_MIX, flapping=0.1, value_size=16, seed=None):
+
+        self.random = random.Random(seed)
+        self.hosts = ['host%05d' % i for i in range(hosts)]
+        self.severities, self.weights = parse_mix(severity_mix)
+        self.flapping = flapping
+        self.value_size = value_size
+        self.template = message_fields()
+        self.event_id = 100000
+        self._recoveries = []
+
+    def value(self):
+        return ''.join(self.random.choice('0123456789abcdef') for _ in range(self.value_size))
+
+    def macros(self, host, trigger, severity, status):
+
+        template, key, name = trigger
+        index = int(host[4:])
+        self.event_id += 1
+        now = time.gmtime()
+        return {
+            '{HOST.NAME}': host,
+            '{HOST.NAME1}': host,
+            '{HOST.IP1}': '10.0.%d.%d' % (index // 256 % 256, index % 256),
+            '{ITEM.KEY1}': key,
+            '{ITEM.VALUE1}': self.value(),
+            '{TRIGGER.NAME}': name.replace('{HOST.NAME}', host),
+            '{TRIGGER.SEVERITY}': severity,
+            '{TRIGGER.STATUS}': status,
+            '{TRIGGER.HOSTGROUP.NAME}': GROUPS[index % len(GROUPS)],
+            '{TRIGGER.TEMPLATE.NAME}': template,
+            '{TRIGGER.EXPRESSION}': '{%s:%s.last()}>0' % (host, key),
+            '{TRIGGER.ID}': str(10000 + TRIGGERS.index(trigger)),
+            '{EVENT.ID}': str(self.event_id),
+            '{EVENT.ACK.STATUS}': 'No',
+            '{EVENT.TAGS}': 'scope:availability',
+            '{EVENT.DATE}': time.strftime('%Y.%m.%d', now),
+            '{EVENT.TIME}': time.strftime('%H:%M:%S', now),
+        }
+
+    def render(self, macros):
+
+        def substitute(text):
+            return MACRO_RE.sub(lambda m: macros.get(m.group(0), m.group(0)), text)
+
+        body = ''.join('%s=%s\r\n' % (name, substitute(value)) for name, value in self.template)
+        return substitute(SUBJECT), body
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Returns the next (subject, body). A flapping trigger's recovery
+        follows its problem immediately.
+        """
+        if self._recoveries:
+            return self.render(self._recoveries.pop())
+
+        host = self.random.choice(self.hosts)
+        trigger = self.random.choice(TRIGGERS)
+        severity = self.random.choices(self.severities, self.weights)[0]
+        if self.random.random() < self.flapping:
+            self._recoveries.append(self.macros(host, trigger, severity, 'OK'))
+        return self.render(self.macros(host, trigger, severity, 'PROBLEM'))
+
+
+def histogram(latencies):
+
+    counts = [0] * (len(BUCKETS) + 1)
+    for latency in latencies:
+        ms = latency * 1000
+        counts[next((i for i, bound in enumerate(BUCKETS) if ms <= bound), len(BUCKETS))] += 1
+    labels = ['<=%dms' % bound for bound in BUCKETS] + ['>%dms' % BUCKETS[-1]]
+    return dict(zip(labels, counts))
+
+
+def percentiles(latencies):
+
+    values = sorted(latencies)
+    if not values:
+        return {}
+    return {'p%d' % p: values[min(int(p / 100.0 * len(values)), len(values) - 1)] for p in (50, 90, 95, 99)}
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class LoadTest:
+    def __init__(self, endpoint, mode='script', rate=50.0, count=500, concurrency=8, workdir=None):
+
+        self.endpoint = endpoint
+        self.mode = mode
+        self.rate = rate
+        self.count = count
+        self.concurrency = concurrency
+        self.workdir = workdir or tempfile.mkdtemp(prefix='zabbix-alerta-load-')
+        self.socket = os.path.join(self.workdir, 'zabbix-alerta.sock')
+        self.env = dict(
+            os.environ,
+            ALERTA_CONF_FILE=os.devnull,
+            ZABBIX_ALERTA_CACHE_DIR=self.workdir,
+            ZABBIX_ALERTA_SOCKET=self.socket if mode == 'daemon' else os.devnull,
+        )
+
+    def command(self, *args):
+        return [sys.executable, '-m', 'zabbix_alerta'] + list(args)
+
+    def send_script(self, alerts):
+        """
+        Send alerts at the target rate, one process each, with at most
+        `concurrency` running like the Zabbix alerter processes. Latency is
+        measured from when the alert was due, so it includes queueing.
+        """
+        latencies = []
+        failures = 0
+        lock = threading.Lock()
+
+        def send(due, subject, body):
+            nonlocal failures
+            result = subprocess.run(
+                self.command(self.endpoint, subject, body), cwd=ROOT, env=self.env, stdout=subprocess.DEVNULL
+            )
+            with lock:
+                latencies.append(time.monotonic() - due)
+                failures += result.returncode != 0
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for i, (subject, body) in enumerate(alerts):
+                due = start + i / self.rate
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(send, due, subject, body)
+        return latencies, failures
+
+    def send_batch(self, alerts):
+
+        process = subprocess.Popen(
+            self.command('batch', '--workers', str(self.concurrency)),
+            cwd=ROOT,
+            env=self.env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        )
+        start = time.monotonic()
+        for i, (subject, body) in enumerate(alerts):
+            delay = start + i / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            process.stdin.write(json.dumps({'sendto': self.endpoint, 'subject': subject, 'message': body}) + '\n')
+        process.stdin.close()
+        return [], int(process.wait() != 0)
+
+    def run(self, alerts, stub):
+
+        cpu = children_cpu()
+        daemon = None
+        if self.mode == 'daemon':
+            daemon = subprocess.Popen(
+                self.command('serve', '--socket', self.socket, '--workers', str(self.concurrency)),
+                cwd=ROOT,
+                env=self.env,
+                stderr=subprocess.DEVNULL,
+            )
+            while not os.path.exists(self.socket):
+                time.sleep(0.05)
+
+        received = stub.requests
+        start = time.monotonic()
+        if self.mode == 'batch':
+            latencies, failures = self.send_batch(alerts)
+        else:
+            latencies, failures = self.send_script(alerts)
+
+        # the daemon forwards in the background, wait until it has caught up
+        deadline = time.monotonic() + 60
+        while daemon and stub.requests - received < self.count - failures and time.monotonic() < deadline:
+            time.sleep(0.05)
+        elapsed = time.monotonic() - start
+        if daemon:
+            daemon.terminate()
+            daemon.wait()
+
+        delivered = stub.requests - received
+        cpu = children_cpu() - cpu
+        return {
+            'mode': self.mode,
+            'target_rate': self.rate,
+            'concurrency': self.concurrency,
+            'alerts': self.count,
+            'failed': failures,
+            'requests_received': delivered,
+            'errors_injected': stub.errors,
+            'seconds': elapsed,
+            'alerts_per_second': delivered / elapsed if elapsed else 0.0,
+            'cpu_seconds_per_alert': cpu / self.count if self.count else 0.0,
+            'latency': percentiles(latencies),
+            'latency_histogram': histogram(latencies) if latencies else {},
+        }
+
+
+def run_load(
+    mode='script',
+    rate=50.0,
+    count=500,
+    concurrency=8,
+    latency=0.0,
+    jitter=0.0,
+    error_rate=0.0,
+    hosts=1000,
+    severity_mix=DEFAULT_SEVERITY_MIX,
+    flapping=0.1,
+    value_size=16,
+    seed=None,
+):
+    generator = AlertGenerator(hosts, severity_mix, flapping, value_size, seed)
+    alerts = [next(generator) for _ in range(count)]
+    with StubAlerta(latency=latency, jitter=jitter, error_rate=error_rate) as stub:
+        with tempfile.TemporaryDirectory(prefix='zabbix-alerta-load-') as workdir:
+            return LoadTest(stub.endpoint, mode, rate, count, concurrency, workdir).run(alerts, stub)
+
+
+def run(quick=False):
+    """
+    Entry point for `python -m benchmarks`.
+    """
+    return {mode: run_load(mode, rate=20.0, count=20 if quick else 200, seed=1) for mode in ('script', 'daemon', 'batch')}
+
+
+def format_report(result):
+
+    lines = [
+        '%(mode)s: %(requests_received)d/%(alerts)d alerts in %(seconds).2fs, %(alerts_per_second).1f/s '
+        '(target %(target_rate).1f/s), %(failed)d failed' % result,
+        'cpu per alert: %.1fms' % (result['cpu_seconds_per_alert'] * 1000),
+    ]
+    if result['latency']:
+        lines.append('latency: ' + ', '.join('%s %.1fms' % (p, v * 1000) for p, v in result['latency'].items()))
+        peak = max(result['latency_histogram'].values())
+        for bucket, n in result['latency_histogram'].items():
+            if n:
+                lines.append('  %10s %6d %s' % (bucket, n, '#' * max(int(50 * n / peak), 1)))
+    return '\n'.join(lines)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.loadgen', description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--mode', choices=['script', 'daemon', 'batch'], default='script', help='ingest mode')
+    parser.add_argument('--rate', type=float, default=50.0, help='target alerts per second (default: 50)')
+    parser.add_argument('--count', type=int, default=500, help='number of alerts (default: 500)')
+    parser.add_argument('--concurrency', type=int, default=8, help='alerter processes or workers (default: 8)')
+    parser.add_argument('--latency', type=float, default=0.0, help='stub Alerta response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra stub response time in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of alerts the stub rejects')
+    parser.add_argument('--hosts', type=int, default=1000, help='number of distinct hosts (default: 1000)')
+    parser.add_argument('--severity-mix', default=DEFAULT_SEVERITY_MIX, help='severity weights (default: %(default)s)')
+    parser.add_argument('--flapping', type=float, default=0.1, help='fraction of problems that recover at once')
+    parser.add_argument('--value-size', type=int, default=16, help='item value size in bytes (default: 16)')
+    parser.add_argument('--seed', type=int, help='random seed, for repeatable runs')
+    parser.add_argument('--json', action='store_true', help='print JSON results')
+    args = parser.parse_args()
+
+    result = run_load(
+        args.mode,
+        args.rate,
+        args.count,
+        args.concurrency,
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        args.hosts,
+        args.severity_mix,
+        args.flapping,
+        args.value_size,
+        args.seed,
+    )
+    print(json.dumps(result, indent=2) if args.json else format_report(result))
+
+
+if __name__ == '__main__':
+    main()
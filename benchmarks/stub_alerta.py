@@ -0,0 +1,113 @@
+"""
+    Stub Alerta API for benchmarks and load tests
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # send headers and body in one segment, avoids delayed ACK stalls
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.server.record(self.path, len(body))
+        if not self.path.rstrip('/').endswith('/alert'):
+            self.reply(404, {'status': 'error', 'message': 'not found'})
+            return
+
+        self.server.delay()
+        if self.server.fail():
+            self.reply(self.server.error_status, {'status': 'error', 'message': 'injected error'})
+        else:
+            self.reply(201, {'status': 'ok', 'id': str(uuid.uuid4())})
+
+    def do_GET(self):
+
+        self.server.record(self.path, 0)
+        self.reply(200, {'status': 'ok', 'alerts': [], 'total': 0})
+
+    def reply(self, status, response):
+
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubAlerta(ThreadingMixIn, HTTPServer):
+    """
+    Accepts alerts after `latency` seconds (plus up to `jitter` more) and
+    fails a fraction `error_rate` of them with `error_status`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503):
+
+        super().__init__((host, port), StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+        self.requests = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+    def record(self, path, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += size
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def fail(self):
+        if self.error_rate and random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            return True
+        return False
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -10,19 +10,22 @@ setup(
     license='MIT',
     author='Nick Satterly',
     author_email='nick.satterly@gmail.com',
-    packages=find_packages(),
-    py_modules=['zabbix_alerta', 'zabbix_config'],
+    packages=find_packages(exclude=['benchmarks']),
+    py_modules=['zabbix_alerta', 'zabbix_config', 'zabbix_daemon', 'zabbix_spool', 'zabbix_webhook', 'zabbix_cli', 'zabbix_state', 'zabbix_batch', 'zabbix_export', 'zabbix_replay', 'zabbix_reconcile', 'zabbix_fleet', 'zabbix_plan', 'zabbix_probe', 'zabbix_metrics', 'zabbix_inventory', 'zabbix_rules'],
     install_requires=[
         'alerta>=5.0.2',
         'Click',
         'pyzabbix',
         'protobix'
     ],
+    extras_require={
+        'fast': ['orjson']
+    },
     include_package_data=True,
     zip_safe=True,
     entry_points={
         'console_scripts': [
-            'zabbix-alerta = zabbix_alerta:cli',
+            'zabbix-alerta = zabbix_alerta:main',
             'zac = zabbix_config:main'
         ]
     },
@@ -30,5 +33,5 @@ setup(
     classifiers=[
         'Topic :: System :: Monitoring'
     ],
-    python_requires='>=3.6'
+    python_requires='>=3.7'
 )
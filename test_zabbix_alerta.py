@@ -1,11 +1,22 @@
+import gzip
+import json
+import os
+import tempfile
 import textwrap
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 from types import SimpleNamespace
+from unittest import mock
 
 import requests_mock
+from alertaclient.exceptions import UnknownError
 from click.testing import CliRunner
 
-from zabbix_alerta import cli, parse_zabbix
+from zabbix_alerta import (PARTIAL, SENT, FanoutFailed, cli, default_config,
+                           forward, get_options, parse_zabbix, truncate)
+from zabbix_config import action_params
 
 SUMMARY_TEMPLATE = '''{TRIGGER.STATUS}: {TRIGGER.NAME}'''
 BODY_TEMPLATE = '''
@@ -51,13 +62,25 @@ body = textwrap.dedent(
 )
 
 
+def use_cache_dir(test, path):
+    """
+    Keep the state, spool and socket files of zabbix-alerta in path until
+    the test ends.
+    """
+    patcher = mock.patch.dict(os.environ, {'ZABBIX_ALERTA_CACHE_DIR': path})
+    patcher.start()
+    test.addCleanup(patcher.stop)
+
+
 class SenderTestCase(unittest.TestCase):
 
     def setUp(self) -> None:
         self.runner = CliRunner(echo_stdin=True)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        use_cache_dir(self, self.tmpdir.name)
 
     def tearDown(self) -> None:
-        pass
+        self.tmpdir.cleanup()
 
     @requests_mock.mock()
     def test_cli(self, m):
@@ -70,6 +93,28 @@ class SenderTestCase(unittest.TestCase):
         self.assertEqual(
             result.output,
             '[alerta] Sending message "PROBLEM: PSU-0.40: Temperature is above threshold" to http://localhost:8080...\n'
+            + 'Successfully sent message "PROBLEM: PSU-0.40: Temperature is above threshold" to http://localhost:8080!\n'
+        )
+        # self.assertEqual(
+        #     result.stderr,
+        #     ''
+        # )
+
+    @requests_mock.mock()
+    def test_cli_debug(self, m):
+
+        self.maxDiff = None
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+
+        with self.runner.isolated_filesystem():
+            with open('alerta.conf', 'w') as f:
+                f.write('[profile debug]\nendpoint = http://localhost:8080\ndebug = on\n')
+            self.runner.env['ALERTA_CONF_FILE'] = 'alerta.conf'
+            result = self.runner.invoke(cli, ['debug', summary, body])
+        self.assertEqual(
+            result.output,
+            '[alerta] Sending message "PROBLEM: PSU-0.40: Temperature is above threshold" to debug...\n'
             + 'resource -> hostname1\n'
             + 'event -> e4597efc-3811-4476-9cf5-4e9d8501037e\n'
             + 'environment -> Production\n'
@@ -88,10 +133,6 @@ class SenderTestCase(unittest.TestCase):
             + 'dateTime -> 2018.01.02T13:04:30Z\n'
             + 'Successfully sent message "PROBLEM: PSU-0.40: Temperature is above threshold" to http://localhost:8080!\n'
         )
-        # self.assertEqual(
-        #     result.stderr,
-        #     ''
-        # )
 
     def test_parser(self):
 
@@ -113,3 +154,286 @@ class SenderTestCase(unittest.TestCase):
         }
         assert alert['origin'].startswith('zabbix/')
         assert alert['type'] == 'zabbixAlert'
+
+    def test_parser_multiline(self):
+
+        message = 'resource=hostname1\r\nevent=log\r\nvalue=line1\r\n  line2\r\n\r\nline4\r\nseverity=High\r\n'
+        alert = parse_zabbix(summary, message)
+
+        assert alert['resource'] == 'hostname1'
+        assert alert['value'] == 'line1\n  line2\n\nline4'
+        assert alert['severity'] == 'major'
+
+        # only known macros start a new field
+        message = 'resource=hostname1\nvalue=login failed\nuser=admin rc=1\nattributes.ip=10.1.1.1\n'
+        alert = parse_zabbix(summary, message)
+
+        assert alert['value'] == 'login failed\nuser=admin rc=1'
+        assert 'user' not in alert
+        assert alert['attributes']['ip'] == '10.1.1.1'
+
+    def test_parser_limits(self):
+
+        message = 'resource=hostname1\nvalue=%s\nmore\ntext=%s\nattributes.ip=10.1.1.1\n' % ('x' * 100000, 'y' * 100)
+        alert = parse_zabbix(summary, message, limits={'*': 64, 'value': 16})
+
+        assert alert['resource'] == 'hostname1'
+        assert alert['value'] == 'x' * 13 + '...'
+        assert alert['text'] == 'y' * 61 + '...'
+        assert alert['attributes'] == {'ip': '10.1.1.1'}
+
+        alert = parse_zabbix(summary, json.dumps({'value': 'x' * 100, 'event': 'log'}), limits={'value': 16})
+        assert alert['value'] == 'x' * 13 + '...'
+        assert alert['event'] == 'log'
+
+    def test_parser_json(self):
+
+        # the zac template with macro values substituted by Zabbix, unescaped
+        message = json.dumps(
+            {
+                'resource': 'hostname1',
+                'event': 'log',
+                'severity': 'High',
+                'status': 'OK',
+                'service': 'group1,group2',
+                'value': '{ITEM.VALUE1}',
+                'attributes.eventId': '2',
+            },
+            indent=2,
+        ).replace('{ITEM.VALUE1}', 'line1\nkey=value\nline3')
+        alert = parse_zabbix(summary, message)
+
+        assert alert['resource'] == 'hostname1'
+        assert alert['severity'] == 'normal'
+        assert alert['service'] == ['group1', 'group2']
+        assert alert['value'] == 'line1\nkey=value\nline3'
+        assert alert['attributes'] == {'eventId': '2'}
+
+    def test_parser_json_unescaped(self):
+
+        # Zabbix does not escape macro values in the JSON template
+        message = (
+            '{\n'
+            '  "resource": "hostname1",\n'
+            '  "value": "say "hello"\n  world",\n'
+            '  "severity": "High!!"\n'
+            '}'
+        )
+        alert = parse_zabbix(summary, message)
+
+        assert alert['resource'] == 'hostname1'
+        assert alert['value'] == 'say "hello"\n  world'
+        assert alert['severity'] == 'High'
+
+    def test_parser_json_backslash(self):
+
+        message = '{\n  "resource": "hostname1",\n  "value": "C:\\new\\temp",\n  "text": "\\\\server\\share \\"x\\""\n}'
+        alert = parse_zabbix(summary, message)
+
+        assert alert['value'] == 'C:\\new\\temp'
+        assert alert['text'] == '\\\\server\\share "x"'
+
+    def test_parser_json_action(self):
+
+        # the JSON message that zac provisions escapes the quotes of the href
+        params = action_params('1', '1', 'http://zabbix.example.com', use_json=True)
+        message = params['operations'][0]['opmessage']['message']
+        alert = parse_zabbix(summary, message.replace('{HOST.NAME1}', 'hostname1'))
+
+        assert alert['resource'] == 'hostname1'
+        assert alert['attributes']['moreInfo'] == (
+            '<a href="http://zabbix.example.com/tr_events.php?triggerid={TRIGGER.ID}&eventid={EVENT.ID}" '
+            'target="_blank">Zabbix console</a>'
+        )
+
+
+class OptionsTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config_file = os.path.join(self.tmpdir.name, 'alerta.conf')
+        self.env = {'ALERTA_CONF_FILE': self.config_file, 'ZABBIX_ALERTA_CACHE_DIR': self.tmpdir.name}
+        self.saved_env = {name: os.environ.get(name) for name in self.env}
+        os.environ.update(self.env)
+
+    def tearDown(self) -> None:
+        for name, value in self.saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        self.tmpdir.cleanup()
+
+    def write_config(self, endpoint):
+        with open(self.config_file, 'w') as f:
+            f.write('[profile production]\nendpoint = %s\ntimeout = 2\nsslverify = off\n' % endpoint)
+
+    def test_profile_cache(self):
+
+        self.write_config('https://alerta.example.com')
+        options = get_options('production')
+        self.assertEqual(options['endpoint'], 'https://alerta.example.com')
+        self.assertEqual(options['sslverify'], False)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name, 'profiles.json')))
+        self.assertEqual(get_options('production'), options)
+
+        # config file changes invalidate the cache
+        self.write_config('https://alerta2.example.com/api')
+        os.utime(self.config_file, ns=(0, 0))
+        self.assertEqual(get_options('production')['endpoint'], 'https://alerta2.example.com/api')
+
+        os.environ['ALERTA_ENDPOINT'] = 'http://localhost:8080'
+        try:
+            self.assertEqual(get_options('production')['endpoint'], 'http://localhost:8080')
+        finally:
+            del os.environ['ALERTA_ENDPOINT']
+
+    def test_fanout(self):
+
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                requests.append((self.path, self.headers.get('Authorization')))
+                time.sleep(0.3)
+                if self.path.split('/')[1] in self.server.failing:
+                    status, reply = 500, b'{"status":"error","message":"down"}'
+                else:
+                    status, reply = 201, b'{"status":"ok","id":"1"}'
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.failing = set()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%d' % server.server_port
+
+        with open(self.config_file, 'w') as f:
+            f.write(
+                '[profile eu]\nendpoint = {0}/eu\n'
+                '[profile us]\nendpoint = {0}/us\nkey = us-key\n'
+                '[profile everywhere]\nfanout = eu, us, {0}/ap;ap-key\nfanout_success = quorum\n'.format(url)
+            )
+        alert = parse_zabbix(summary, body)
+
+        # targets are sent to at the same time, each with its own key
+        started = time.perf_counter()
+        self.assertEqual(forward(get_options('eu,us'), alert), SENT)
+        self.assertLess(time.perf_counter() - started, 0.55)
+        self.assertEqual(sorted(requests), [('/eu/alert', None), ('/us/alert', 'Key us-key')])
+
+        server.failing = {'us'}
+        with self.assertRaises(FanoutFailed):
+            forward(get_options('eu,us'), alert)
+        self.assertEqual(forward(get_options('everywhere'), alert), PARTIAL)
+        server.failing = {'us', 'ap'}
+        with self.assertRaises(FanoutFailed):
+            forward(get_options('everywhere'), alert)
+
+
+class PayloadTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        use_cache_dir(self, self.tmpdir.name)
+        self.options = dict(default_config, endpoint='http://localhost:8080')
+        self.alert = parse_zabbix(summary, body)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def sent(self, m, **options):
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        forward(dict(self.options, **options), self.alert)
+        return m.last_request.json()
+
+    @requests_mock.mock()
+    def test_raw_data_policy(self, m):
+
+        self.assertIsNone(self.sent(m)['rawData'])
+        self.assertEqual(self.sent(m, raw_data='full')['rawData'], '{}\n\n{}'.format(summary, body))
+        self.assertEqual(self.sent(m, raw_data='truncate', raw_data_size='20')['rawData'], 'PROBLEM: PSU-0.40...')
+        self.assertRegex(self.sent(m, raw_data='hash')['rawData'], r'^sha256:[0-9a-f]{64}$')
+        with self.assertRaises(ValueError):
+            self.sent(m, raw_data='none')
+
+        # built by the parser only as far as the policy keeps it
+        message = body + 'x' * 4 * 1024 * 1024
+        self.assertIsNone(parse_zabbix(summary, message, raw_data='omit')['rawData'])
+        raw = parse_zabbix(summary, message, raw_data='truncate', raw_data_size=20)['rawData']
+        self.assertEqual(raw, 'PROBLEM: PSU-0.40...')
+        raw = parse_zabbix(summary, 'é' * 30, raw_data='truncate', raw_data_size=50)['rawData']
+        self.assertEqual(raw, truncate('{}\n\n{}'.format(summary, 'é' * 30), 50))
+
+    @requests_mock.mock()
+    def test_max_field_size(self, m):
+
+        self.alert['value'] = 'x' * 1000
+        sent = self.sent(m, max_field_size='32')
+        self.assertEqual(sent['value'], 'x' * 29 + '...')
+        self.assertEqual(sent['text'], 'PROBLEM: PSU-0.40: Temperatur...')
+        self.assertEqual(sent['attributes']['ip'], '10.1.1.1')
+        self.assertEqual(len(sent['attributes']['moreInfo'].encode('utf-8')), 32)
+        self.assertEqual(self.alert['value'], 'x' * 1000)
+
+        # multi-byte characters are not split
+        self.assertEqual(truncate('°' * 10, 8), '°°...')
+
+    def test_gzip(self):
+
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers['Content-Length']))
+                requests.append((self.headers.get('Content-Encoding'), data))
+                status, reply = 201, b'{"status":"ok","id":"1"}'
+                if self.server.reply and self.headers.get('Content-Encoding'):
+                    status, reply = self.server.reply
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        server.reply = None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            self.alert['value'] = 'x' * 2000
+            options = dict(self.options, endpoint='http://127.0.0.1:%d' % server.server_address[1], gzip=True)
+            forward(options, self.alert)
+            self.assertEqual(requests[0][0], 'gzip')
+            self.assertEqual(json.loads(gzip.decompress(requests[0][1]))['value'], 'x' * 2000)
+
+            # endpoints that reject compressed bodies get them uncompressed
+            server.reply = (415, b'{"status":"error","message":"Unsupported Media Type"}')
+            forward(dict(options, timeout=5.0), self.alert)
+            forward(dict(options, timeout=5.0), self.alert)
+            self.assertEqual([encoding for encoding, _ in requests[1:]], ['gzip', None, None])
+            self.assertEqual(json.loads(requests[2][1])['value'], 'x' * 2000)
+
+            # an invalid alert is not sent again, only a body that could not be decoded
+            del requests[:]
+            server.reply = (400, b'{"status":"error","message":"Alert must have a resource"}')
+            with self.assertRaises(UnknownError):
+                forward(dict(options, timeout=6.0), self.alert)
+            self.assertEqual([encoding for encoding, _ in requests], ['gzip'])
+            server.reply = (400, b'{"status":"error","message":"Failed to decode JSON object"}')
+            forward(dict(options, timeout=7.0), self.alert)
+            self.assertEqual([encoding for encoding, _ in requests[1:]], ['gzip', None])
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,51 @@
+import io
+import json
+import tempfile
+import unittest
+
+import requests_mock
+
+from test_zabbix_alerta import body, summary, use_cache_dir
+from zabbix_batch import batch
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        use_cache_dir(self, self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    @requests_mock.mock()
+    def test_batch(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+
+        lines = [json.dumps({'sendto': 'http://localhost:8080', 'subject': summary, 'message': body})] * 20
+        lines[5] = '{"subject": "no message"}'
+        lines[10] = ''
+        failures = []
+        counts, elapsed = batch(
+            io.StringIO('\n'.join(lines)), workers=4, on_failure=lambda lineno, e: failures.append(lineno)
+        )
+
+        self.assertEqual(counts, {'sent': 18, 'failed': 1})
+        self.assertEqual(failures, [6])
+        self.assertEqual(m.call_count, 18)
+        self.assertEqual(m.last_request.json()['resource'], 'hostname1')
+
+    @requests_mock.mock()
+    def test_batch_default_sendto(self, m):
+
+        m.post('http://localhost:8080/alert', status_code=500, text='{"status":"error","message":"boom"}')
+
+        line = json.dumps({'subject': summary, 'message': body})
+        failures = []
+        counts, _ = batch(
+            io.StringIO(line), sendto='http://localhost:8080', on_failure=lambda lineno, e: failures.append(lineno)
+        )
+
+        self.assertEqual(counts, {'failed': 1})
+        self.assertEqual(failures, [1])
@@ -0,0 +1,111 @@
+import os
+import stat
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import requests_mock
+
+from test_zabbix_alerta import body, summary, use_cache_dir
+from zabbix_alerta import default_config, options_env, socket_path, submit
+from zabbix_daemon import Forwarder
+from zabbix_spool import Spool
+
+
+class ForwarderTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'zabbix-alerta.sock')
+        use_cache_dir(self, self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_submit_no_daemon(self):
+
+        self.assertFalse(submit('http://localhost:8080', summary, body, path=self.path))
+
+    @requests_mock.mock()
+    def test_submit(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+
+        server = Forwarder(self.path, workers=2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            self.assertTrue(submit('http://localhost:8080', summary, body, path=self.path))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(m.last_request.json()['resource'], 'hostname1')
+        self.assertFalse(os.path.exists(self.path))
+
+    def serve(self, **kwargs):
+
+        server = Forwarder(self.path, workers=2, **kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.addCleanup(stop)
+        return server
+
+    @requests_mock.mock()
+    def test_submit_failed(self, m):
+
+        # the script only gets OK once the alert is delivered
+        m.post('http://localhost:8080/alert', status_code=500, text='{"status":"error","message":"down"}')
+        self.serve()
+        self.assertFalse(submit('http://localhost:8080', summary, body, path=self.path))
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+    @requests_mock.mock()
+    def test_submit_other_environment(self, m):
+
+        # the script would resolve sendto to another endpoint, so it sends the alert itself
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.serve()
+        env = dict(options_env(), ALERTA_ENDPOINT='http://other.example.com:8080')
+        with mock.patch('zabbix_alerta.options_env', return_value=env):
+            self.assertFalse(submit('http://localhost:8080', summary, body, path=self.path))
+        self.assertFalse(m.called)
+        self.assertTrue(submit('http://localhost:8080', summary, body, path=self.path))
+
+    def test_submit_busy(self):
+
+        server = self.serve(max_pending=1)
+        server.pending.acquire()
+        self.assertFalse(submit('http://localhost:8080', summary, body, path=self.path))
+        server.pending.release()
+
+    def test_submit_spool(self):
+
+        spool_dir = os.path.join(self.tmpdir.name, 'spool')
+        server = self.serve()
+        server.profiles.get = lambda sendto: dict(default_config, spool_dir=spool_dir)
+        self.assertTrue(submit('http://localhost:8080', summary, body, path=self.path))
+
+        spool = Spool(spool_dir)
+        records = [record for _, _, record in spool.read()]
+        spool.close()
+        self.assertEqual(records[0]['alert']['resource'], 'hostname1')
+
+    def test_socket_path(self):
+
+        with mock.patch.dict(os.environ):
+            os.environ.pop('ZABBIX_ALERTA_SOCKET', None)
+            os.environ.pop('XDG_RUNTIME_DIR', None)
+            self.assertEqual(socket_path(), os.path.join(self.tmpdir.name, 'forwarder.sock'))
+            os.environ['XDG_RUNTIME_DIR'] = '/run/user/1000'
+            self.assertEqual(socket_path(), '/run/user/1000/zabbix-alerta/forwarder.sock')
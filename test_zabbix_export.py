@@ -0,0 +1,136 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import requests_mock
+
+from test_zabbix_alerta import use_cache_dir
+from zabbix_alerta import default_config
+from zabbix_export import ExportReader, ingest, problem_macros
+
+problem = {
+    'clock': 1519304285,
+    'ns': 123456789,
+    'value': 1,
+    'eventid': 42,
+    'objectid': 17,
+    'name': 'Zabbix agent on Host B is unreachable for 5 minutes',
+    'severity': 4,
+    'hosts': [{'host': 'hostb', 'name': 'Host B'}],
+    'groups': ['Linux servers', 'Zabbix servers'],
+    'tags': [{'tag': 'availability', 'value': ''}, {'tag': 'scope', 'value': 'agent'}],
+}
+recovery = {'clock': 1519304345, 'ns': 987654321, 'value': 0, 'eventid': 43, 'p_eventid': 42}
+
+
+class ExportTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.export_dir = os.path.join(self.tmpdir.name, 'export')
+        os.mkdir(self.export_dir)
+        self.path = os.path.join(self.export_dir, 'problems-history-syncer-1.ndjson')
+        self.checkpoint = os.path.join(self.tmpdir.name, 'checkpoint.json')
+        self.options = dict(default_config, endpoint='http://localhost:8080')
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        use_cache_dir(self, self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.executor.shutdown()
+        self.tmpdir.cleanup()
+
+    def write(self, *events, path=None):
+        with open(path or self.path, 'a') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+
+    @requests_mock.mock()
+    def test_problem_and_recovery(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.write(problem)
+
+        reader = ExportReader(self.export_dir, self.checkpoint)
+        self.assertEqual(ingest(reader, self.options, self.executor), (1, True))
+        alert = m.last_request.json()
+        self.assertEqual(alert['resource'], 'Host B')
+        self.assertEqual(alert['event'], '17')
+        self.assertEqual(alert['text'], 'PROBLEM: ' + problem['name'])
+        self.assertEqual(alert['severity'], 'major')
+        self.assertEqual(alert['service'], ['Linux servers', 'Zabbix servers'])
+        self.assertEqual(alert['tags'], ['availability', 'scope:agent'])
+        self.assertEqual(alert['attributes']['eventId'], '42')
+
+        # an export without trigger ids keys the alert on the problem name
+        without_trigger = {k: v for k, v in problem.items() if k != 'objectid'}
+        self.assertIn(('event', problem['name']), problem_macros(without_trigger, 'PROBLEM'))
+
+        # recovery is mapped to its problem after a restart
+        self.write(recovery)
+        reader = ExportReader(self.export_dir, self.checkpoint)
+        self.assertEqual(ingest(reader, self.options, self.executor), (1, True))
+        self.assertEqual(m.last_request.json()['severity'], 'normal')
+        self.assertEqual(m.last_request.json()['resource'], 'Host B')
+        self.assertEqual(m.last_request.json()['event'], '17')
+        self.assertEqual(m.last_request.json()['attributes']['eventId'], '42')
+        self.assertEqual(reader.problems, {})
+
+        self.assertEqual(ingest(reader, self.options, self.executor), (0, True))
+        self.assertEqual(m.call_count, 2)
+
+    @requests_mock.mock()
+    def test_checkpoint_batched(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        reader = ExportReader(self.export_dir, self.checkpoint, max_problems=3)
+        for eventid in range(1, 6):
+            self.write(dict(problem, eventid=eventid, hosts=[{'host': 'host%d' % eventid}]))
+            ingest(reader, self.options, self.executor)
+        with open(self.checkpoint) as f:
+            self.assertEqual(list(json.load(f)['problems']), ['1'])
+
+        # written when the interval is up, without the oldest open problems
+        reader.commit({}, now=time.monotonic() + 10)
+        with open(self.checkpoint) as f:
+            checkpoint = json.load(f)
+        self.assertEqual(sorted(checkpoint['problems']), ['3', '4', '5'])
+        self.assertEqual(set(checkpoint['problems']['5']), {'eventid', 'objectid', 'name', 'severity', 'hosts', 'groups', 'tags'})
+        self.assertEqual(ExportReader(self.export_dir, self.checkpoint).read(), [])
+
+    @requests_mock.mock()
+    def test_rotation(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.write(problem)
+        reader = ExportReader(self.export_dir, self.checkpoint)
+        ingest(reader, self.options, self.executor)
+
+        # more events, then Zabbix rotates the file
+        self.write(dict(problem, eventid=44))
+        os.rename(self.path, self.path + '.old')
+        self.write(dict(problem, eventid=45))
+        with open(self.path, 'a') as f:
+            f.write('{"partial":')
+
+        self.assertEqual(ingest(reader, self.options, self.executor), (1, True))
+        self.assertEqual(m.last_request.json()['attributes']['eventId'], '44')
+        self.assertEqual(ingest(reader, self.options, self.executor), (1, True))
+        self.assertEqual(m.last_request.json()['attributes']['eventId'], '45')
+        self.assertEqual(ingest(reader, self.options, self.executor), (0, True))
+
+    @requests_mock.mock()
+    def test_failed_delivery_is_retried(self, m):
+
+        m.post('http://localhost:8080/alert', exc=requests.exceptions.ConnectionError)
+        self.write(problem)
+
+        reader = ExportReader(self.export_dir, self.checkpoint)
+        self.assertEqual(ingest(reader, self.options, self.executor), (1, False))
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.assertEqual(ingest(reader, self.options, self.executor), (1, True))
+        self.assertEqual(ingest(reader, self.options, self.executor), (0, True))
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+import requests_mock
+from requests.exceptions import ConnectTimeout
+
+from zabbix_fleet import FAILED, OK, read_inventory, run, summary
+
+inventory = """
+[DEFAULT]
+sendto = production
+password_env = ZABBIX_PASSWORD
+
+[zabbix-eu1]
+server = http://zabbix-eu1
+
+[zabbix-us1]
+server = http://zabbix-us1
+password = secret
+json = yes
+timeout = 5
+"""
+
+
+def zabbix_api(request, context):
+
+    method = request.json()['method']
+    results = {
+        'apiinfo.version': '5.0.0',
+        'user.login': 'token',
+        'mediatype.get': [{'mediatypeid': '1', 'description': 'Alerta'}],
+        'user.get': [{'userid': '1', 'alias': 'Admin'}],
+        'user.updatemedia': {'userids': ['1']},
+        'action.create': {'actionids': ['7']},
+    }
+    return {'jsonrpc': '2.0', 'result': results[method], 'id': request.json()['id']}
+
+
+class FleetTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.inventory = os.path.join(self.tmpdir.name, 'inventory.ini')
+        with open(self.inventory, 'w') as f:
+            f.write(inventory)
+        os.environ['ZABBIX_PASSWORD'] = 'from-env'
+
+    def tearDown(self) -> None:
+        del os.environ['ZABBIX_PASSWORD']
+        self.tmpdir.cleanup()
+
+    def test_read_inventory(self):
+
+        servers = read_inventory(self.inventory)
+        self.assertEqual([s['name'] for s in servers], ['zabbix-eu1', 'zabbix-us1'])
+        self.assertEqual([s['password'] for s in servers], ['from-env', 'secret'])
+        self.assertEqual([s['use_json'] for s in servers], [False, True])
+        self.assertEqual([s['timeout'] for s in servers], [30.0, 5.0])
+
+    @requests_mock.mock()
+    def test_fleet(self, m):
+
+        m.post('http://zabbix-eu1/api_jsonrpc.php', json=zabbix_api)
+        m.post('http://zabbix-us1/api_jsonrpc.php', exc=ConnectTimeout)
+
+        results = run(read_inventory(self.inventory), workers=2)
+        self.assertEqual([r[1] for r in results], [OK, FAILED])
+        self.assertIn('Connected to Zabbix API Version 5.0.0', results[0][4])
+
+        actions = [r.json() for r in m.request_history if r.json()['method'] == 'action.create']
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0]['params']['name'], 'Forward to Alerta')
+
+        table = summary(results).splitlines()
+        self.assertTrue(table[1].startswith('zabbix-eu1  http://zabbix-eu1  ok'))
+        self.assertEqual(table[-1], '1 servers configured, 1 failed')
@@ -0,0 +1,105 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import requests_mock
+
+from test_zabbix_alerta import use_cache_dir
+from zabbix_alerta import SENT, default_config, forward
+from zabbix_inventory import Index, lookup, refresh, write_index
+
+
+class FakeZabbix:
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.calls = []
+        self.host = SimpleNamespace(get=self.host_get)
+
+    def host_get(self, hostids=None, **params):
+        self.calls.append((hostids, params))
+        if params['output'] == ['hostid']:
+            return [{'hostid': h['hostid']} for h in self.hosts]
+        return [h for h in self.hosts if h['hostid'] in hostids]
+
+
+def host(hostid, name, **inventory):
+    return {
+        'hostid': hostid,
+        'host': name,
+        'name': name.upper(),
+        'inventory': inventory,
+        'groups': [{'name': 'Linux servers'}, {'name': 'Databases'}],
+        'tags': [{'tag': 'team', 'value': 'dba'}, {'tag': 'pci', 'value': ''}],
+    }
+
+
+class InventoryTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'inventory.idx')
+        use_cache_dir(self, self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_index(self):
+
+        entries = {'host%d' % i: {'location': 'rack %d' % i} for i in range(1000)}
+        write_index(self.path, entries)
+
+        index = Index(self.path)
+        self.assertEqual(index.count, 1000)
+        self.assertEqual(index.get('host1'), {'location': 'rack 1'})
+        self.assertEqual(index.get('host999'), {'location': 'rack 999'})
+        self.assertIsNone(index.get('host1000'))
+        self.assertEqual(dict(index), entries)
+
+        write_index(self.path, {})
+        self.assertIsNone(Index(self.path).get('host1'))
+
+    def test_refresh(self):
+
+        zapi = FakeZabbix([host('1', 'db1', location='London', os='Linux', poc_1_name='Ops'), host('2', 'db2')])
+        self.assertEqual(refresh(zapi, self.path, (5, 0)), (2, 4, 0, 0))
+        self.assertEqual(
+            lookup(self.path, 'DB1'),
+            {'location': 'London', 'os': 'Linux', 'owner': 'Ops', 'hostGroups': 'Databases, Linux servers', 'hostTags': 'pci, team:dba'},
+        )
+        self.assertIn('selectGroups', zapi.calls[1][1])
+        self.assertIn('selectTags', zapi.calls[1][1])
+
+        # unchanged, the index is not replaced
+        inode = os.stat(self.path).st_ino
+        self.assertEqual(refresh(zapi, self.path, (5, 0)), (2, 0, 0, 0))
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+
+        # readers pick up the new index once it is replaced
+        zapi.hosts = [host('1', 'db1', location='Paris'), host('3', 'db3')]
+        self.assertEqual(refresh(zapi, self.path, (6, 4)), (2, 2, 2, 2))
+        self.assertIn('selectHostGroups', zapi.calls[-1][1])
+        self.assertEqual(lookup(self.path, 'db1')['location'], 'Paris')
+        self.assertIsNone(lookup(self.path, 'db2'))
+
+    @requests_mock.mock()
+    def test_enrich(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        write_index(self.path, {'db1': {'location': 'London', 'owner': 'Ops'}})
+        options = dict(default_config, endpoint='http://localhost:8080', inventory=self.path)
+
+        alert = {'resource': 'db1', 'event': 'cpu', 'attributes': {'owner': 'DBA'}}
+        self.assertEqual(forward(options, alert), SENT)
+        self.assertEqual(m.last_request.json()['attributes'], {'location': 'London', 'owner': 'DBA'})
+
+        # a missing or broken index does not stop alerts
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage' * 10)
+        self.assertEqual(forward(options, dict(alert, resource='db2')), SENT)
+        self.assertEqual(forward(dict(options, inventory=self.path + '.missing'), alert), SENT)
+        self.assertEqual(m.last_request.json()['attributes'], {'owner': 'DBA'})
+
+
+if __name__ == '__main__':
+    unittest.main()
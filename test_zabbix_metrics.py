@@ -0,0 +1,129 @@
+import os
+import socket
+import tempfile
+import unittest
+from urllib.request import urlopen
+
+import requests
+import requests_mock
+
+import zabbix_alerta
+import zabbix_metrics
+from test_zabbix_alerta import use_cache_dir
+from zabbix_alerta import ERROR, SENT, default_config, forward, send
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.textfile = os.path.join(self.tmpdir.name, 'zabbix_alerta.prom')
+        use_cache_dir(self, self.tmpdir.name)
+        self.options = dict(default_config, endpoint='http://localhost:8080', profile='prod')
+        self.alert = {'environment': 'Production', 'resource': 'host1', 'event': 'temp', 'severity': 'major'}
+
+        zabbix_metrics.REGISTRY.clear()
+        zabbix_metrics._textfiles.clear()
+
+    def tearDown(self) -> None:
+        zabbix_alerta.collect_metrics = False
+        self.tmpdir.cleanup()
+
+    def read_textfile(self):
+        zabbix_metrics.flush_all()
+        with open(self.textfile) as f:
+            return f.read()
+
+    @requests_mock.mock()
+    def test_textfile(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.options['metrics_textfile'] = self.textfile
+
+        self.assertEqual(forward(self.options, self.alert), SENT)
+        text = self.read_textfile()
+        self.assertIn('# TYPE zabbix_alerta_alerts_total counter', text)
+        self.assertIn(
+            'zabbix_alerta_alerts_total{profile="prod",endpoint="http://localhost:8080",severity="major",status="sent"} 1',
+            text,
+        )
+        self.assertIn('zabbix_alerta_phase_seconds_count{profile="prod",phase="send"} 1', text)
+        self.assertIn('zabbix_alerta_phase_seconds_bucket{profile="prod",phase="client",le="+Inf"} 1', text)
+        self.assertIn('zabbix_alerta_payload_bytes_count{profile="prod"} 1', text)
+
+        # counters from other processes are added to, not replaced
+        zabbix_metrics._textfiles.clear()
+        m.post('http://localhost:8080/alert', status_code=500, text='{"status":"error","message":"oops"}')
+        with self.assertRaises(Exception):
+            forward(self.options, self.alert)
+        text = self.read_textfile()
+        self.assertIn('severity="major",status="sent"} 1', text)
+        self.assertIn('severity="major",status="error"} 1', text)
+        self.assertIn('zabbix_alerta_phase_seconds_count{profile="prod",phase="send"} 2', text)
+
+    @requests_mock.mock()
+    def test_script_phases(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        with open(os.path.join(self.tmpdir.name, 'alerta.conf'), 'w') as f:
+            f.write('[DEFAULT]\nendpoint = http://localhost:8080\nmetrics_textfile = %s\n' % self.textfile)
+        env = dict(ALERTA_CONF_FILE=f.name, ZABBIX_ALERTA_CACHE_DIR=self.tmpdir.name)
+        saved = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        try:
+            self.assertEqual(send('', 'PROBLEM: test', 'resource=host1\nevent=temp\nseverity=High'), 0)
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+
+        text = self.read_textfile()
+        for phase in ('config', 'parse', 'client', 'send', 'total'):
+            self.assertIn('zabbix_alerta_phase_seconds_count{profile="",phase="%s"} 1' % phase, text)
+
+    @requests_mock.mock()
+    def test_statsd(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(5)
+        self.options['metrics_statsd'] = '127.0.0.1:%d' % sock.getsockname()[1]
+
+        self.assertEqual(forward(self.options, self.alert), SENT)
+        lines = sock.recv(65536).decode('utf-8').split('\n')
+        sock.close()
+        self.assertIn(
+            'zabbix_alerta.alerts:1|c|#profile:prod,endpoint:http://localhost:8080,severity:major,status:sent', lines
+        )
+        self.assertTrue(any(line.startswith('zabbix_alerta.phase:') and line.endswith('|ms|#profile:prod,phase:send') for line in lines))
+        self.assertTrue(any(line.startswith('zabbix_alerta.payload_bytes:') for line in lines))
+
+    def test_scrape_endpoint(self):
+
+        server = zabbix_metrics.serve('127.0.0.1:0')
+        try:
+            self.assertTrue(zabbix_alerta.collect_metrics)
+            with requests_mock.Mocker(real_http=True) as m:
+                m.post('http://localhost:8080/alert', exc=requests.exceptions.ConnectionError)
+                with self.assertRaises(requests.exceptions.ConnectionError):
+                    forward(self.options, self.alert)
+            with urlopen('http://127.0.0.1:%d/metrics' % server.server_address[1]) as response:
+                text = response.read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('status="%s"} 1' % ERROR, text)
+        self.assertFalse(os.path.exists(self.textfile))
+
+    def test_label_escaping(self):
+
+        registry = zabbix_metrics.Registry()
+        registry.incr('alerts_total', (('profile', 'a"b\\c\nd'),))
+        self.assertIn('zabbix_alerta_alerts_total{profile="a\\"b\\\\c\\nd"} 1', registry.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
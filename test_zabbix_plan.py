@@ -0,0 +1,106 @@
+import unittest
+from types import SimpleNamespace
+
+from zabbix_config import action_params, script_mediatype
+from zabbix_plan import CREATE, UNCHANGED, UPDATE, Planner, format_change
+
+
+class FakeMethod:
+    def __init__(self, api, name):
+        self.api = api
+        self.name = name
+
+    def __getattr__(self, method):
+        def call(**params):
+            self.api.calls.append(('%s.%s' % (self.name, method), params))
+            return self.api.handle(self.name, method, params)
+
+        return call
+
+
+class FakeZabbixAPI:
+    """
+    Stores media types, the Admin user and actions like a Zabbix 5.0 server.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.mediatypes = []
+        self.medias = []
+        self.actions = []
+
+    def __getattr__(self, name):
+        return FakeMethod(self, name)
+
+    def handle(self, name, method, params):
+        if (name, method) == ('mediatype', 'get'):
+            return [m for m in self.mediatypes if m['name'] == params['filter']['name']]
+        if (name, method) == ('mediatype', 'create'):
+            self.mediatypes.append(dict(params, mediatypeid='3'))
+            return {'mediatypeids': ['3']}
+        if (name, method) == ('mediatype', 'update'):
+            self.mediatypes[0].update(params)
+            return {'mediatypeids': ['3']}
+        if (name, method) == ('user', 'get'):
+            return [{'userid': '1', 'medias': [dict(m, mediaid=str(i)) for i, m in enumerate(self.medias)]}]
+        if (name, method) == ('user', 'update'):
+            self.medias = params['user_medias']
+            return {'userids': ['1']}
+        if (name, method) == ('action', 'get'):
+            return [a for a in self.actions if a['name'] == params['filter']['name']]
+        if (name, method) == ('action', 'create'):
+            self.actions.append(dict(params, actionid='7'))
+            return {'actionids': ['7']}
+        if (name, method) == ('action', 'update'):
+            self.actions[0].update(params)
+            return {'actionids': ['7']}
+        raise AssertionError('unexpected call %s.%s' % (name, method))
+
+
+class PlanTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.zapi = FakeZabbixAPI()
+        self.zapi.medias = [{'mediatypeid': '1', 'sendto': 'admin@example.com', 'active': '0', 'severity': '63', 'period': '1-7,00:00-24:00'}]
+        zc = SimpleNamespace(zapi=self.zapi, version=(5, 0), mediatype_name_field='name', user_alias_field='alias')
+        self.planner = Planner(zc, 'production', 'http://zabbix-web')
+
+    def writes(self):
+        return [name for name, _ in self.zapi.calls if not name.endswith('.get')]
+
+    def test_plan_makes_no_changes(self):
+
+        changes = self.planner.plan()
+        self.assertEqual([c.op for c in changes], [CREATE, CREATE, CREATE])
+        self.assertEqual(self.writes(), [])
+
+    def test_apply_is_idempotent(self):
+
+        self.planner.apply()
+        self.assertEqual(self.writes(), ['mediatype.create', 'user.update', 'action.create'])
+        self.assertEqual(len(self.zapi.medias), 2)
+
+        self.zapi.calls.clear()
+        changes = self.planner.apply()
+        self.assertEqual([c.op for c in changes], [UNCHANGED, UNCHANGED, UNCHANGED])
+        self.assertEqual(self.writes(), [])
+
+        # only filtered gets with the fields needed
+        self.assertEqual(self.zapi.calls[0][1]['filter'], {'name': 'Alerta'})
+        self.assertEqual(self.zapi.calls[1][1]['output'], ['userid'])
+
+    def test_apply_updates_changed_template(self):
+
+        self.zapi.mediatypes.append(dict(script_mediatype('name'), mediatypeid='3', maxattempts='3'))
+        self.zapi.actions.append(dict(action_params('3', '1', 'http://zabbix-web', use_json=True), actionid='7'))
+
+        changes = self.planner.apply()
+        self.assertEqual([c.op for c in changes], [UPDATE, CREATE, UPDATE])
+        self.assertEqual(changes[0].fields, ['maxattempts'])
+        self.assertEqual(changes[2].fields, ['def_longdata', 'r_longdata', 'operations', 'recovery_operations'])
+        self.assertEqual(self.writes(), ['mediatype.update', 'user.update', 'action.update'])
+        self.assertEqual(
+            format_change(changes[2], applied=True),
+            '~ updated action "Forward to Alerta": def_longdata, r_longdata, operations, recovery_operations',
+        )
+        self.assertEqual([c.op for c in self.planner.plan()], [UNCHANGED, UNCHANGED, UNCHANGED])
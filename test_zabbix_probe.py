@@ -0,0 +1,78 @@
+import time
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+from zabbix_probe import Probe, latencies, percentile, report
+
+
+class FakePipeline:
+    """
+    Zabbix and Alerta APIs that see every trapper value 0.1s later at each
+    stage, and the Zabbix alert for the second value is never sent.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.history = SimpleNamespace(get=self.history_get)
+        self.event = SimpleNamespace(get=self.event_get)
+        self.alert = SimpleNamespace(get=self.alert_get)
+
+    def send(self, trapper, host, key, value):
+        self.sent.append((value, time.time()))
+
+    def clock(self, t):
+        return {'clock': str(int(t)), 'ns': str(int((t - int(t)) * 1e9))}
+
+    def history_get(self, **kwargs):
+        return [dict(self.clock(t + 0.1), value=v) for v, t in self.sent]
+
+    def event_get(self, **kwargs):
+        return [dict(self.clock(t + 0.2), eventid=str(i), name='Alerta probe ' + v) for i, (v, t) in enumerate(self.sent)]
+
+    def alert_get(self, eventids, **kwargs):
+        return [{'eventid': e, 'clock': str(int(self.sent[int(e)][1]) + 1), 'status': '1'} for e in eventids if e != '1']
+
+    def get_history(self, query, page_size):
+        # newest first, with a value left over from an earlier run
+        history = [SimpleNamespace(value=v, update_time=datetime.utcfromtimestamp(t + 1.5)) for v, t in self.sent]
+        history.append(SimpleNamespace(value=self.sent[0][0], update_time=datetime.utcfromtimestamp(self.sent[0][1] - 60)))
+        return history[::-1][:page_size]
+
+
+class ProbeTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3.0], 99), 3.0)
+        self.assertIsNone(percentile([], 50))
+
+    def test_probe(self):
+
+        pipeline = FakePipeline()
+        job = Probe(pipeline, pipeline, 'zabbix-server')
+        with mock.patch('zabbix_probe.trapper_send', pipeline.send):
+            samples = job.run(count=3, rate=100, timeout=0)
+
+        self.assertEqual(len(samples), 3)
+        result = latencies(samples)
+        self.assertEqual([round(v, 3) for v in result['send -> history']], [0.1, 0.1, 0.1])
+        self.assertEqual(len(result['event -> alert']), 2)
+        # every probe reaches Alerta, not only the latest one
+        self.assertEqual([round(v, 3) for v in result['total']], [1.5, 1.5, 1.5])
+
+        # only probes of this run, received after they were sent
+        now = time.time()
+        job.samples = {'probe-1': {'send': now}}
+        self.assertFalse(job.received('probe-1', now - 60))
+        self.assertFalse(job.received('probe-2', now + 1))
+        self.assertTrue(job.received('probe-1', now + 1))
+
+        lines = report(samples).splitlines()
+        self.assertEqual(lines[0].split(), ['STAGE', 'COUNT', 'P50', 'P95', 'P99'])
+        self.assertEqual(lines[1].split()[:4], ['send', '->', 'history', '3'])
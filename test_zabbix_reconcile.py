@@ -0,0 +1,139 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from zabbix_reconcile import Reconciler
+
+
+class FakeZabbix:
+    """
+    Problems and events of a Zabbix server, with the get methods used.
+    """
+
+    def __init__(self):
+        self.events = []  # (eventid, objectid, value)
+        self.open = {}  # eventid -> objectid
+        self.calls = []
+
+        self.event = SimpleNamespace(get=self.event_get)
+        self.problem = SimpleNamespace(get=self.problem_get)
+
+    def add(self, objectid, value):
+        eventid = str(len(self.events) + 1)
+        self.events.append((eventid, objectid, value))
+        if value:
+            self.open[eventid] = objectid
+        else:
+            self.open = {e: o for e, o in self.open.items() if o != objectid}
+        return eventid
+
+    def event_get(self, sortorder='ASC', limit=None, eventid_from=0, value=None, **kwargs):
+        self.calls.append(('event.get', eventid_from))
+        events = [
+            {'eventid': e, 'objectid': o}
+            for e, o, v in self.events
+            if int(e) >= eventid_from and (value is None or v == value)
+        ]
+        if sortorder == 'DESC':
+            events.reverse()
+        return events[:limit]
+
+    def problem_get(self, eventids=None, limit=None, eventid_from=0, **kwargs):
+        self.calls.append(('problem.get', eventid_from))
+        problems = [
+            {'eventid': e, 'objectid': o}
+            for e, o in self.open.items()
+            if int(e) >= eventid_from and (eventids is None or e in eventids)
+        ]
+        return problems[:limit]
+
+
+class FakeAlerta:
+    def __init__(self):
+        self.alerts = {}
+        self.actions = []
+
+    def get_alerts(self, query, page=1, page_size=None):
+        origin = dict(query)['origin']
+        status = [v for k, v in query if k == 'status']
+        eventids = [v for k, v in query if k == 'attributes.eventId']
+        alerts = [
+            SimpleNamespace(id=id, status=a['status'], severity=a['severity'], attributes={'eventId': a['eventId']})
+            for id, a in sorted(self.alerts.items())
+            if a['origin'] == origin and a['status'] in status and (not eventids or a['eventId'] in eventids)
+        ]
+        return alerts[(page - 1) * page_size:page * page_size]
+
+    def action(self, id, action, text=''):
+        self.actions.append((id, action))
+        self.alerts[id]['status'] = 'closed' if action == 'close' else 'open'
+
+
+class ReconcileTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state = os.path.join(self.tmpdir.name, 'reconcile.json')
+        self.zapi = FakeZabbix()
+        self.api = FakeAlerta()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def alert(self, id, eventid, status='open', severity='major', origin='zabbix/zabbix1'):
+        self.api.alerts[id] = {'eventId': eventid, 'status': status, 'severity': severity, 'origin': origin}
+
+    def reconciler(self, **kwargs):
+        return Reconciler(self.zapi, self.api, self.state, origin='zabbix/zabbix1', **kwargs)
+
+    def test_reconcile(self):
+
+        for objectid in ('10', '11', '12'):
+            self.alert('a' + objectid, self.zapi.add(objectid, 1))
+        reconciler = self.reconciler(page_size=2)
+        self.assertEqual(reconciler.reconcile(now=1000), ([], []))
+
+        # lost recovery message, and an alert closed by hand
+        self.zapi.add('10', 0)
+        self.api.alerts['a11']['status'] = 'closed'
+        self.zapi.calls.clear()
+
+        reconciler = self.reconciler(page_size=2)
+        self.assertEqual(reconciler.reconcile(now=1060), (['a10'], ['a11']))
+        self.assertEqual(sorted(reconciler.problems), ['2', '3'])
+
+        # incremental: only events after the watermark were requested
+        self.assertEqual(self.zapi.calls[:2], [('problem.get', 4), ('event.get', 4)])
+        self.assertEqual(self.api.alerts['a10']['status'], 'closed')
+        self.assertEqual(self.api.alerts['a11']['status'], 'open')
+
+    def test_new_problems_not_closed(self):
+
+        reconciler = self.reconciler()
+        reconciler.reconcile(now=1000)
+
+        # alert arrives in Alerta before the next sync
+        self.alert('a1', '99')
+        self.assertEqual(reconciler.reconcile(now=1060), ([], []))
+
+    def test_other_server(self):
+
+        # same event id from another Zabbix server, resolved only there
+        self.alert('a1', self.zapi.add('10', 1))
+        self.alert('b1', '1', origin='zabbix/zabbix2')
+        self.alert('b2', '1', status='closed', origin='zabbix/zabbix2')
+        self.assertEqual(self.reconciler().reconcile(now=1000), ([], []))
+
+        self.zapi.add('10', 0)
+        self.assertEqual(self.reconciler().reconcile(now=1060), (['a1'], []))
+        self.assertEqual(self.api.alerts['b1']['status'], 'open')
+
+    def test_dry_run(self):
+
+        self.alert('a1', self.zapi.add('10', 1))
+        self.zapi.add('10', 0)
+
+        reconciler = self.reconciler()
+        self.assertEqual(reconciler.reconcile(dry_run=True, now=1000), (['a1'], []))
+        self.assertEqual(self.api.actions, [])
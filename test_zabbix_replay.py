@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import unittest
+
+import requests
+import requests_mock
+
+from test_zabbix_alerta import use_cache_dir
+from zabbix_alerta import default_config
+from zabbix_replay import Replay, parse_time, time_slices
+
+
+class FakeEvents:
+    def __init__(self, events):
+        self.events = events
+        self.calls = 0
+
+    def get(self, time_from, time_till, countOutput=False, eventid_from=0, limit=None, **kwargs):
+        self.calls += 1
+        events = [e for e in self.events if time_from <= e['clock'] <= time_till and int(e['eventid']) >= eventid_from]
+        if countOutput:
+            return str(len(events))
+        return [dict(e, clock=str(e['clock'])) for e in events[:limit]]
+
+
+class FakeHosts:
+    def get(self, hostids, **kwargs):
+        return [{'hostid': hostid, 'groups': [{'name': 'Linux servers'}]} for hostid in hostids]
+
+
+class FakeZabbixAPI:
+    def __init__(self, events):
+        self.event = FakeEvents(events)
+        self.host = FakeHosts()
+
+
+def make_events(count, start=1000, step=1):
+    return [
+        {
+            'eventid': str(100 + i),
+            'objectid': str(10 + i % 3),
+            'clock': start + i * step,
+            'value': '1' if i % 2 == 0 else '0',
+            'name': 'Trigger %d' % (i % 3),
+            'severity': '4',
+            'acknowledged': '0',
+            'hosts': [{'hostid': '1', 'host': 'host1', 'name': 'Host 1'}],
+            'tags': [],
+        }
+        for i in range(count)
+    ]
+
+
+class ReplayTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.checkpoint = os.path.join(self.tmpdir.name, 'checkpoint.json')
+        self.options = dict(default_config, endpoint='http://localhost:8080')
+        use_cache_dir(self, self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_parse_time(self):
+
+        self.assertEqual(parse_time('1500000000'), 1500000000)
+        self.assertEqual(parse_time('2h', now=10000), 2800)
+        self.assertEqual(parse_time('now', now=10000), 10000)
+        with self.assertRaises(ValueError):
+            parse_time('yesterday')
+
+    def test_time_slices(self):
+
+        self.assertEqual(time_slices(0, 99, 4), [(0, 24), (25, 49), (50, 74), (75, 99)])
+        self.assertEqual(time_slices(0, 2, 4), [(0, 0), (1, 1), (2, 2)])
+
+    @requests_mock.mock()
+    def test_replay(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        zapi = FakeZabbixAPI(make_events(50))
+
+        progress = []
+        job = Replay(zapi, self.options, 1000, 1049, self.checkpoint, page_size=4)
+        self.assertEqual(job.run(workers=4, fetch_workers=3, progress=lambda *args: progress.append(args[:2])), 50)
+
+        # the first event of trigger 11 recovers a problem before the range
+        self.assertEqual(m.call_count, 49)
+        self.assertEqual(progress[-1], (50, 50))
+        alerts = [r.json() for r in m.request_history]
+        first, recovery = [a for a in alerts if a['attributes']['eventId'] == '100']
+        self.assertEqual(first['resource'], 'Host 1')
+        self.assertEqual(first['service'], ['Linux servers'])
+        self.assertEqual(first['severity'], 'major')
+        self.assertEqual((first['event'], recovery['event'], recovery['severity']), ('10', '10', 'normal'))
+
+        # events of the same trigger are sent in order
+        for objectid in ('10', '11', '12'):
+            sent = [a['attributes']['eventId'] for a in alerts if a['attributes']['triggerId'] == objectid]
+            self.assertEqual(sent, sorted(sent))
+
+        # nothing left to replay for the same range
+        self.assertEqual(Replay(zapi, self.options, 1000, 1049, self.checkpoint).run(), 0)
+
+    @requests_mock.mock()
+    def test_resume(self, m):
+
+        # Alerta goes away after the first page of events
+        m.post('http://localhost:8080/alert', [{'text': '{"status":"ok"}'}] * 5 + [{'exc': requests.exceptions.ConnectionError}])
+        zapi = FakeZabbixAPI(make_events(20, step=0))
+
+        job = Replay(zapi, self.options, 1000, 1190, self.checkpoint, page_size=5)
+        with self.assertRaises(RuntimeError):
+            job.run(workers=1)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['eventid'], '104')
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.assertEqual(job.run(workers=1), 15)
@@ -0,0 +1,165 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import requests_mock
+
+from test_zabbix_alerta import use_cache_dir
+from zabbix_alerta import DROPPED, SENT, default_config, forward
+from zabbix_config import rules as rules_command
+from zabbix_rules import Rules, compile_rules, load_rules, read_rules
+
+RULES = '''
+[rule drop-info]
+severity = informational, indeterminate
+drop = yes
+
+[rule databases]
+service = Databases
+resource = db*
+    ~^mysql-[0-9]+$
+sendto = http://dba.example.com
+
+[rule staging]
+resource = stg-*
+set_environment = Staging
+
+[rule pci]
+tags = pci
+event = agent.ping, icmpping
+sendto = http://security.example.com
+'''
+
+
+class RulesTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = self.write('rules.ini', RULES)
+        use_cache_dir(self, self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def match(self, **alert):
+        rule = load_rules(self.path, self.tmpdir.name).match(alert)
+        return rule and rule['name']
+
+    def test_match(self):
+
+        self.assertEqual(self.match(resource='web1', severity='informational'), 'drop-info')
+        self.assertEqual(self.match(resource='db1', severity='major', service=['Linux', 'Databases']), 'databases')
+        self.assertEqual(self.match(resource='mysql-12', severity='major', service=['Databases']), 'databases')
+        self.assertIsNone(self.match(resource='mysql-12a', severity='major', service=['Databases']))
+        self.assertIsNone(self.match(resource='db1', severity='major', service=['Linux']))
+        self.assertEqual(self.match(resource='stg-web1', severity='major'), 'staging')
+        self.assertEqual(self.match(resource='db1', severity='informational', service=['Databases']), 'drop-info')  # first match wins
+        self.assertEqual(self.match(resource='pos1', event='icmpping', tags=['pci', 'eu']), 'pci')
+        self.assertIsNone(self.match(resource='pos1', event='icmpping', tags=['eu']))
+        self.assertIsNone(self.match())
+
+    def test_cache(self):
+
+        load_rules(self.path, self.tmpdir.name)
+        cached = [name for name in os.listdir(self.tmpdir.name) if name.startswith('rules-')]
+        self.assertEqual(len(cached), 1)
+
+        # a changed rules file is compiled again
+        self.write('rules.ini', RULES + '\n[rule all]\nresource = *\ndrop = yes\n')
+        self.assertEqual(self.match(resource='web1', severity='major'), 'all')
+        with open(os.path.join(self.tmpdir.name, cached[0])) as f:
+            self.assertEqual(len(json.load(f)['compiled']['rules']), 5)
+
+    def test_many_rules(self):
+
+        text = ''.join('[rule r%d]\nresource = host%d\nevent = key%d*\ndrop = yes\n\n' % (i, i, i % 10) for i in range(5000))
+        text += '[rule regex]\nresource = ~^host(1|2)$\nsendto = other\n'
+        rules = Rules(compile_rules(read_rules(self.write('many.ini', text))))
+        self.assertEqual(rules.match({'resource': 'host4321', 'event': 'key1.x'})['name'], 'r4321')
+        self.assertIsNone(rules.match({'resource': 'host4321', 'event': 'key2.x'}))
+        self.assertEqual(rules.match({'resource': 'host2', 'event': 'other'})['name'], 'regex')
+
+    def test_invalid(self):
+
+        for text, error in [
+            ('[rule a]\nresource = web1\n', 'no sendto'),
+            ('[rule a]\nhost = web1\ndrop = yes\n', "unknown key 'host'"),
+            ('[rule a]\nresource = ~(\ndrop = yes\n', 'invalid regex'),
+            ('[a]\ndrop = yes\n', 'must be named'),
+        ]:
+            with self.assertRaisesRegex(ValueError, error):
+                read_rules(self.write('bad.ini', text))
+
+    @requests_mock.mock()
+    def test_forward(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        m.post('http://dba.example.com/alert', text='{"status":"ok"}')
+        options = dict(default_config, endpoint='http://localhost:8080', rules=self.path)
+        alert = {'resource': 'db1', 'event': 'cpu', 'severity': 'major', 'environment': 'Production'}
+
+        self.assertEqual(forward(options, dict(alert, severity='informational')), DROPPED)
+        self.assertFalse(m.called)
+        self.assertEqual(forward(options, dict(alert, service=['Databases'])), SENT)
+        self.assertEqual(m.last_request.url, 'http://dba.example.com/alert')
+        self.assertEqual(forward(options, dict(alert, resource='stg-db1')), SENT)
+        self.assertEqual(m.last_request.url, 'http://localhost:8080/alert')
+        self.assertEqual(m.last_request.json()['environment'], 'Staging')
+
+    @requests_mock.mock()
+    def test_forward_fanout(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        m.post('http://eu.example.com/alert', text='{"status":"ok"}')
+        m.post('http://us.example.com/alert', text='{"status":"ok"}')
+        config_file = self.write(
+            'alerta.conf',
+            '[profile eu]\nendpoint = http://eu.example.com\n'
+            '[profile us]\nendpoint = http://us.example.com\n'
+            '[profile both]\nfanout = eu, us\n',
+        )
+        rules = self.write('fanout.ini', '[rule databases]\nservice = Databases\nsendto = both\n')
+        with mock.patch.dict(os.environ, {'ALERTA_CONF_FILE': config_file}):
+            options = dict(default_config, endpoint='http://localhost:8080', rules=rules)
+            alert = {'resource': 'db1', 'event': 'cpu', 'severity': 'major', 'service': ['Databases']}
+            self.assertEqual(forward(options, alert), SENT)
+
+        self.assertEqual(sorted(r.url for r in m.request_history), ['http://eu.example.com/alert', 'http://us.example.com/alert'])
+
+    def test_command(self):
+
+        alerts = self.write(
+            'alerts.ndjson',
+            json.dumps({'sendto': 'http://localhost:8080', 'subject': 'PROBLEM', 'message': 'resource=stg-web1\nevent=cpu\nseverity=High'})
+            + '\n'
+            + json.dumps({'sendto': 'http://localhost:8080', 'subject': 'PROBLEM', 'message': 'resource=web1\nseverity=Information'})
+            + '\n',
+        )
+        output = io.StringIO()
+        with redirect_stdout(output):
+            rules_command(['test', self.path, alerts])
+        self.assertEqual(
+            output.getvalue().splitlines()[1:],
+            [
+                'line 1: stg-web1 cpu major -> rule "staging": environment Staging',
+                'line 2: web1 None informational -> rule "drop-info": drop',
+            ],
+        )
+
+        with self.assertRaises(SystemExit):
+            with redirect_stdout(output):
+                rules_command(['test', self.write('bad.ini', '[rule a]\nresource = web1\n')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+
+import requests_mock
+from click.testing import CliRunner
+from requests.exceptions import ConnectTimeout
+
+from test_zabbix_alerta import body, summary, use_cache_dir
+from zabbix_alerta import cli
+from zabbix_spool import Spool, drain
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool = Spool(self.tmpdir.name, segment_size=256)
+        use_cache_dir(self, self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.spool.close()
+        self.tmpdir.cleanup()
+
+    def append(self, n):
+        for i in range(n):
+            self.spool.append({'sendto': 'http://localhost:8080', 'alert': {'resource': 'host%d' % i, 'event': 'e'}})
+
+    def test_read_skips_torn_record(self):
+
+        self.spool.segment_size = 4096
+        self.append(3)
+        with open(self.spool.segment_path(self.spool.segments()[-1]), 'ab') as f:
+            f.write(b'\xa5\x5a\x00\x00\x10\x00garbage')
+        self.append(1)
+
+        resources = [record['alert']['resource'] for _, _, record in self.spool.read()]
+        self.assertEqual(resources, ['host0', 'host1', 'host2', 'host0'])
+
+    @requests_mock.mock()
+    def test_drain(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.append(10)
+        self.assertGreater(len(self.spool.segments()), 1)
+
+        delivered, drained = drain(self.spool, concurrency=1)
+        self.assertEqual((delivered, drained), (10, True))
+        self.assertEqual([r.json()['resource'] for r in m.request_history], ['host%d' % i for i in range(10)])
+        self.assertEqual(len(self.spool.segments()), 1)
+
+        self.assertEqual(drain(self.spool), (0, True))
+
+    @requests_mock.mock()
+    def test_drain_resumes_after_failure(self, m):
+
+        m.post('http://localhost:8080/alert', exc=ConnectTimeout)
+        self.append(3)
+
+        self.assertEqual(drain(self.spool), (0, False))
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.assertEqual(drain(self.spool), (3, True))
+
+    @requests_mock.mock()
+    def test_drain_server_error(self, m):
+
+        # server errors are retried, only alerts Alerta rejects are dropped
+        m.post('http://localhost:8080/alert', status_code=503, json={'status': 'error', 'message': 'unavailable'})
+        self.append(2)
+        self.assertEqual(drain(self.spool), (0, False))
+        self.assertEqual(len(list(self.spool.read(*self.spool.checkpoint()))), 2)
+
+        m.post('http://localhost:8080/alert', status_code=400, json={'status': 'error', 'message': 'invalid'})
+        self.assertEqual(drain(self.spool), (2, True))
+        self.assertEqual(list(self.spool.read(*self.spool.checkpoint())), [])
+
+    def test_cli_spool(self):
+
+        config_file = os.path.join(self.tmpdir.name, 'alerta.conf')
+        with open(config_file, 'w') as f:
+            f.write('[profile spooled]\nspool_dir = %s\n' % self.tmpdir.name)
+
+        result = CliRunner(env={'ALERTA_CONF_FILE': config_file}).invoke(cli, ['spooled', summary, body])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        records = [record for _, _, record in self.spool.read()]
+        self.assertEqual(records[0]['sendto'], 'spooled')
+        self.assertEqual(records[0]['alert']['resource'], 'hostname1')
@@ -0,0 +1,313 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import requests
+import requests_mock
+from alertaclient.exceptions import UnknownError
+
+from test_zabbix_alerta import use_cache_dir
+from zabbix_alerta import (AGGREGATED, DEFERRED, DUPLICATE, SENT, SHED,
+                           SPOOLED, SUPPRESSED, CircuitOpen, Throttled,
+                           default_config, forward)
+from zabbix_spool import Spool
+from zabbix_state import State
+
+
+class StateTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        use_cache_dir(self, self.tmpdir.name)
+
+        self.options = dict(default_config, endpoint='http://localhost:8080')
+        self.alert = {'environment': 'Production', 'resource': 'host1', 'event': 'temp', 'severity': 'major', 'value': '61'}
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def counters(self):
+        state = State()
+        try:
+            return state.counters()
+        finally:
+            state.close()
+
+    @requests_mock.mock()
+    def test_suppress_repeats(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.options['suppress_ttl'] = '60'
+
+        self.assertEqual(forward(self.options, self.alert), SENT)
+        self.assertEqual(forward(self.options, self.alert), SUPPRESSED)
+        self.assertEqual(forward(self.options, dict(self.alert, value='62')), SENT)
+        self.assertEqual(forward(self.options, dict(self.alert, value='62')), SUPPRESSED)
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(self.counters(), {'suppressed': 2})
+
+    def test_suppress_expires(self):
+
+        state = State()
+        state.remember('key', 'fingerprint', ttl=60, now=1000)
+        self.assertTrue(state.is_repeat('key', 'fingerprint', now=1059))
+        self.assertFalse(state.is_repeat('key', 'fingerprint', now=1061))
+        self.assertFalse(state.is_repeat('key', 'other', now=1001))
+
+        # expired entries are evicted
+        state.remember('key2', 'fingerprint', ttl=60, now=1100)
+        self.assertEqual(state.conn.execute('SELECT key FROM suppress').fetchall(), [('key2',)])
+        state.close()
+
+    @requests_mock.mock()
+    def test_dedupe_event_id(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.options['dedupe_ttl'] = '3600'
+
+        problem = dict(self.alert, attributes={'eventId': '1234'})
+        recovery = dict(problem, severity='normal')
+        self.assertEqual(forward(self.options, problem), SENT)
+        self.assertEqual(forward(self.options, problem), DUPLICATE)
+        self.assertEqual(forward(self.options, recovery), SENT)
+        self.assertEqual(forward(self.options, recovery), DUPLICATE)
+
+        # unexpanded macros are not event ids
+        unknown = dict(self.alert, attributes={'eventId': '{EVENT.ID}'})
+        self.assertEqual(forward(self.options, unknown), SENT)
+        self.assertEqual(forward(self.options, unknown), SENT)
+
+        self.assertEqual(m.call_count, 4)
+        self.assertEqual(self.counters(), {'duplicates': 2})
+
+    @requests_mock.mock()
+    def test_dedupe_failed_send(self, m):
+
+        m.post('http://localhost:8080/alert', status_code=500, text='{"status":"error","message":"down"}')
+        self.options['dedupe_ttl'] = '3600'
+
+        problem = dict(self.alert, attributes={'eventId': '1234'})
+        with self.assertRaises(Exception):
+            forward(self.options, problem)
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.assertEqual(forward(self.options, problem), SENT)
+
+    def test_delivered_bounded(self):
+
+        state = State()
+        for i in range(10):
+            state.mark_delivered('key%d' % i, max_age=60, max_size=5, now=1000 + i)
+        self.assertEqual(state.conn.execute('SELECT count(*) FROM delivered').fetchone()[0], 5)
+        self.assertTrue(state.is_delivered('key9', max_age=60, now=1010))
+        self.assertFalse(state.is_delivered('key0', max_age=60, now=1010))
+        self.assertFalse(state.is_delivered('key9', max_age=60, now=1070))
+        state.close()
+
+    @requests_mock.mock()
+    def test_retries(self, m):
+
+        m.post(
+            'http://localhost:8080/alert',
+            [{'exc': requests.exceptions.ConnectionError}, {'exc': requests.exceptions.ConnectionError}, {'text': '{"status":"ok"}'}],
+        )
+        self.options.update(retries='2', retry_backoff='0.1')
+
+        with mock.patch('zabbix_alerta.time.sleep') as sleep:
+            self.assertEqual(forward(self.options, self.alert), SENT)
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertLessEqual(sleep.call_args_list[1][0][0], 0.2)
+
+    @requests_mock.mock()
+    def test_client_error_not_retried(self, m):
+
+        # a bad API key or endpoint fails at once
+        self.options.update(retries='2', retry_backoff='0.1', breaker_threshold='1')
+        for status in (401, 404):
+            m.post('http://localhost:8080/alert', status_code=status, json={'status': 'error', 'message': 'denied'})
+            with self.assertRaises(UnknownError):
+                forward(self.options, self.alert)
+        self.assertEqual(m.call_count, 2)
+
+    @requests_mock.mock()
+    def test_circuit_breaker(self, m):
+
+        m.post('http://localhost:8080/alert', exc=requests.exceptions.ConnectionError)
+        self.options.update(breaker_threshold='2', breaker_timeout='30')
+
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                forward(self.options, self.alert)
+        with self.assertRaises(CircuitOpen):
+            forward(self.options, self.alert)
+        self.assertEqual(m.call_count, 2)
+
+        # one half-open probe after the timeout, which fails and re-opens
+        with mock.patch('zabbix_state.time.time', return_value=time.time() + 31):
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                forward(self.options, self.alert)
+            with self.assertRaises(CircuitOpen):
+                forward(self.options, self.alert)
+        self.assertEqual(m.call_count, 3)
+
+        # a probe that fails other than by a request error does not leave it half-open
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        with mock.patch('zabbix_state.time.time', return_value=time.time() + 62):
+            with mock.patch('zabbix_alerta.send_with_retries', side_effect=ValueError):
+                with self.assertRaises(ValueError):
+                    forward(self.options, self.alert)
+            self.assertEqual(forward(self.options, self.alert), SENT)
+        self.assertEqual(forward(self.options, self.alert), SENT)
+        self.assertEqual(self.counters(), {'circuit_open': 2})
+
+    @requests_mock.mock()
+    def test_fallback_spool(self, m):
+
+        m.post('http://localhost:8080/alert', exc=requests.exceptions.ConnectionError)
+        self.options['fallback_spool'] = os.path.join(self.tmpdir.name, 'spool')
+
+        self.assertEqual(forward(self.options, self.alert), SPOOLED)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            forward(self.options, self.alert, fallback=False)
+
+        spool = Spool(self.options['fallback_spool'])
+        records = [record for _, _, record in spool.read()]
+        spool.close()
+        self.assertEqual(records, [{'sendto': 'http://localhost:8080', 'alert': self.alert}])
+
+    @requests_mock.mock()
+    def test_storm_aggregation(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.options.update(storm_threshold='3', storm_window='60', storm_interval='10')
+
+        now = time.time()
+        results = []
+        with mock.patch('zabbix_state.time.time') as clock:
+            for i in range(10):
+                clock.return_value = now + i
+                alert = dict(self.alert, resource='host%d' % i, service=['Switches'])
+                results.append(forward(self.options, alert))
+
+            # first two forwarded, the rest folded into a summary sent every 10s
+            self.assertEqual(results, [SENT, SENT] + [AGGREGATED] * 8)
+            summaries = [r.json() for r in m.request_history if r.json()['event'] == 'AlertStorm']
+            self.assertEqual(len(summaries), 1)
+            self.assertEqual(summaries[0]['resource'], 'Switches')
+            self.assertEqual(summaries[0]['severity'], 'major')
+            self.assertEqual(summaries[0]['attributes']['count'], 3)
+            self.assertEqual(summaries[0]['attributes']['resources'], 'host2, host1, host0')
+
+            # recoveries are always forwarded
+            clock.return_value = now + 11
+            self.assertEqual(forward(self.options, dict(self.alert, severity='normal', service=['Switches'])), SENT)
+
+            clock.return_value = now + 12
+            self.assertEqual(forward(self.options, dict(self.alert, resource='host3', severity='normal', service=['Switches'])), SENT)
+
+            # storm ends once the rate drops, the folded alerts still open are
+            # forwarded and the summary is cleared
+            clock.return_value = now + 200
+            self.assertEqual(forward(self.options, dict(self.alert, service=['Switches'])), SENT)
+            replayed = [r.json()['resource'] for r in m.request_history[-9:-2]]
+            self.assertEqual(sorted(replayed), ['host%d' % i for i in (2, 4, 5, 6, 7, 8, 9)])
+            clear = m.request_history[-2].json()
+            self.assertEqual((clear['event'], clear['severity']), ('AlertStorm', 'normal'))
+            self.assertEqual(clear['attributes']['aggregated'], 8)
+
+        self.assertEqual(self.counters(), {'aggregated': 8})
+
+    @requests_mock.mock()
+    def test_storm_expires(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.options.update(storm_threshold='3', storm_window='60', storm_interval='10')
+
+        now = time.time()
+        with mock.patch('zabbix_state.time.time') as clock:
+            for i in range(5):
+                clock.return_value = now + i
+                forward(self.options, dict(self.alert, resource='host%d' % i, service=['Switches']))
+            self.assertEqual(m.request_history[-1].json()['event'], 'AlertStorm')
+
+            # the group goes quiet, any later alert clears its summary
+            clock.return_value = now + 100
+            self.assertEqual(forward(self.options, dict(self.alert, service=['Routers'])), SENT)
+            self.assertEqual([r.json()['resource'] for r in m.request_history[3:6]], ['host2', 'host3', 'host4'])
+            clear = m.request_history[-2].json()
+            self.assertEqual((clear['resource'], clear['severity']), ('Switches', 'normal'))
+            self.assertEqual(clear['service'], ['Switches'])
+            self.assertEqual(m.last_request.json()['service'], ['Routers'])
+
+            clock.return_value = now + 200
+            forward(self.options, dict(self.alert, service=['Routers']))
+            self.assertEqual(m.call_count, 9)
+
+    def test_storm_claims(self):
+
+        # two processes see the same storm, only one sends its summary or ends it
+        first, second = State(), State()
+        alert = dict(self.alert, service=['Switches'])
+        self.assertTrue(first.storm_check('Switches', alert, 1, 60, 10, now=1000)['due'])
+        self.assertFalse(second.storm_check('Switches', alert, 1, 60, 10, now=1000)['due'])
+        self.assertTrue(second.storm_check('Switches', alert, 1, 60, 10, now=1010)['due'])
+
+        context = {'threshold': 1, 'window': 60}
+        first.storm_check('Routers', alert, 1, 60, 10, now=1000, context=context)
+        self.assertEqual([group for group, _, _ in first.ended_storms(now=1100)], ['Routers'])
+        self.assertEqual(second.ended_storms(now=1100), [])
+        self.assertEqual([group for group, _, _ in second.ended_storms(now=1200)], ['Routers'])
+        first.close()
+        second.close()
+
+    def test_token_bucket(self):
+
+        state = State()
+        # 4 tokens: warnings keep half in reserve, majors use all but critical is never limited
+        self.assertTrue(state.take_token('p', 1, 4, 'warning', now=1000))
+        self.assertTrue(state.take_token('p', 1, 4, 'warning', now=1000))
+        self.assertFalse(state.take_token('p', 1, 4, 'warning', now=1000))
+        self.assertTrue(state.take_token('p', 1, 4, 'major', now=1000))
+        self.assertTrue(state.take_token('p', 1, 4, 'major', now=1000))
+        self.assertFalse(state.take_token('p', 1, 4, 'major', now=1000))
+        self.assertTrue(state.take_token('p', 1, 4, 'critical', now=1000))
+        self.assertTrue(state.take_token('p', 1, 4, 'normal', now=1000))
+
+        # refills at the configured rate
+        self.assertTrue(state.take_token('p', 1, 4, 'major', now=1001))
+        self.assertFalse(state.take_token('p', 1, 4, 'warning', now=1001))
+        self.assertTrue(state.take_token('p', 1, 4, 'warning', now=1010))
+        state.close()
+
+    def test_token_bucket_idle(self):
+
+        # the default burst is the rate, an idle bucket lets every severity through
+        state = State()
+        for rate in (1, 2, 0.5):
+            burst = max(rate, 1.0)
+            for severity in ('major', 'minor', 'warning', 'informational', 'Average', 'Information'):
+                name = '%s-%s' % (rate, severity)
+                self.assertTrue(state.take_token(name, rate, burst, severity, now=1000), name)
+                self.assertTrue(state.take_token(name, rate, burst, severity, now=1000 + 1 / rate), name)
+        state.close()
+
+    @requests_mock.mock()
+    def test_rate_limit(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok"}')
+        self.options.update(rate_limit='0.001', rate_burst='2')
+
+        self.assertEqual(forward(self.options, self.alert), SENT)
+        self.assertEqual(forward(self.options, self.alert), SENT)
+        self.assertEqual(forward(self.options, self.alert), SHED)
+        self.assertEqual(forward(self.options, dict(self.alert, severity='critical')), SENT)
+        with self.assertRaises(Throttled):
+            forward(self.options, self.alert, fallback=False)
+
+        self.options['fallback_spool'] = os.path.join(self.tmpdir.name, 'spool')
+        self.assertEqual(forward(self.options, self.alert), DEFERRED)
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(self.counters(), {'shed': 1, 'deferred': 1})
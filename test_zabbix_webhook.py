@@ -0,0 +1,97 @@
+import asyncio
+import http.client
+import json
+import tempfile
+import threading
+import unittest
+
+import requests_mock
+
+from test_zabbix_alerta import use_cache_dir
+from zabbix_webhook import WebhookReceiver
+
+
+class WebhookTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        use_cache_dir(self, self.tmpdir.name)
+        self.loop = asyncio.new_event_loop()
+        self.receiver = WebhookReceiver(workers=2)
+        self.server = self.loop.run_until_complete(self.receiver.start('127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        self.receiver.executor.shutdown()
+        self.tmpdir.cleanup()
+
+    def post(self, conn, payload):
+        conn.request('POST', '/webhook', body=json.dumps(payload), headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+
+    @requests_mock.mock()
+    def test_webhook(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok","id":"abc"}')
+
+        payload = {
+            'url': 'http://127.0.0.1/webhook',
+            'sendto': 'http://localhost:8080',
+            'subject': 'OK: Temperature is above threshold',
+            'resource': 'hostname1',
+            'event': 'temp',
+            'severity': 'High!!',
+            'status': 'OK',
+            'ack': 'Yes',
+            'service': 'group1,group2',
+            'value': 'line1\nline2',
+            'attributes.eventId': '2',
+        }
+        conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        status, response = self.post(conn, payload)
+        self.assertEqual((status, response), (200, {'status': 'ok', 'result': 'sent'}))
+
+        # connection is kept alive
+        status, _ = self.post(conn, payload)
+        self.assertEqual(status, 200)
+        conn.close()
+
+        alert = m.last_request.json()
+        self.assertEqual(alert['severity'], 'ok')
+        self.assertEqual(alert['service'], ['group1', 'group2'])
+        self.assertEqual(alert['value'], 'line1\nline2')
+        self.assertEqual(alert['attributes'], {'eventId': '2'})
+        self.assertNotIn('status', alert)
+
+    @requests_mock.mock()
+    def test_field_types(self, m):
+
+        m.post('http://localhost:8080/alert', text='{"status":"ok","id":"abc"}')
+
+        # numbers are taken as text, other types are rejected
+        payload = {'sendto': 'http://localhost:8080', 'resource': 'hostname1', 'event': 'temp', 'value': 61.5}
+        conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        self.assertEqual(self.post(conn, dict(payload, tags=['a', 'b']))[0], 200)
+        self.assertEqual(m.last_request.json()['value'], '61.5')
+        self.assertEqual(m.last_request.json()['tags'], ['a', 'b'])
+        for invalid in ({'value': None}, {'value': ['x']}, {'tags': [1]}, {'sendto': 1}):
+            status, response = self.post(conn, dict(payload, **invalid))
+            self.assertEqual(status, 400, invalid)
+            self.assertEqual(response['status'], 'error')
+        conn.close()
+        self.assertEqual(m.call_count, 1)
+
+    def test_invalid_request(self):
+
+        conn = http.client.HTTPConnection('127.0.0.1', self.port)
+        conn.request('POST', '/webhook', body='not json')
+        self.assertEqual(conn.getresponse().status, 400)
+        conn.close()
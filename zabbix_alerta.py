@@ -3,11 +3,20 @@
     zabbix-alerta: Forward Zabbix events to Alerta
 """
 
-import configparser
+import importlib
+import json
 import os
-
-import click
-from alertaclient.api import Client
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 __version__ = '4.0.0'
 
@@ -19,6 +28,32 @@ default_config = {
     'timeout': 5.0,
     'sslverify': True,
     'debug': False,
+    'spool_dir': '',
+    'suppress_ttl': 0,
+    'dedupe_ttl': 0,
+    'dedupe_size': 100000,
+    'retries': 0,
+    'retry_backoff': 0.5,
+    'breaker_threshold': 0,
+    'breaker_timeout': 30.0,
+    'fallback_spool': '',
+    'storm_threshold': 0,
+    'storm_window': 60.0,
+    'storm_interval': 10.0,
+    'storm_key': 'service',
+    'rate_limit': 0,
+    'rate_burst': 0,
+    'metrics_textfile': '',
+    'metrics_statsd': '',
+    'raw_data': 'omit',
+    'raw_data_size': 1024,
+    'max_field_size': 0,
+    'field_limits': '',
+    'gzip': False,
+    'inventory': '',
+    'rules': '',
+    'fanout': '',
+    'fanout_success': 'all',
 }
 
 ZBX_SEVERITY_MAP = {
@@ -31,21 +66,376 @@ ZBX_SEVERITY_MAP = {
 }
 
 
-def parse_zabbix(subject, message):
+# environment variables that change how sendto is resolved
+OPTIONS_ENV = ('ALERTA_DEFAULT_PROFILE', 'ALERTA_ENDPOINT', 'ALERTA_API_KEY')
+
+
+def cache_dir():
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.environ.get('ZABBIX_ALERTA_CACHE_DIR') or os.path.join(cache_home, 'zabbix-alerta')
+
+
+def get_options(sendto):
+    """
+    Resolve options for sendto, using a snapshot of previously resolved
+    options that is discarded when the config file or environment changes.
+    """
+    config_file = os.path.abspath(
+        os.path.expanduser(os.environ.get('ALERTA_CONF_FILE') or default_config['config_file'])
+    )
+    try:
+        st = os.stat(config_file)
+        stamp = [config_file, st.st_mtime_ns, st.st_size]
+    except OSError:
+        stamp = [config_file, None, None]
+    stamp += [os.environ.get(name) for name in OPTIONS_ENV]
+    stamp += [__version__, list(default_config)]  # new options need a new snapshot
+
+    cache_file = os.path.join(cache_dir(), 'profiles.json')
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    if cache.get('stamp') != stamp:
+        cache = {'stamp': stamp, 'profiles': {}}
+    elif sendto in cache['profiles']:
+        return cache['profiles'][sendto]
+
+    options = read_options(sendto, config_file)
+
+    cache['profiles'][sendto] = options
+    try:
+        os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+        tmp_file = '{}.{}'.format(cache_file, os.getpid())
+        with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
+    return options
+
+
+def read_options(sendto, config_file):
+
+    import configparser
+
+    options = default_config.copy()
+    parser = configparser.RawConfigParser(defaults=options)
+
+    options['config_file'] = config_file
+    parser.read(config_file)
+
+    # sendto=target,target,... where each target is a profile or apiUrl[;key]
+    if ',' in sendto:
+        options = read_options('', config_file)
+        options['fanout'] = sendto
+        return options
+
+    # sendto=apiUrl[;key]
+    if sendto.startswith('http://') or sendto.startswith('https://'):
+        want_profile = None
+        try:
+            options['endpoint'], options['key'] = sendto.split(';', 1)
+        except ValueError:
+            options['endpoint'] = sendto
+    # sendto=profile
+    else:
+        want_profile = sendto or os.environ.get('ALERTA_DEFAULT_PROFILE') or parser.defaults().get('profile')
+
+        if want_profile and parser.has_section('profile %s' % want_profile):
+            for opt in options:
+                try:
+                    options[opt] = parser.getboolean('profile %s' % want_profile, opt)
+                except (ValueError, AttributeError):
+                    options[opt] = parser.get('profile %s' % want_profile, opt)
+        else:
+            for opt in options:
+                try:
+                    options[opt] = parser.getboolean('DEFAULT', opt)
+                except (ValueError, AttributeError):
+                    options[opt] = parser.get('DEFAULT', opt)
+
+    options['profile'] = want_profile
+    options['endpoint'] = os.environ.get('ALERTA_ENDPOINT', options['endpoint'])
+    options['key'] = os.environ.get('ALERTA_API_KEY', options['key'])
+
+    return options
+
 
+CLIENT_TIMEOUT = 2.0
+# the daemon replies once the alert is delivered, within the alert script timeout
+REPLY_TIMEOUT = 25.0
+
+
+def socket_path():
+    """
+    The forwarder socket, by default in a directory only the user running
+    Zabbix can write to.
+    """
+    if os.environ.get('ZABBIX_ALERTA_SOCKET'):
+        return os.environ['ZABBIX_ALERTA_SOCKET']
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'zabbix-alerta', 'forwarder.sock')
+    return os.path.join(cache_dir(), 'forwarder.sock')
+
+
+def options_env():
+    """
+    The config file and environment that sendto is resolved with, which the
+    forwarder daemon must share with the script to send an alert the same way.
+    """
+    env = {name: os.environ.get(name) for name in OPTIONS_ENV}
+    env['ALERTA_CONF_FILE'] = os.path.abspath(
+        os.path.expanduser(os.environ.get('ALERTA_CONF_FILE') or default_config['config_file'])
+    )
+    return env
+
+
+def submit(sendto, summary, body, path=None):
+    """
+    Hand the alert to a running forwarder daemon. Returns False if the daemon
+    is not running, is busy, resolves sendto differently or could not deliver
+    the alert, so it can be sent directly.
+    """
+    request = {'sendto': sendto, 'summary': summary, 'body': body, 'env': options_env()}
+    request = json.dumps(request).encode('utf-8') + b'\n'
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CLIENT_TIMEOUT)
+    try:
+        sock.connect(path or socket_path())
+        sock.sendall(request)
+        sock.settimeout(REPLY_TIMEOUT)
+        reply = sock.makefile('rb').readline()
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+    return reply.strip() == b'OK'
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# smaller request bodies are not worth compressing
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 1
+
+# a 400 reply about the body encoding, not an invalid alert, eg. "Failed to
+# decode JSON object: 'utf-8' codec can't decode byte 0x8b"
+ENCODING_ERROR_RE = re.compile(r'decod|encod|gzip|compress', re.IGNORECASE)
+
+
+def http_adapter(pool_size=None, compress=False):
+    """
+    Returns a transport adapter that gzips request bodies if compress is
+    True. If the endpoint rejects a compressed body that it accepts without
+    compression, compression is turned off for the endpoint.
+    """
+    import gzip
+
+    from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+
+    class Adapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+
+            body = request.body
+            data = body.encode('utf-8') if isinstance(body, str) else body
+            if not self.compress or not data or len(data) < GZIP_MIN_SIZE or 'Content-Encoding' in request.headers:
+                return super().send(request, **kwargs)
+
+            request.body = gzip.compress(data, GZIP_LEVEL)
+            request.headers['Content-Encoding'] = 'gzip'
+            request.headers['Content-Length'] = str(len(request.body))
+            response = super().send(request, **kwargs)
+            if response.status_code != 415 and not (
+                response.status_code == 400 and ENCODING_ERROR_RE.search(response.text)
+            ):
+                return response
+
+            request.body = data
+            del request.headers['Content-Encoding']
+            request.headers['Content-Length'] = str(len(data))
+            retry = super().send(request, **kwargs)
+            if retry.status_code != response.status_code:
+                self.compress = False
+            return retry
+
+    adapter = Adapter(pool_connections=1, pool_maxsize=pool_size or DEFAULT_POOLSIZE)
+    adapter.compress = compress
+    return adapter
+
+
+# replies worth retrying besides 5xx. Other 4xx fail at once: Alerta rejects
+# invalid alerts with 400 and alerts refused by a plugin with 403, and 401 or
+# 404 mean a bad API key or endpoint that retrying will not fix
+RETRY_STATUS = (408, 429)
+
+
+def raise_for_retry_status(response, **kwargs):
+    """
+    Raise HTTPError for server errors, which alertaclient would otherwise
+    raise as UnknownError just like an alert that Alerta rejected.
+    """
+    if response.status_code >= 500 or response.status_code in RETRY_STATUS:
+        response.raise_for_status()
+
+
+def get_client(options, pool_size=None):
+    """
+    Return an API client for the endpoint, re-using a cached client (and its
+    keep-alive connection pool) for the lifetime of the process.
+    """
+    cache_key = (options['endpoint'], options['key'], float(options['timeout']), options['sslverify'], options['gzip'])
+
+    with _clients_lock:
+        if cache_key not in _clients:
+            from alertaclient.api import Client
+
+            api = Client(
+                endpoint=options['endpoint'],
+                key=options['key'],
+                timeout=float(options['timeout']),
+                ssl_verify=options['sslverify'],
+            )
+            api.http.session.hooks['response'].append(raise_for_retry_status)
+            if pool_size or options['gzip']:
+                adapter = http_adapter(pool_size, compress=options['gzip'])
+                api.http.session.mount('http://', adapter)
+                api.http.session.mount('https://', adapter)
+            _clients[cache_key] = api
+        return _clients[cache_key]
+
+
+def parse_zabbix(subject, message, debug=False, limits=None, raw_data='full', raw_data_size=0):
+    """
+    Build an alert from a Zabbix alert message. rawData is only built as far
+    as the profile's raw_data policy keeps it, see slim_alert().
+    """
+    limits = limits or {}
+    if message.lstrip().startswith('{'):
+        macros = ((macro, limit_value(limits, macro, value)) for macro, value in parse_json(message).items())
+    else:
+        macros = parse_message(message, limits)
+
+    if raw_data == 'omit':
+        raw = None
+    elif raw_data == 'truncate':
+        # raw_data_size characters of each are at least as many bytes
+        raw = truncate('{}\n\n{}'.format(subject[:raw_data_size], message[:raw_data_size]), raw_data_size)
+    else:
+        raw = '{}\n\n{}'.format(subject, message)
+    return make_alert(macros, raw_data=raw, debug=debug)
+
+
+def parse_options(options):
+    """
+    Keyword arguments of parse_zabbix() for the profile.
+    """
+    return dict(
+        debug=options['debug'],
+        limits=size_limits(options),
+        raw_data=options['raw_data'],
+        raw_data_size=int(options['raw_data_size']),
+    )
+
+
+# a line of the alert message that starts a new macro, scanning for the
+# newline first is much faster than a multi-line "^" on long values. Only
+# known macros start a new line, so "key=value" text inside a multi-line
+# value stays part of it.
+MACROS = (
+    'resource', 'event', 'environment', 'severity', 'correlate', 'status', 'ack', 'service', 'group',
+    'value', 'text', 'tags', 'origin', 'type', 'dateTime', 'timeout', 'customer',
+)
+MACRO_NAME = r'(%s|attributes\.[\w.]+)=' % '|'.join(MACROS)
+MACRO_LINE_RE = re.compile(r'\n[ \t]*' + MACRO_NAME)
+MACRO_RE = re.compile(r'[ \t]*' + MACRO_NAME)
+
+
+def parse_message(message, limits=None):
+    """
+    Walk the message once yielding (macro, value) for every "macro=value"
+    line of a known macro, see MACROS. Other lines continue the previous value,
+    eg. a multi-line log item value. Values over their size limit are cut
+    before they are copied.
+    """
+    limits = limits or {}
+    macro = start = None
+    first = MACRO_RE.match(message)
+    if first:
+        macro, start = first.group(1), first.end()
+    for match in MACRO_LINE_RE.finditer(message):
+        if macro:
+            yield macro, message_value(message, start, match.start(), field_limit(limits, macro))
+        macro, start = match.group(1), match.end()
+    if macro:
+        yield macro, message_value(message, start, len(message), field_limit(limits, macro))
+
+
+def message_value(message, start, end, limit):
+
+    if limit and end - start > limit:
+        # one character more than fits so truncate() marks the cut
+        return truncate(message[start:start + limit + 1].replace('\r\n', '\n'), limit)
+    return message[start:end].replace('\r\n', '\n').rstrip()
+
+
+# one field per line as written by the zac JSON message template
+JSON_FIELD_RE = re.compile(r'^\s*"([A-Za-z][\w.]*)"\s*:\s*', re.MULTILINE)
+JSON_BACKSLASH_RE = re.compile(r'\\(?!")')
+
+
+def parse_json(message):
+    """
+    Decode a JSON alert message. Zabbix does not escape macro values so if
+    a value breaks the JSON fall back to splitting the message on the field
+    names at the start of each line.
+    """
+    # a backslash comes from a macro value, eg. C:\new\temp, and is literal,
+    # except before a quote as in the escaped href of the zac template
+    escaped = JSON_BACKSLASH_RE.sub(r'\\\\', message)
+    if orjson:
+        try:
+            return orjson.loads(escaped)
+        except orjson.JSONDecodeError:
+            pass  # eg. unescaped newlines, which the stdlib decoder accepts
+    try:
+        return json.loads(escaped, strict=False)
+    except ValueError:
+        pass
+
+    fields = {}
+    matches = list(JSON_FIELD_RE.finditer(message))
+    for match, following in zip(matches, matches[1:] + [None]):
+        end = following.start() if following else message.rfind('}')
+        value = message[match.end():end if end > match.end() else None].rstrip()
+        if value.endswith(','):
+            value = value[:-1]
+        if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        fields[match.group(1)] = value
+    return fields
+
+
+def make_alert(macros, raw_data, debug=False):
+    """
+    Build an alert from (macro, value) pairs, eg. lines of the alert message
+    or the fields of a webhook request.
+    """
     alert = {}
     attributes = {}
     zabbix_severity = False
-    for line in message.split('\n'):
-        if '=' not in line:
-            continue
-        try:
-            macro, value = line.rstrip().split('=', 1)
-        except ValueError as e:
-            click.secho('{}: {}'.format(e, line))
+    for macro, value in macros:
+        if macro == 'attributes' and isinstance(value, dict):
+            attributes.update(value)
             continue
-
-        if macro == 'service':
+        elif macro == 'service' and isinstance(value, str):
             value = value.split(',')
         elif macro == 'severity':
             if value.endswith('!!'):
@@ -55,13 +445,14 @@ def parse_zabbix(subject, message):
                 value = ZBX_SEVERITY_MAP.get(value, 'indeterminate')
         elif macro == 'timeout':
             value = int(value)
-        elif macro == 'tags':
+        elif macro == 'tags' and isinstance(value, str):
             value = value.split(',')
         elif macro.startswith('attributes.'):
             attributes[macro.replace('attributes.', '')] = value
 
         alert[macro] = value
-        click.echo('{} -> {}'.format(macro, value))
+        if debug:
+            print('{} -> {}'.format(macro, value))
 
     # if {$ENVIRONMENT} user macro isn't defined anywhere set default
     if alert.get('environment', '') == '{$ENVIRONMENT}':
@@ -80,134 +471,526 @@ def parse_zabbix(subject, message):
 
     alert['attributes'] = attributes
     alert['origin'] = 'zabbix/%s' % os.uname()[1]
-    alert['rawData'] = '{}\n\n{}'.format(subject, message)
+    alert['rawData'] = raw_data
 
     return alert
 
 
-CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+def route(options, alert):
+    """
+    Apply the profile's rules file, see zabbix_rules. Returns the options
+    of the profile the alert is routed to and the alert, or None for the
+    alert if a rule drops it.
+    """
+    if not options['rules']:
+        return options, alert
 
+    from zabbix_rules import load_rules
 
-@click.command('zabbix-alerta', context_settings=CONTEXT_SETTINGS)
-@click.argument('sendto')
-@click.argument('summary')
-@click.argument('body')
-def cli(sendto, summary, body):
+    rule = load_rules(os.path.expanduser(options['rules'])).match(alert)
+    if not rule:
+        return options, alert
+    if rule['drop']:
+        return options, None
+    if rule['set_environment']:
+        alert = dict(alert, environment=rule['set_environment'])
+    if rule['sendto']:
+        options = get_options(rule['sendto'])
+    return options, alert
+
+
+def enrich(options, alert):
     """
-        Zabbix-to-Alerta integration script
+    Add the host's attributes from the profile's inventory index, see
+    `zac inventory`. Attributes set by the alert message are kept.
+    """
+    if not options['inventory'] or not alert.get('resource'):
+        return alert
 
-    INSTALL
+    from zabbix_inventory import lookup
 
-       $ ln -s `which zabbix-alerta` <AlertScriptsPath>
+    try:
+        inventory = lookup(os.path.expanduser(options['inventory']), alert['resource'])
+    except (OSError, ValueError):
+        return alert  # never hold up an alert for enrichment
+    if not inventory:
+        return alert
+    return dict(alert, attributes=dict(inventory, **(alert.get('attributes') or {})))
 
-    ALERT FORMAT
 
-    OPERATIONS
+def size_limits(options):
+    """
+    Field size limits in bytes from the profile's field_limits, eg.
+    "value:65536,text:1024", with max_field_size as the default "*".
+    """
+    limits = {'*': int(options['max_field_size'] or 0)}
+    for item in (options['field_limits'] or '').split(','):
+        if item.strip():
+            name, size = item.rsplit(':', 1)
+            limits[name.strip()] = int(size)
+    return limits
 
-    Default subject:
 
-    {TRIGGER.STATUS}: {TRIGGER.NAME}
+def field_limit(limits, name):
+    return limits.get(name, limits.get('*', 0))
 
-    Default message:
 
-    \b
-    resource={HOST.NAME1}
-    event={ITEM.KEY1}
-    environment=Production
-    severity={TRIGGER.SEVERITY}!!
-    status={TRIGGER.STATUS}
-    ack={EVENT.ACK.STATUS}
-    service={TRIGGER.HOSTGROUP.NAME}
-    group=Zabbix
-    value={ITEM.VALUE1}
-    text={TRIGGER.STATUS}: {TRIGGER.NAME}
-    tags={EVENT.TAGS}
-    attributes.eventId={EVENT.ID}
-    attributes.triggerId={TRIGGER.ID}
-    attributes.ip={HOST.IP1}
-    attributes.thresholdInfo={TRIGGER.TEMPLATE.NAME}: {TRIGGER.EXPRESSION}
-    attributes.moreInfo=<a href="http://x.x.x.x/tr_events.php?triggerid={TRIGGER.ID}&eventid={EVENT.ID}">Zabbix console</a>
-    type=zabbixAlert
-    dateTime={EVENT.DATE}T{EVENT.TIME}Z
+def limit_value(limits, name, value):
 
-    RECOVERY
+    limit = field_limit(limits, name) if isinstance(value, str) else 0
+    return truncate(value, limit) if limit else value
 
-    Default subject:
 
-    {TRIGGER.STATUS}: {TRIGGER.NAME}
+def truncate(value, size):
+    """
+    Cut a string to at most size bytes of UTF-8, marking where it was cut.
+    """
+    data = value.encode('utf-8')
+    if len(data) <= size:
+        return value
+    return data[:max(size - 3, 0)].decode('utf-8', 'ignore') + '...'
 
-    Default message:
 
-    \b
-    resource={HOST.NAME1}
-    event={ITEM.KEY1}
-    environment=Production
-    severity={TRIGGER.SEVERITY}!!
-    status={TRIGGER.STATUS}
-    ack={EVENT.ACK.STATUS}
-    service={TRIGGER.HOSTGROUP.NAME}
-    group=Zabbix
-    value={ITEM.VALUE1}
-    text={TRIGGER.STATUS}: {ITEM.NAME1}
-    tags={EVENT.RECOVERY.TAGS}
-    attributes.ip={HOST.IP1}
-    attributes.thresholdInfo={TRIGGER.TEMPLATE.NAME}: {TRIGGER.EXPRESSION}
-    attributes.moreInfo=<a href="http://x.x.x.x/tr_events.php?triggerid={TRIGGER.ID}&eventid={EVENT.RECOVERY.ID}">Zabbix console</a>
-    type=zabbixAlert
-    dateTime={EVENT.RECOVERY.DATE}T{EVENT.RECOVERY.TIME}Z
+def slim_alert(options, alert):
+    """
+    Apply the profile's raw_data policy and field size limits. Returns a
+    copy of the alert if it was changed.
     """
+    policy = options['raw_data']
+    limits = size_limits(options)
+    if policy == 'full' and not any(limits.values()):
+        return alert
+
+    alert = dict(alert)
+    raw_data = alert.get('rawData')
+    if policy == 'omit':
+        alert.pop('rawData', None)
+    elif policy == 'truncate' and raw_data:
+        alert['rawData'] = truncate(raw_data, int(options['raw_data_size']))
+    elif policy == 'hash' and raw_data:
+        import hashlib
+
+        alert['rawData'] = 'sha256:' + hashlib.sha256(raw_data.encode('utf-8')).hexdigest()
+    elif policy not in ('full', 'truncate', 'hash'):
+        raise ValueError('invalid raw_data policy {!r}, use full, omit, truncate or hash'.format(policy))
+
+    if any(limits.values()):
+        for field, value in alert.items():
+            if field != 'rawData':
+                alert[field] = limit_value(limits, field, value)
+        if alert.get('attributes'):
+            alert['attributes'] = {
+                k: limit_value(limits, 'attributes.' + k, v) for k, v in alert['attributes'].items()
+            }
+    return alert
 
-    # FIXME - use {ITEM.APPLICATION} for alert "group" when ZBXNEXT-2684 is resolved (see https://support.zabbix.com/browse/ZBXNEXT-2684)
 
-    click.echo('[alerta] Sending message "{}" to {}...'.format(summary, sendto))
+class Profiles:
+    """
+    Resolved options for each sendto, reloaded when the config file changes.
+    """
 
-    options = default_config
-    parser = configparser.RawConfigParser(defaults=options)
+    def __init__(self):
+        self._options = {}
+        self._config_mtime = None
+        self._lock = threading.Lock()
 
-    options['config_file'] = os.environ.get('ALERTA_CONF_FILE') or options['config_file']
-    parser.read(os.path.expanduser(options['config_file']))
+    def get(self, sendto):
 
-    # sendto=apiUrl[;key]
-    if sendto.startswith('http://') or sendto.startswith('https://'):
-        want_profile = None
+        config_file = os.path.expanduser(os.environ.get('ALERTA_CONF_FILE') or default_config['config_file'])
         try:
-            options['endpoint'], options['key'] = sendto.split(';', 1)
-        except ValueError:
-            options['endpoint'] = sendto
-    # sendto=profile
+            mtime = os.stat(config_file).st_mtime
+        except OSError:
+            mtime = None
+
+        with self._lock:
+            if mtime != self._config_mtime:
+                self._options.clear()
+                self._config_mtime = mtime
+            if sendto not in self._options:
+                self._options[sendto] = get_options(sendto)
+            return self._options[sendto]
+
+
+SENT = 'sent'
+SPOOLED = 'spooled'
+SUPPRESSED = 'suppressed'
+DUPLICATE = 'duplicate'
+AGGREGATED = 'aggregated'
+SHED = 'shed'
+DEFERRED = 'deferred'
+DROPPED = 'dropped'
+PARTIAL = 'partial'
+ERROR = 'error'
+
+# options that need the shared state database
+STATE_OPTIONS = ('suppress_ttl', 'dedupe_ttl', 'breaker_threshold', 'storm_threshold', 'rate_limit')
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class Throttled(Exception):
+    pass
+
+
+class FanoutFailed(Exception):
+    pass
+
+
+# set when a long-running command serves metrics, see zabbix_metrics.serve()
+collect_metrics = False
+
+
+class Timer:
+    """
+    Time spent in each phase of forwarding an alert, for metrics.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, phase, started):
+        self.phases[phase] = self.phases.get(phase, 0.0) + time.perf_counter() - started
+
+
+def options_sendto(options):
+    if options['profile']:
+        return options['profile']
+    return '{};{}'.format(options['endpoint'], options['key']) if options['key'] else options['endpoint']
+
+
+def spool_alert(path, sendto, alert):
+
+    from zabbix_spool import Spool
+
+    spool = Spool(path)
+    try:
+        spool.append({'sendto': sendto, 'alert': alert})
+    finally:
+        spool.close()
+
+
+def send_with_retries(options, alert, pool_size=None, timer=None):
+    """
+    Send the alert, retrying connection errors, timeouts and server errors
+    with exponential backoff and full jitter.
+    """
+    from requests.exceptions import RequestException
+
+    started = time.perf_counter()
+    api = get_client(options, pool_size=pool_size)
+    if timer:
+        timer.add('client', started)
+
+    # the client takes rawData as raw_data
+    kwargs = {k: v for k, v in alert.items() if k != 'rawData'}
+    kwargs['raw_data'] = alert.get('rawData')
+
+    started = time.perf_counter()
+    retries = int(options['retries'] or 0)
+    try:
+        for attempt in range(retries + 1):
+            try:
+                return api.send_alert(**kwargs)
+            except RequestException:
+                if attempt == retries:
+                    raise
+                time.sleep(random.uniform(0, float(options['retry_backoff']) * 2 ** attempt))
+    finally:
+        if timer:
+            timer.add('send', started)
+
+
+def forward(options, alert, pool_size=None, fallback=True, timer=None):
+    """
+    Send the alert to Alerta unless the profile options say it should be
+    held back locally. Returns SENT or the reason it was not sent.
+
+    If Alerta is unavailable and the profile has a fallback_spool the alert
+    is spooled instead, unless fallback is False.
+    """
+    timer = timer or Timer()
+    status = ERROR
+    try:
+        options, routed = route(options, alert)
+        if routed is None:
+            status = DROPPED
+            return status
+        if options['fanout']:
+            return fan_out(options, routed, pool_size, fallback)
+        alert = slim_alert(options, enrich(options, routed))
+        status = _forward_or_spool(options, alert, pool_size, fallback, timer)
+        return status
+    finally:
+        # fan-out targets record their own metrics
+        metrics = collect_metrics or options['metrics_textfile'] or options['metrics_statsd']
+        if metrics and not options['fanout']:
+            from zabbix_metrics import record
+
+            record(options, alert, status, timer)
+
+
+def fan_out(options, alert, pool_size=None, fallback=True):
+    """
+    Forward the alert to every fanout target at the same time, each with
+    its own profile options. Returns SENT if all targets accepted it, or
+    PARTIAL if enough did for fanout_success: all, any or quorum (more
+    than half). Raises FanoutFailed otherwise.
+    """
+    import logging
+    from concurrent.futures import ThreadPoolExecutor
+
+    targets = [t.strip() for t in options['fanout'].split(',') if t.strip()]
+    success = options['fanout_success']
+    needed = {'all': len(targets), 'any': 1, 'quorum': len(targets) // 2 + 1}.get(success)
+    if needed is None:
+        raise ValueError('invalid fanout_success {!r}, use all, any or quorum'.format(success))
+
+    resolved = [(target, get_options(target)) for target in targets]
+    for target, target_options in resolved:
+        if target_options['fanout']:
+            raise ValueError('fanout target {} is itself a fanout'.format(target))
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = [(t, executor.submit(forward, o, alert, pool_size, fallback)) for t, o in resolved]
+        for target, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logging.getLogger('zabbix-alerta').warning('Failed to send alert to %s: %s', target, e)
+                errors.append('{}: {}'.format(target, e))
+
+    if len(targets) - len(errors) < needed:
+        raise FanoutFailed(
+            'sent to {} of {} targets, {} needed: {}'.format(
+                len(targets) - len(errors), len(targets), success, '; '.join(errors)
+            )
+        )
+    return PARTIAL if errors else SENT
+
+
+def _forward_or_spool(options, alert, pool_size, fallback, timer):
+
+    state = None
+    if any(float(options[name] or 0) for name in STATE_OPTIONS):
+        from zabbix_state import State
+
+        state = State()
+    try:
+        return _forward(options, alert, pool_size, state, timer)
+    except Throttled:
+        if not fallback:
+            raise
+        if options['fallback_spool']:
+            spool_alert(options['fallback_spool'], options_sendto(options), alert)
+            state.incr(DEFERRED)
+            return DEFERRED
+        state.incr(SHED)
+        return SHED
+    except Exception as e:
+        from requests.exceptions import RequestException
+
+        if not (isinstance(e, (CircuitOpen, RequestException)) and fallback and options['fallback_spool']):
+            raise
+        spool_alert(options['fallback_spool'], options_sendto(options), alert)
+        return SPOOLED
+    finally:
+        if state:
+            state.close()
+
+
+def _forward(options, alert, pool_size, state, timer):
+
+    if not state:
+        send_with_retries(options, alert, pool_size, timer)
+        return SENT
+
+    from zabbix_state import alert_fingerprint, alert_key, delivery_key, storm_alert, storm_group
+
+    dedupe_ttl = float(options['dedupe_ttl'] or 0)
+    seen_key = delivery_key(options, alert) if dedupe_ttl else None
+    if seen_key and state.is_delivered(seen_key, dedupe_ttl):
+        return DUPLICATE
+
+    suppress_ttl = float(options['suppress_ttl'] or 0)
+    if suppress_ttl:
+        key, fingerprint = alert_key(options, alert), alert_fingerprint(alert)
+        if state.is_repeat(key, fingerprint):
+            return SUPPRESSED
+
+    # fold alerts into one summary per group while they arrive too fast
+    storm_threshold = int(options['storm_threshold'] or 0)
+    group = storm_group(options, alert) if storm_threshold else None
+    if storm_threshold:
+        _end_storms(state, pool_size, timer)
+    if group and alert.get('severity') in ('normal', 'ok'):
+        # recoveries are always forwarded, and their folded problem is not
+        state.storm_unfold(group, alert)
+    elif group:
+        context = {
+            'sendto': options_sendto(options),
+            'threshold': storm_threshold,
+            'window': float(options['storm_window']),
+            'environment': alert.get('environment'),
+            'service': alert.get('service'),
+            'origin': alert.get('origin'),
+        }
+        storm = state.storm_check(
+            group, alert, storm_threshold, float(options['storm_window']), float(options['storm_interval']),
+            context=context,
+        )
+        if storm and storm['ended']:
+            _end_storm(options, group, storm, alert, state, pool_size, timer)
+        elif storm:
+            if storm['due']:
+                _send(options, storm_alert(group, alert, storm), pool_size, state, timer)
+            return AGGREGATED
+
+    rate_limit = float(options['rate_limit'] or 0)
+    if rate_limit:
+        burst = float(options['rate_burst'] or 0) or max(rate_limit, 1.0)
+        name = options['profile'] or options['endpoint']
+        if not state.take_token(name, rate_limit, burst, alert.get('severity')):
+            raise Throttled('rate limit for {} exceeded'.format(name))
+
+    _send(options, alert, pool_size, state, timer)
+
+    if seen_key:
+        state.mark_delivered(seen_key, dedupe_ttl, int(options['dedupe_size']))
+    if suppress_ttl:
+        state.remember(key, fingerprint, suppress_ttl)
+    return SENT
+
+
+def _end_storm(options, group, storm, alert, state, pool_size, timer):
+    """
+    Forward the folded alerts of an ended storm that are still open, then
+    clear its summary.
+    """
+    from zabbix_state import storm_alert
+
+    for folded in state.storm_folded(group):
+        _send(options, folded, pool_size, state, timer)
+        state.storm_unfold(group, folded)
+    _send(options, storm_alert(group, alert, storm), pool_size, state, timer)
+    state.storm_ended(group, storm['started'])
+
+
+def _end_storms(state, pool_size, timer):
+    """
+    End the storms of groups that went quiet, which no alert of their own
+    group may arrive to end.
+    """
+    for group, storm, context in state.ended_storms():
+        try:
+            _end_storm(get_options(context['sendto']), group, storm, context, state, pool_size, timer)
+        except Exception:
+            continue  # tried again after STORM_END_TIMEOUT
+
+
+def _send(options, alert, pool_size, state, timer):
+
+    from requests.exceptions import RequestException
+
+    breaker_threshold = int(options['breaker_threshold'] or 0)
+    if breaker_threshold:
+        breaker_timeout = float(options['breaker_timeout'])
+        if not state.breaker_allow(options['endpoint'], breaker_timeout):
+            raise CircuitOpen('circuit open for {}, not sending'.format(options['endpoint']))
+        try:
+            send_with_retries(options, alert, pool_size, timer)
+        except RequestException:
+            state.breaker_failure(options['endpoint'], breaker_threshold)
+            raise
+        except BaseException:
+            # not a failure of the endpoint, but a half-open probe must not be left running
+            state.breaker_release(options['endpoint'])
+            raise
+        state.breaker_success(options['endpoint'])
     else:
-        want_profile = sendto or os.environ.get('ALERTA_DEFAULT_PROFILE') or parser.defaults().get('profile')
+        send_with_retries(options, alert, pool_size, timer)
 
-        if want_profile and parser.has_section('profile %s' % want_profile):
-            for opt in options:
-                try:
-                    options[opt] = parser.getboolean('profile %s' % want_profile, opt)
-                except (ValueError, AttributeError):
-                    options[opt] = parser.get('profile %s' % want_profile, opt)
-        else:
-            for opt in options:
-                try:
-                    options[opt] = parser.getboolean('DEFAULT', opt)
-                except (ValueError, AttributeError):
-                    options[opt] = parser.get('DEFAULT', opt)
 
-    options['profile'] = want_profile
-    options['endpoint'] = os.environ.get('ALERTA_ENDPOINT', options['endpoint'])
-    options['key'] = os.environ.get('ALERTA_API_KEY', options['key'])
+def send(sendto, summary, body):
+    """
+    Forward a Zabbix alert to Alerta, or append it to the spool. Returns the
+    exit status for the alert script.
+    """
+    # FIXME - use {ITEM.APPLICATION} for alert "group" when ZBXNEXT-2684 is resolved (see https://support.zabbix.com/browse/ZBXNEXT-2684)
 
-    api = Client(
-        endpoint=options['endpoint'], key=options['key'], timeout=options['timeout'], ssl_verify=options['sslverify']
-    )
+    print('[alerta] Sending message "{}" to {}...'.format(summary, sendto))
+
+    timer = Timer()
+    options = get_options(sendto)
+    timer.add('config', timer.started)
 
     try:
-        alert = parse_zabbix(summary, body)
-        api.send_alert(**alert)
+        started = time.perf_counter()
+        alert = parse_zabbix(summary, body, **parse_options(options))
+        timer.add('parse', started)
+        if options['spool_dir']:
+            spool_alert(options['spool_dir'], sendto, alert)
+        else:
+            status = forward(options, alert, timer=timer)
     except Exception as e:
-        click.secho('ERROR: {}'.format(e))
-        raise click.Abort()
+        print('ERROR: {}'.format(e))
+        return 1
+
+    if options['spool_dir']:
+        print('Spooled message "{}" to {}'.format(summary, options['spool_dir']))
+    elif options['fanout'] and status in (SENT, PARTIAL):
+        print('Sent message "{}" to {} of {}'.format(summary, 'all' if status == SENT else 'some', options['fanout']))
+    elif status == SENT:
+        print('Successfully sent message "{}" to {}!'.format(summary, options['endpoint']))
+    else:
+        print('Message "{}" not sent to {}: {}'.format(summary, options['endpoint'], status))
+    return 0
+
+
+# subcommands are imported on demand so the per-alert path stays cheap
+COMMANDS = {
+    'serve': ('zabbix_cli', 'serve'),
+    'drain': ('zabbix_cli', 'drain'),
+    'webhook': ('zabbix_cli', 'webhook'),
+    'stats': ('zabbix_cli', 'stats'),
+    'batch': ('zabbix_cli', 'batch'),
+    'tail': ('zabbix_cli', 'tail'),
+}
 
-    click.echo('Successfully sent message "{}" to {}!'.format(summary, options['endpoint']))
 
+def main():
+
+    args = sys.argv[1:]
+    if args and args[0] in COMMANDS:
+        module, name = COMMANDS[args[0]]
+        command = getattr(importlib.import_module(module), name)
+        return command(args[1:], prog_name='zabbix-alerta %s' % args[0])
+
+    # Zabbix alert scripts always get three arguments so skip click entirely
+    if len(args) == 3 and not set(args) & {'-h', '--help'}:
+        if submit(*args):
+            print('[alerta] Queued message "{}" for {}'.format(args[1], args[0]))
+            return
+        sys.exit(send(*args))
+
+    from zabbix_cli import cli
 
-if __name__ == '__main__':
     cli()  # pylint: disable=no-value-for-parameter
+
+
+def __getattr__(name):
+
+    # the click command is only built when asked for, see main()
+    if name == 'cli':
+        from zabbix_cli import cli
+
+        return cli
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+if __name__ == '__main__':
+    main()
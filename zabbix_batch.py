@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+    zabbix-alerta batch: forward many Zabbix events read from a stream
+
+    Each input line is a JSON object with the subject and message of a
+    Zabbix alert, eg.
+
+        {"sendto": "production", "subject": "PROBLEM: ...", "message": "resource=..."}
+
+    Lines are parsed as they are read and sent by a bounded pool of workers
+    that share keep-alive connections, so memory use does not grow with the
+    size of the input.
+"""
+
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from zabbix_alerta import Profiles, forward, parse_options, parse_zabbix
+
+FAILED = 'failed'
+
+
+def read_alerts(lines, sendto='', profiles=None):
+    """
+    Yield (line number, options, alert) for every non-blank input line, or
+    (line number, None, exception) if the line could not be parsed.
+    """
+    profiles = profiles or Profiles()
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            options = profiles.get(record.get('sendto') or sendto)
+            alert = parse_zabbix(record['subject'], record['message'], **parse_options(options))
+        except Exception as e:
+            yield lineno, None, e
+        else:
+            yield lineno, options, alert
+
+
+def run(alerts, workers=8, on_failure=None):
+    """
+    Forward parsed alerts with at most `workers` sends, and as many alerts
+    queued, in flight. Calls on_failure(lineno, exception) for every alert
+    not sent. Returns a count of alerts per forward status.
+    """
+    counts = Counter()
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+
+    def failed(lineno, e):
+        with lock:
+            counts[FAILED] += 1
+        if on_failure:
+            on_failure(lineno, e)
+
+    def send(lineno, options, alert):
+        try:
+            status = forward(options, alert, pool_size=workers)
+        except Exception as e:
+            failed(lineno, e)
+        else:
+            with lock:
+                counts[status] += 1
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for lineno, options, alert in alerts:
+            if options is None:
+                failed(lineno, alert)
+                continue
+            slots.acquire()
+            executor.submit(send, lineno, options, alert)
+    return counts
+
+
+def summary(counts, elapsed):
+
+    total = sum(counts.values())
+    rate = total / elapsed if elapsed > 0 else 0.0
+    details = ', '.join('{} {}'.format(n, status) for status, n in sorted(counts.items()))
+    return '{} alerts in {:.2f}s ({:.1f}/s): {}'.format(total, elapsed, rate, details or 'none')
+
+
+def batch(lines, sendto='', workers=8, on_failure=None):
+
+    started = time.monotonic()
+    counts = run(read_alerts(lines, sendto), workers=workers, on_failure=on_failure)
+    return counts, time.monotonic() - started
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+    zabbix-alerta command line
+
+    The per-alert path in zabbix_alerta.main() does not import this module.
+"""
+
+import asyncio
+import logging
+import time
+
+import click
+
+from zabbix_alerta import send, socket_path
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+LOG = logging.getLogger('zabbix-alerta')
+
+
+def setup_logging(debug=False):
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+
+def serve_metrics(address):
+
+    if address:
+        from zabbix_metrics import serve
+
+        serve(address)
+        LOG.info('Serving metrics on http://%s/metrics', address)
+
+
+@click.command('zabbix-alerta', context_settings=CONTEXT_SETTINGS)
+@click.argument('sendto')
+@click.argument('summary')
+@click.argument('body')
+def cli(sendto, summary, body):
+    """
+        Zabbix-to-Alerta integration script
+
+    INSTALL
+
+       $ ln -s `which zabbix-alerta` <AlertScriptsPath>
+
+    ALERT FORMAT
+
+    OPERATIONS
+
+    Default subject:
+
+    {TRIGGER.STATUS}: {TRIGGER.NAME}
+
+    Default message:
+
+    \b
+    resource={HOST.NAME1}
+    event={ITEM.KEY1}
+    environment=Production
+    severity={TRIGGER.SEVERITY}!!
+    status={TRIGGER.STATUS}
+    ack={EVENT.ACK.STATUS}
+    service={TRIGGER.HOSTGROUP.NAME}
+    group=Zabbix
+    value={ITEM.VALUE1}
+    text={TRIGGER.STATUS}: {TRIGGER.NAME}
+    tags={EVENT.TAGS}
+    attributes.eventId={EVENT.ID}
+    attributes.triggerId={TRIGGER.ID}
+    attributes.ip={HOST.IP1}
+    attributes.thresholdInfo={TRIGGER.TEMPLATE.NAME}: {TRIGGER.EXPRESSION}
+    attributes.moreInfo=<a href="http://x.x.x.x/tr_events.php?triggerid={TRIGGER.ID}&eventid={EVENT.ID}">Zabbix console</a>
+    type=zabbixAlert
+    dateTime={EVENT.DATE}T{EVENT.TIME}Z
+
+    RECOVERY
+
+    Default subject:
+
+    {TRIGGER.STATUS}: {TRIGGER.NAME}
+
+    Default message:
+
+    \b
+    resource={HOST.NAME1}
+    event={ITEM.KEY1}
+    environment=Production
+    severity={TRIGGER.SEVERITY}!!
+    status={TRIGGER.STATUS}
+    ack={EVENT.ACK.STATUS}
+    service={TRIGGER.HOSTGROUP.NAME}
+    group=Zabbix
+    value={ITEM.VALUE1}
+    text={TRIGGER.STATUS}: {ITEM.NAME1}
+    tags={EVENT.RECOVERY.TAGS}
+    attributes.ip={HOST.IP1}
+    attributes.thresholdInfo={TRIGGER.TEMPLATE.NAME}: {TRIGGER.EXPRESSION}
+    attributes.moreInfo=<a href="http://x.x.x.x/tr_events.php?triggerid={TRIGGER.ID}&eventid={EVENT.RECOVERY.ID}">Zabbix console</a>
+    type=zabbixAlert
+    dateTime={EVENT.RECOVERY.DATE}T{EVENT.RECOVERY.TIME}Z
+    """
+
+    if send(sendto, summary, body):
+        raise click.Abort()
+
+
+@click.command('serve', context_settings=CONTEXT_SETTINGS)
+@click.option('--socket', 'path', default=socket_path, help='Unix socket path (env: ZABBIX_ALERTA_SOCKET)')
+@click.option('--workers', default=8, show_default=True, help='Concurrent sends to Alerta')
+@click.option('--metrics-listen', metavar='[HOST]:PORT', help='Serve Prometheus metrics at http://HOST:PORT/metrics')
+@click.option('--debug', is_flag=True, help='Print debug output')
+def serve(path, workers, metrics_listen, debug):
+    """
+        Forward Zabbix alerts received on a local socket to Alerta
+    """
+    from zabbix_daemon import Forwarder
+
+    setup_logging(debug)
+    serve_metrics(metrics_listen)
+
+    server = Forwarder(path, workers=workers)
+    LOG.info('Listening on %s', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@click.command('drain', context_settings=CONTEXT_SETTINGS)
+@click.option('--spool-dir', required=True, envvar='ZABBIX_ALERTA_SPOOL_DIR', help='Spool directory')
+@click.option('--concurrency', default=4, show_default=True, help='Concurrent sends to Alerta')
+@click.option('--follow', is_flag=True, help='Keep running and deliver new alerts as they are spooled')
+@click.option('--interval', default=1.0, show_default=True, help='Poll interval in seconds when following')
+@click.option('--metrics-listen', metavar='[HOST]:PORT', help='Serve Prometheus metrics at http://HOST:PORT/metrics')
+@click.option('--debug', is_flag=True, help='Print debug output')
+def drain(spool_dir, concurrency, follow, interval, metrics_listen, debug):
+    """
+        Deliver spooled Zabbix alerts to Alerta
+    """
+    from zabbix_spool import Spool, drain as drain_spool
+
+    setup_logging(debug)
+    serve_metrics(metrics_listen)
+
+    spool = Spool(spool_dir)
+    retry_delay = interval
+    try:
+        while True:
+            delivered, drained = drain_spool(spool, concurrency=concurrency)
+            if delivered:
+                LOG.info('Delivered %d spooled alerts', delivered)
+            if not follow:
+                if not drained:
+                    raise click.ClickException('Alerta unavailable, spool not fully drained')
+                break
+            # back off while Alerta is unavailable
+            retry_delay = interval if drained else min(retry_delay * 2, 60.0)
+            time.sleep(retry_delay)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        spool.close()
+
+
+@click.command('webhook', context_settings=CONTEXT_SETTINGS)
+@click.option('--host', default='127.0.0.1', show_default=True, help='Listen address')
+@click.option('--port', default=8081, show_default=True, help='Listen port')
+@click.option('--workers', default=8, show_default=True, help='Concurrent sends to Alerta')
+@click.option('--metrics-listen', metavar='[HOST]:PORT', help='Serve Prometheus metrics at http://HOST:PORT/metrics')
+@click.option('--debug', is_flag=True, help='Print debug output')
+def webhook(host, port, workers, metrics_listen, debug):
+    """
+        Receive Zabbix webhook requests and forward them to Alerta
+    """
+    from zabbix_webhook import WebhookReceiver
+
+    setup_logging(debug)
+    serve_metrics(metrics_listen)
+
+    receiver = WebhookReceiver(workers=workers)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(receiver.start(host, port))
+    LOG.info('Listening on http://%s:%s', host, port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        receiver.executor.shutdown(wait=True)
+        loop.close()
+
+
+@click.command('batch', context_settings=CONTEXT_SETTINGS)
+@click.argument('input', type=click.File('r'), default='-')
+@click.option('--sendto', default='', help='Profile for records without a "sendto" field')
+@click.option('--workers', default=8, show_default=True, help='Concurrent sends to Alerta')
+@click.option('--debug', is_flag=True, help='Print debug output')
+def batch(input, sendto, workers, debug):
+    """
+        Forward Zabbix alerts read as NDJSON from a file or stdin to Alerta
+    """
+    from zabbix_batch import batch as run_batch, summary
+
+    setup_logging(debug)
+
+    def on_failure(lineno, e):
+        click.echo('line {}: {}'.format(lineno, e), err=True)
+
+    counts, elapsed = run_batch(input, sendto=sendto, workers=workers, on_failure=on_failure)
+    click.echo(summary(counts, elapsed))
+    if counts['failed']:
+        raise click.ClickException('{} alerts not sent'.format(counts['failed']))
+
+
+@click.command('tail', context_settings=CONTEXT_SETTINGS)
+@click.argument('export_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--sendto', default='', help='Profile or endpoint to forward alerts to')
+@click.option('--environment', default='Production', show_default=True, help='Alert environment')
+@click.option('--zabbix-severity', is_flag=True, help='Use Zabbix severity names in Alerta')
+@click.option('--checkpoint', default=None, help='Checkpoint file  [default: <cache dir>/export-checkpoint.json]')
+@click.option('--workers', default=8, show_default=True, help='Concurrent sends to Alerta')
+@click.option('--interval', default=0.2, show_default=True, help='Poll interval in seconds')
+@click.option('--metrics-listen', metavar='[HOST]:PORT', help='Serve Prometheus metrics at http://HOST:PORT/metrics')
+@click.option('--debug', is_flag=True, help='Print debug output')
+def tail(export_dir, sendto, environment, zabbix_severity, checkpoint, workers, interval, metrics_listen, debug):
+    """
+        Forward problem events from Zabbix real-time export files to Alerta
+    """
+    from zabbix_alerta import get_options
+    from zabbix_export import ExportReader, follow
+
+    setup_logging(debug)
+    serve_metrics(metrics_listen)
+
+    reader = ExportReader(export_dir, checkpoint)
+    LOG.info('Following problem export files in %s', export_dir)
+    try:
+        follow(
+            reader,
+            get_options(sendto),
+            workers=workers,
+            interval=interval,
+            environment=environment,
+            zabbix_severity=zabbix_severity,
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+@click.command('stats', context_settings=CONTEXT_SETTINGS)
+def stats():
+    """
+        Show counts of alerts held back locally
+    """
+    from zabbix_state import State
+
+    state = State()
+    try:
+        for name, value in state.counters().items():
+            click.echo('{:<20} {}'.format(name, value))
+    finally:
+        state.close()
@@ -5,6 +5,7 @@
 
 import argparse
 import getpass
+import json
 import logging
 import os
 import sys
@@ -49,6 +50,7 @@ EMAIL = 0
 SCRIPT = 1
 SMS = 2
 JABBER = 3
+WEBHOOK = 4
 EZ_TEXTING = 100
 
 # use if severity
@@ -102,37 +104,194 @@ NO_MANUAL_CLOSE = 0
 ALLOW_MANUAL_CLOSE = 1
 
 
+# posts the webhook parameters to `zabbix-alerta webhook` as a JSON object
+WEBHOOK_SCRIPT = """\
+var params = JSON.parse(value),
+    req = new CurlHttpRequest();
+
+req.AddHeader('Content-Type: application/json');
+var resp = req.Post(params.url, JSON.stringify(params));
+
+if (req.Status() != 200) {
+    throw 'Response code: ' + req.Status() + ' ' + resp;
+}
+return 'OK';
+"""
+
+
+def message_fields(use_zabbix_severity=False):
+
+    return [
+        ('resource', '{HOST.NAME1}'),
+        ('event', '{ITEM.KEY1}'),
+        ('environment', 'Production'),
+        ('severity', '{TRIGGER.SEVERITY}' + ('!!' if use_zabbix_severity else '')),
+        ('status', '{TRIGGER.STATUS}'),
+        ('ack', '{EVENT.ACK.STATUS}'),
+        ('service', '{TRIGGER.HOSTGROUP.NAME}'),
+        ('group', 'Zabbix'),
+        ('value', '{ITEM.VALUE1}'),
+        ('text', '{TRIGGER.STATUS}: {TRIGGER.NAME}'),
+        ('tags', '{EVENT.TAGS}'),
+        ('attributes.ip', '{HOST.IP1}'),
+        ('attributes.thresholdInfo', '{TRIGGER.TEMPLATE.NAME}: {TRIGGER.EXPRESSION}'),
+        ('attributes.eventId', '{EVENT.ID}'),
+        ('attributes.triggerId', '{TRIGGER.ID}'),
+        ('type', 'zabbixAlert'),
+        ('dateTime', '{EVENT.DATE}T{EVENT.TIME}Z'),
+    ]
+
+
+def format_message(fields, use_json=False):
+
+    if use_json:
+        return json.dumps(dict(fields), indent=2)
+    return ''.join('%s=%s\r\n' % field for field in fields)
+
+
+def script_mediatype(name_field='description'):
+
+    return {
+        'type': SCRIPT,
+        name_field: 'Alerta',
+        'exec_path': 'zabbix-alerta',
+        'exec_params': '{ALERT.SENDTO}\n{ALERT.SUBJECT}\n{ALERT.MESSAGE}\n',
+        'maxattempts': '5',
+        'attempt_interval': '5s',
+    }
+
+
+def webhook_mediatype(webhook_url, web_url, use_zabbix_severity=False):
+
+    console_link = (
+        '<a href="%s/tr_events.php?triggerid={TRIGGER.ID}&eventid={EVENT.ID}" target="_blank">Zabbix console</a>'
+        % web_url
+    )
+    parameters = [
+        {'name': 'url', 'value': webhook_url},
+        {'name': 'sendto', 'value': '{ALERT.SENDTO}'},
+        {'name': 'subject', 'value': '{ALERT.SUBJECT}'},
+    ]
+    parameters += [{'name': name, 'value': value} for name, value in message_fields(use_zabbix_severity)]
+    parameters.append({'name': 'attributes.moreInfo', 'value': console_link})
+
+    return {
+        'type': WEBHOOK,
+        'name': 'Alerta Webhook',
+        'script': WEBHOOK_SCRIPT,
+        'parameters': parameters,
+        'timeout': '10s',
+        'maxattempts': '5',
+        'attempt_interval': '5s',
+    }
+
+
+def action_params(media_id, user_id, web_url, use_zabbix_severity=False, use_json=False):
+
+    use_console_link = True
+
+    fields = message_fields(use_zabbix_severity)
+    default_message = format_message(fields, use_json)
+
+    operations_console_link = (
+        '<a href="%s/tr_events.php?triggerid={TRIGGER.ID}&eventid={EVENT.ID}" target="_blank">Zabbix console</a>'
+        % web_url
+    )
+    operations = {
+        'operationtype': SEND_MESSAGE,
+        'opmessage': {
+            'default_msg': USE_DATA_FROM_OPERATION,
+            'mediatypeid': media_id,
+            'subject': '{TRIGGER.STATUS}: {TRIGGER.NAME}',
+            'message': format_message(fields + [('attributes.moreInfo', operations_console_link)], use_json)
+            if use_console_link
+            else '',
+        },
+        'opmessage_usr': [{'userid': user_id}],
+    }
+
+    recovery_console_link = (
+        '<a href="%s/tr_events.php?triggerid={TRIGGER.ID}&eventid={EVENT.RECOVERY.ID}" target="_blank">Zabbix console</a>'
+        % web_url
+    )
+    recovery_operations = {
+        'operationtype': SEND_MESSAGE,
+        'opmessage': {
+            'default_msg': USE_DATA_FROM_OPERATION,
+            'mediatypeid': media_id,
+            'subject': '{TRIGGER.STATUS}: {TRIGGER.NAME}',
+            'message': format_message(fields + [('attributes.moreInfo', recovery_console_link)], use_json)
+            if use_console_link
+            else '',
+        },
+        'opmessage_usr': [{'userid': user_id}],
+    }
+
+    return {
+        'name': 'Forward to Alerta',
+        'eventsource': TRIGGERS,
+        'status': ENABLED,
+        'esc_period': 120,
+        'def_shortdata': '{TRIGGER.NAME}: {TRIGGER.STATUS}',
+        'def_longdata': default_message,
+        'r_shortdata': '{TRIGGER.NAME}: {TRIGGER.STATUS}',
+        'r_longdata': default_message,
+        'maintenance_mode': DO_NOT_PAUSE_EXEC,
+        'operations': [operations],
+        'recovery_operations': [recovery_operations],
+    }
+
+
+def trapper_send(trapper, host, key, value):
+
+    cfg = protobix.ZabbixAgentConfig()
+    cfg.server_active = trapper
+    zbx = protobix.DataContainer(cfg)
+
+    zbx.data_type = 'items'
+    zbx.add_item(host=host, key=key, value=value)
+    return zbx.send()
+
+
 class ZabbixConfig:
-    def __init__(self, endpoint, user, password=''):
+    def __init__(self, endpoint, user, password='', timeout=None):
 
-        self.zapi = ZabbixAPI(endpoint)
+        self.zapi = ZabbixAPI(endpoint, timeout=timeout)
         self.zapi.login(user, password)
-        print('Connected to Zabbix API Version %s' % self.zapi.api_version())
+        version = self.zapi.api_version()
+        print('Connected to Zabbix API Version %s' % version)
+        self.version = tuple(int(v) for v in version.split('.')[:2])
 
         self.item_id = None
         self.trigger_id = None
 
-    def create_action(self, sendto, web_url, use_zabbix_severity=False):
+    @property
+    def mediatype_name_field(self):
+        return 'name' if self.version >= (4, 4) else 'description'
 
-        use_console_link = True
+    @property
+    def user_alias_field(self):
+        return 'username' if self.version >= (5, 4) else 'alias'
 
-        medias = self.zapi.mediatype.get(output='extend')
-        try:
-            media_id = [m for m in medias if m['description'] == 'Alerta'][0]['mediatypeid']
-        except Exception:
-            print('media does not exist. creating...')
-            response = self.zapi.mediatype.create(
-                type=SCRIPT,
-                description='Alerta',
-                exec_path='zabbix-alerta',
-                exec_params='{ALERT.SENDTO}\n{ALERT.SUBJECT}\n{ALERT.MESSAGE}\n',
-                maxattempts='5',
-                attempt_interval='5s',
-            )
-            media_id = response['mediatypeids'][0]
+    def admin_user_id(self):
+
+        users = self.zapi.user.get(output=['userid'], filter={self.user_alias_field: 'Admin'})
+        return users[0]['userid']
+
+    def create_action(self, sendto, web_url, use_zabbix_severity=False, webhook_url=None, use_json=False):
 
-        users = self.zapi.user.get(output='extend')
-        admin_user_id = [u for u in users if u['alias'] == 'Admin'][0]['userid']
+        if webhook_url:
+            media_id = self.create_webhook(webhook_url, web_url, use_zabbix_severity)
+        else:
+            medias = self.zapi.mediatype.get(output=['mediatypeid'], filter={self.mediatype_name_field: 'Alerta'})
+            try:
+                media_id = medias[0]['mediatypeid']
+            except Exception:
+                print('media does not exist. creating...')
+                response = self.zapi.mediatype.create(**script_mediatype(self.mediatype_name_field))
+                media_id = response['mediatypeids'][0]
+
+        admin_user_id = self.admin_user_id()
 
         media_alerta = {
             'mediatypeid': media_id,
@@ -147,74 +306,29 @@ class ZabbixConfig:
         except ZabbixAPIException as e:
             sys.exit(e)
 
-        default_message = (
-            'resource={HOST.NAME1}\r\n'
-            'event={ITEM.KEY1}\r\n'
-            'environment=Production\r\n'
-            'severity={TRIGGER.SEVERITY}' + ('!!' if use_zabbix_severity else '') + '\r\n'
-            'status={TRIGGER.STATUS}\r\n'
-            'ack={EVENT.ACK.STATUS}\r\n'
-            'service={TRIGGER.HOSTGROUP.NAME}\r\n'
-            'group=Zabbix\r\n'
-            'value={ITEM.VALUE1}\r\n'
-            'text={TRIGGER.STATUS}: {TRIGGER.NAME}\r\n'
-            'tags={EVENT.TAGS}\r\n'
-            'attributes.ip={HOST.IP1}\r\n'
-            'attributes.thresholdInfo={TRIGGER.TEMPLATE.NAME}: {TRIGGER.EXPRESSION}\r\n'
-            'attributes.eventId={EVENT.ID}\r\n'
-            'attributes.triggerId={TRIGGER.ID}\r\n'
-            'type=zabbixAlert\r\n'
-            'dateTime={EVENT.DATE}T{EVENT.TIME}Z\r\n'
-        )
-
-        operations_console_link = (
-            'attributes.moreInfo=<a href="%s/tr_events.php?triggerid={TRIGGER.ID}&eventid={EVENT.ID}" target="_blank">Zabbix console</a>'
-            % web_url
-        )
-        operations = {
-            'operationtype': SEND_MESSAGE,
-            'opmessage': {
-                'default_msg': USE_DATA_FROM_OPERATION,
-                'mediatypeid': media_id,
-                'subject': '{TRIGGER.STATUS}: {TRIGGER.NAME}',
-                'message': default_message + operations_console_link if use_console_link else '',
-            },
-            'opmessage_usr': [{'userid': admin_user_id}],
-        }
-
-        recovery_console_link = (
-            'attributes.moreInfo=<a href="%s/tr_events.php?triggerid={TRIGGER.ID}&eventid={EVENT.RECOVERY.ID}" target="_blank">Zabbix console</a>'
-            % web_url
-        )
-        recovery_operations = {
-            'operationtype': SEND_MESSAGE,
-            'opmessage': {
-                'default_msg': USE_DATA_FROM_OPERATION,
-                'mediatypeid': media_id,
-                'subject': '{TRIGGER.STATUS}: {TRIGGER.NAME}',
-                'message': default_message + recovery_console_link if use_console_link else '',
-            },
-            'opmessage_usr': [{'userid': admin_user_id}],
-        }
-
         try:
-            self.zapi.action.create(
-                name='Forward to Alerta',
-                eventsource=TRIGGERS,
-                status=ENABLED,
-                esc_period=120,
-                def_shortdata='{TRIGGER.NAME}: {TRIGGER.STATUS}',
-                def_longdata=default_message,
-                r_shortdata='{TRIGGER.NAME}: {TRIGGER.STATUS}',
-                r_longdata=default_message,
-                maintenance_mode=DO_NOT_PAUSE_EXEC,
-                operations=[operations],
-                recovery_operations=[recovery_operations],
-            )
+            self.zapi.action.create(**action_params(media_id, admin_user_id, web_url, use_zabbix_severity, use_json))
         except ZabbixAPIException as e:
             print(e)
 
-    def test_action(self, trapper, endpoint, key=None):
+    def create_webhook(self, webhook_url, web_url, use_zabbix_severity=False):
+
+        medias = self.zapi.mediatype.get(output=['mediatypeid', 'name'], filter={'name': 'Alerta Webhook'})
+        if medias:
+            return medias[0]['mediatypeid']
+
+        print('webhook media does not exist. creating...')
+        response = self.zapi.mediatype.create(**webhook_mediatype(webhook_url, web_url, use_zabbix_severity))
+        return response['mediatypeids'][0]
+
+    def test_action(self, trapper, endpoint, key=None, timeout=None):
+
+        deadline = time.time() + timeout if timeout else None
+
+        def wait(seconds):
+            if deadline and time.time() + seconds > deadline:
+                raise TimeoutError('test alert not received within %s seconds' % timeout)
+            time.sleep(seconds)
 
         hosts = self.zapi.host.get()
         zabbix_server_id = [h for h in hosts if h['name'] == 'Zabbix server'][0]['hostid']
@@ -250,14 +364,7 @@ class ZabbixConfig:
             self.item_id = self.zapi.item.get(triggerids=self.trigger_id)[0]['itemid']
 
         def zabbix_send(value):
-            cfg = protobix.ZabbixAgentConfig()
-            cfg.server_active = trapper
-            zbx = protobix.DataContainer(cfg)
-
-            zbx.data_type = 'items'
-            zbx.add_item(host='Zabbix server', key='test.alerta', value=value)
-            response = zbx.send()
-            print(response)
+            print(trapper_send(trapper, 'Zabbix server', 'test.alerta', value))
 
         print('sending test items')
         now = int(time.time())
@@ -280,7 +387,7 @@ class ZabbixConfig:
             if len(response) > 1:
                 break
             print('waiting 5 seconds...')
-            time.sleep(5)
+            wait(5)
 
         print('sent items received by zabbix')
         print(response)
@@ -300,7 +407,7 @@ class ZabbixConfig:
                 event_id = response[0]['eventid']
                 break
             print('waiting 2 seconds...')
-            time.sleep(2)
+            wait(2)
 
         print('event triggered')
         print(response[0])
@@ -315,7 +422,7 @@ class ZabbixConfig:
             if len(response) > 0:
                 break
             print('waiting 2 seconds...')
-            time.sleep(2)
+            wait(2)
 
         print('alert triggered by event')
         print(response[0])
@@ -330,7 +437,7 @@ class ZabbixConfig:
                 sys.exit(e)
             if len(response) > 0:
                 break
-            time.sleep(5)
+            wait(5)
         print(response[0].last_receive_id)
 
         print('success!')
@@ -344,8 +451,347 @@ class ZabbixConfig:
             pass
 
 
+def add_connection_arguments(parser):
+
+    parser.add_argument('--server', default='http://localhost', help='Zabbix web API URL (default: http://localhost)')
+    parser.add_argument('--user', default='Admin', help='Zabbix admin user (default: "Admin")')
+    parser.add_argument(
+        '--no-password', '-w', action='store_true', help='do not prompt for password (default: "zabbix")'
+    )
+    parser.add_argument('--debug', action='store_true', help='print debug output')
+
+
+def connect(args):
+
+    if args.debug:
+        # debug logging
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setLevel(logging.DEBUG)
+        log = logging.getLogger('pyzabbix')
+        log.addHandler(stream)
+        log.setLevel(logging.DEBUG)
+
+    if args.no_password:
+        password = 'zabbix'  # default for 'Admin'
+    else:
+        password = getpass.getpass()
+
+    return ZabbixConfig(args.server, args.user, password)
+
+
+def replay(argv):
+
+    from zabbix_alerta import get_options
+    from zabbix_replay import Replay, parse_time
+
+    parser = argparse.ArgumentParser(
+        prog='zac replay',
+        description='Replay Zabbix trigger events in a time range to Alerta',
+        epilog='Example\n\n  $ zac replay --server http://zabbix-web --from 6h --to now production\n',
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    add_connection_arguments(parser)
+    parser.add_argument(
+        '--from', dest='time_from', required=True, help='start time as epoch, ISO 8601 or time ago (eg. 2h, 7d)'
+    )
+    parser.add_argument('--to', dest='time_till', default='now', help='end time (default: now)')
+    parser.add_argument('--environment', default='Production', help='alert environment (default: Production)')
+    parser.add_argument('--zabbix-severity', '-Z', action='store_true', help='use Zabbix severity levels')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent sends to Alerta (default: 8)')
+    parser.add_argument('--fetch-workers', type=int, default=4, help='concurrent Zabbix API requests (default: 4)')
+    parser.add_argument('--page-size', type=int, default=1000, help='events per Zabbix API request (default: 1000)')
+    parser.add_argument('--checkpoint', help='checkpoint file (default: <cache dir>/replay-checkpoint.json)')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint of a previous replay')
+    parser.add_argument('sendto', nargs='?', default='', help='config profile or alerta API endpoint and key')
+    args = parser.parse_args(argv)
+
+    try:
+        time_from, time_till = parse_time(args.time_from), parse_time(args.time_till)
+    except ValueError as e:
+        parser.error(str(e))
+
+    def progress(sent, total, elapsed):
+        print('replayed %d/%d events (%.1f/s)' % (sent, total, sent / elapsed if elapsed else 0.0))
+
+    try:
+        zc = connect(args)
+        job = Replay(zc.zapi, get_options(args.sendto), time_from, time_till, args.checkpoint, args.page_size)
+        if args.restart:
+            job.reset()
+        job.run(args.workers, args.fetch_workers, args.environment, args.zabbix_severity, progress=progress)
+    except KeyboardInterrupt:
+        sys.exit('interrupted, run the same command again to resume')
+    except Exception as e:
+        sys.exit(e)
+
+
+def reconcile(argv):
+
+    from zabbix_alerta import get_client, get_options
+    from zabbix_reconcile import Reconciler
+
+    parser = argparse.ArgumentParser(
+        prog='zac reconcile',
+        description='Close or reopen Alerta alerts that disagree with open Zabbix problems',
+        epilog='Example\n\n  $ zac reconcile --server http://zabbix-web --interval 60 production\n',
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    add_connection_arguments(parser)
+    parser.add_argument('--interval', type=int, default=0, help='seconds between runs (default: run once)')
+    parser.add_argument(
+        '--full-interval', type=int, default=3600, help='seconds between full syncs of open problems (default: 3600)'
+    )
+    parser.add_argument(
+        '--origin', help='origin of the alerts from this Zabbix server (default: zabbix/<this host>)'
+    )
+    parser.add_argument('--state', help='state file (default: <cache dir>/reconcile-<origin>.json)')
+    parser.add_argument('--dry-run', action='store_true', help='show changes without making them')
+    parser.add_argument('sendto', nargs='?', default='', help='config profile or alerta API endpoint and key')
+    args = parser.parse_args(argv)
+
+    if args.debug:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    try:
+        zc = connect(args)
+        reconciler = Reconciler(
+            zc.zapi, get_client(get_options(args.sendto)), args.state, args.full_interval, origin=args.origin
+        )
+        while True:
+            closed, reopened = reconciler.reconcile(dry_run=args.dry_run)
+            print(
+                '%d open problems, %s%d alerts closed, %d reopened'
+                % (len(reconciler.problems), 'would be ' if args.dry_run else '', len(closed), len(reopened))
+            )
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        sys.exit(e)
+
+
+def fleet(argv):
+
+    from zabbix_fleet import OK, read_inventory, run, summary
+
+    parser = argparse.ArgumentParser(
+        prog='zac fleet',
+        description='Configure the Alerta integration on all Zabbix servers in an inventory file',
+        epilog='Example\n\n  $ zac fleet --workers 16 --test zabbix-servers.ini\n',
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument('--workers', type=int, default=8, help='servers configured at the same time (default: 8)')
+    parser.add_argument('--test', action='store_true', help='send a test alert through each server')
+    parser.add_argument(
+        '--no-password', '-w', action='store_true', help='use "zabbix" for servers without a password in the inventory'
+    )
+    parser.add_argument('--verbose', '-v', action='store_true', help='show output of every server, not just failures')
+    parser.add_argument('inventory', help='ini file with a section for each Zabbix server')
+    args = parser.parse_args(argv)
+
+    try:
+        servers = read_inventory(args.inventory)
+    except (ValueError, configparser.Error) as e:
+        sys.exit(e)
+
+    default_password = 'zabbix'  # default for 'Admin'
+    if not args.no_password and not all(s['password'] for s in servers):
+        default_password = getpass.getpass()
+
+    results = run(servers, workers=args.workers, test=args.test, default_password=default_password)
+    for server, result, _, _, output in results:
+        if output and (args.verbose or result != OK):
+            print('--- %s (%s)' % (server['name'], server['server']))
+            print(output.rstrip())
+    print(summary(results))
+    if any(result != OK for _, result, _, _, _ in results):
+        sys.exit(1)
+
+
+def plan_or_apply(argv, command):
+
+    from zabbix_plan import Planner, format_change
+
+    parser = argparse.ArgumentParser(
+        prog='zac %s' % command,
+        description='Show the changes needed to configure Zabbix for Alerta'
+        if command == 'plan'
+        else 'Configure Zabbix for Alerta, changing only what differs',
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    add_connection_arguments(parser)
+    parser.add_argument('--zabbix-severity', '-Z', action='store_true', help='use Zabbix severity levels')
+    parser.add_argument('--json', action='store_true', help='use JSON alert message template')
+    parser.add_argument(
+        '--webhook', metavar='URL', help='use webhook media (Zabbix 5.0+) posting to "zabbix-alerta webhook" at URL'
+    )
+    parser.add_argument('sendto', help='config profile or alerta API endpoint and key')
+    args = parser.parse_args(argv)
+
+    try:
+        zc = connect(args)
+        planner = Planner(zc, args.sendto, args.server, args.zabbix_severity, args.webhook, args.json)
+        changes = planner.apply() if command == 'apply' else planner.plan()
+    except (KeyboardInterrupt, SystemExit):
+        sys.exit(0)
+    except Exception as e:
+        sys.exit(e)
+
+    for change in changes:
+        print(format_change(change, applied=command == 'apply'))
+
+
+def plan(argv):
+    plan_or_apply(argv, 'plan')
+
+
+def apply(argv):
+    plan_or_apply(argv, 'apply')
+
+
+def probe(argv):
+
+    from zabbix_alerta import get_client, get_options
+    from zabbix_probe import Probe, report
+
+    parser = argparse.ArgumentParser(
+        prog='zac probe',
+        description='Measure alert latency through each stage from Zabbix to Alerta',
+        epilog='Example\n\n  $ zac probe --server http://zabbix-web --trapper zabbix-server --count 50 --rate 2 production\n',
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    add_connection_arguments(parser)
+    parser.add_argument('--trapper', default='localhost', help='Zabbix trapper host (default: localhost)')
+    parser.add_argument('--count', type=int, default=10, help='number of test events (default: 10)')
+    parser.add_argument('--rate', type=float, default=1.0, help='test events per second (default: 1)')
+    parser.add_argument(
+        '--timeout', type=int, default=120, help='seconds to wait for the last event to reach Alerta (default: 120)'
+    )
+    parser.add_argument('--clean-up', action='store_true', help='delete the probe item and trigger afterwards')
+    parser.add_argument('sendto', nargs='?', default='', help='config profile or alerta API endpoint and key')
+    args = parser.parse_args(argv)
+
+    def progress(received, sent):
+        print('%d/%d test events received by Alerta' % (received, sent))
+
+    try:
+        zc = connect(args)
+        job = Probe(zc.zapi, get_client(get_options(args.sendto)), args.trapper)
+        job.setup()
+        try:
+            samples = job.run(args.count, args.rate, args.timeout, progress=progress)
+        finally:
+            if args.clean_up:
+                job.clean_up()
+    except KeyboardInterrupt:
+        sys.exit(0)
+    except Exception as e:
+        sys.exit(e)
+
+    print(report(samples))
+
+
+def inventory(argv):
+
+    from zabbix_alerta import cache_dir
+    from zabbix_inventory import DEFAULT_FIELDS, refresh
+
+    parser = argparse.ArgumentParser(
+        prog='zac inventory',
+        description='Export Zabbix host inventory, groups and tags to a local index for alert enrichment',
+        epilog='Example\n\n  $ zac inventory --server http://zabbix-web --output /var/lib/zabbix/inventory.idx --interval 300\n',
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    add_connection_arguments(parser)
+    parser.add_argument('--output', '-o', help='index file (default: <cache dir>/inventory.idx)')
+    parser.add_argument(
+        '--fields', default=DEFAULT_FIELDS, help='inventory fields as field[=attribute],... (default: %(default)s)'
+    )
+    parser.add_argument('--interval', type=int, default=0, help='seconds between refreshes (default: run once)')
+    args = parser.parse_args(argv)
+
+    path = args.output or os.path.join(cache_dir(), 'inventory.idx')
+    try:
+        zc = connect(args)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        while True:
+            hosts, added, changed, removed = refresh(zc.zapi, path, zc.version, args.fields)
+            print(
+                '%d hosts exported to %s, %d names added, %d changed, %d removed' % (hosts, path, added, changed, removed)
+            )
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        sys.exit(e)
+
+
+def rules(argv):
+
+    from zabbix_alerta import Profiles
+    from zabbix_batch import read_alerts
+    from zabbix_rules import Rules, compile_rules, describe, read_rules
+
+    parser = argparse.ArgumentParser(
+        prog='zac rules',
+        description='Check alert routing rules offline',
+        epilog='Example\n\n  $ zac rules test /etc/zabbix-alerta/rules.ini alerts.ndjson\n',
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest='command', metavar='{test}')
+    subparsers.required = True
+    test = subparsers.add_parser(
+        'test', help='validate a rules file and show the rule each sample alert matches', description='Validate a rules file'
+    )
+    test.add_argument('rules', help='rules file')
+    test.add_argument(
+        'alerts', nargs='?', type=argparse.FileType('r'), help='sample alerts as NDJSON, like "zabbix-alerta batch" input'
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        rule_list = read_rules(args.rules)
+    except ValueError as e:
+        sys.exit('%s: %s' % (args.rules, e))
+    compiled = Rules(compile_rules(rule_list))
+    print('%s: %d rules OK' % (args.rules, len(rule_list)))
+
+    if args.alerts:
+        failed = 0
+        for lineno, _, alert in read_alerts(args.alerts, profiles=Profiles()):
+            if isinstance(alert, Exception):
+                print('line %d: %s' % (lineno, alert))
+                failed += 1
+                continue
+            print(
+                'line %d: %s %s %s -> %s'
+                % (lineno, alert.get('resource'), alert.get('event'), alert.get('severity'), describe(compiled.match(alert)))
+            )
+        if failed:
+            sys.exit(1)
+
+
+COMMANDS = {
+    'plan': plan,
+    'apply': apply,
+    'replay': replay,
+    'reconcile': reconcile,
+    'fleet': fleet,
+    'probe': probe,
+    'inventory': inventory,
+    'rules': rules,
+}
+
+
 def main():
 
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
+
     config_file = os.environ.get('ALERTA_CONF_FILE') or OPTIONS['config_file']
 
     config = configparser.RawConfigParser(defaults=OPTIONS)
@@ -356,19 +802,18 @@ def main():
 
     parser = argparse.ArgumentParser(
         prog='zac',
-        usage='zac [OPTIONS] SENDTO',
+        usage='zac [OPTIONS] SENDTO\n       zac {%s} --help' % ','.join(COMMANDS),
         description='Zabbix-Alerta configuration script',
         epilog=epilog,
         formatter_class=argparse.RawTextHelpFormatter,
     )
-    parser.add_argument('--server', default='http://localhost', help='Zabbix web API URL (default: http://localhost)')
-    parser.add_argument('--user', default='Admin', help='Zabbix admin user (default: "Admin")')
-    parser.add_argument(
-        '--no-password', '-w', action='store_true', help='do not prompt for password (default: "zabbix")'
-    )
+    add_connection_arguments(parser)
     parser.add_argument('--trapper', default='localhost', help='Zabbix trapper host (default: localhost)')
     parser.add_argument('--zabbix-severity', '-Z', action='store_true', help='use Zabbix severity levels')
-    parser.add_argument('--debug', action='store_true', help='print debug output')
+    parser.add_argument('--json', action='store_true', help='use JSON alert message template')
+    parser.add_argument(
+        '--webhook', metavar='URL', help='use webhook media (Zabbix 5.0+) posting to "zabbix-alerta webhook" at URL'
+    )
     parser.add_argument('sendto', help='config profile or alerta API endpoint and key')
     args, left = parser.parse_known_args()
 
@@ -399,24 +844,13 @@ def main():
     parser.set_defaults(**OPTIONS)
     args = parser.parse_args()
 
-    if args.debug:
-        # debug logging
-        stream = logging.StreamHandler(sys.stdout)
-        stream.setLevel(logging.DEBUG)
-        log = logging.getLogger('pyzabbix')
-        log.addHandler(stream)
-        log.setLevel(logging.DEBUG)
-
-    if args.no_password:
-        password = 'zabbix'  # default for 'Admin'
-    else:
-        password = getpass.getpass()
-
     try:
-        zc = ZabbixConfig(args.server, args.user, password)
+        zc = connect(args)
 
         # configure action
-        zc.create_action(args.sendto, args.server, args.zabbix_severity)
+        zc.create_action(
+            args.sendto, args.server, args.zabbix_severity, webhook_url=args.webhook, use_json=args.json
+        )
 
         # test action
         zc.test_action(args.trapper, args.endpoint, args.key)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+    zabbix-alerta serve: long-running forwarder daemon
+
+    Keeps configuration, profiles and keep-alive HTTP sessions warm so that
+    the per-alert `zabbix-alerta` script only has to hand the Zabbix alert
+    to the daemon over a local Unix socket. The daemon replies once the
+    alert is delivered or spooled, otherwise the script sends it itself and
+    fails if it cannot, so that Zabbix retries.
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from zabbix_alerta import (SPOOLED, Profiles, forward, options_env,
+                           parse_options, parse_zabbix, spool_alert)
+
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+# alerts queued or being sent, per worker, before new ones are refused
+MAX_PENDING_PER_WORKER = 4
+
+LOG = logging.getLogger('zabbix-alerta')
+
+
+class ForwarderHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+
+        line = self.rfile.readline(MAX_REQUEST_SIZE)
+        try:
+            request = json.loads(line.decode('utf-8'))
+            args = request['sendto'], request['summary'], request['body']
+        except (ValueError, KeyError, TypeError) as e:
+            LOG.warning('Invalid request: %s', e)
+            self.wfile.write(b'ERROR\n')
+            return
+
+        # sendto would resolve to other options than the script's, eg. another endpoint
+        if request.get('env') != options_env():
+            LOG.warning('Environment of the script differs, not accepting message "%s"', args[1])
+            self.wfile.write(b'ENV\n')
+            return
+
+        # over the limit the script sends the alert itself
+        if not self.server.pending.acquire(blocking=False):
+            LOG.warning('Too many pending alerts, not accepting message "%s"', args[1])
+            self.wfile.write(b'BUSY\n')
+            return
+        try:
+            delivered = self.server.executor.submit(self.server.forward, *args).result()
+        finally:
+            self.server.pending.release()
+        self.wfile.write(b'OK\n' if delivered else b'ERROR\n')
+
+
+class Forwarder(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, workers=8, max_pending=None):
+
+        self.path = path
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = threading.BoundedSemaphore(max_pending or workers * MAX_PENDING_PER_WORKER)
+
+        self.profiles = Profiles()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        remove_stale_socket(path)
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, ForwarderHandler)
+        finally:
+            os.umask(old_umask)
+
+    def forward(self, sendto, summary, body):
+        """
+        Returns True once the alert is delivered or spooled.
+        """
+        try:
+            options = self.profiles.get(sendto)
+            alert = parse_zabbix(summary, body, **parse_options(options))
+            if options['spool_dir']:
+                spool_alert(options['spool_dir'], sendto, alert)
+                status = SPOOLED
+            else:
+                status = forward(options, alert, pool_size=self.workers)
+        except Exception as e:
+            LOG.error('Failed to send message "%s" to %s: %s', summary, sendto, e)
+            return False
+        LOG.info('Message "%s" to %s: %s', summary, options['endpoint'], status)
+        return True
+
+    def server_close(self):
+
+        super().server_close()
+        self.executor.shutdown(wait=True)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def remove_stale_socket(path):
+
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise SystemExit('Forwarder already running on %s' % path)
+    finally:
+        sock.close()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+    zabbix-alerta tail: forward Zabbix real-time export problem events
+
+    Zabbix 4.4+ writes problem and recovery events as NDJSON to files named
+    problems-*.ndjson in ExportDir (one per history syncer) and renames them
+    to *.ndjson.old when they reach ExportFileSize. Following these files
+    replaces the fork-per-alert script media type.
+
+    The byte offset reached in each file is checkpointed after delivery, at
+    most once per COMMIT_INTERVAL, and a renamed file is finished before the
+    new file is started. Open problems are kept with the checkpoint until
+    their recovery is delivered, so that it can be mapped to the same alert.
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from zabbix_alerta import cache_dir, make_alert
+from zabbix_spool import deliver
+
+BATCH_SIZE = 2000
+COMMIT_INTERVAL = 1.0
+
+# open problems remembered for their recovery, the oldest are forgotten first
+MAX_PROBLEMS = 100000
+
+# fields of a problem event needed to map its recovery
+PROBLEM_FIELDS = ('eventid', 'objectid', 'name', 'severity', 'hosts', 'groups', 'tags')
+
+# Zabbix severity numbers as exported
+ZBX_SEVERITIES = ['Not classified', 'Information', 'Warning', 'Average', 'High', 'Disaster']
+
+LOG = logging.getLogger('zabbix-alerta')
+
+
+def default_checkpoint():
+    return os.path.join(cache_dir(), 'export-checkpoint.json')
+
+
+def problem_macros(problem, status, environment='Production', zabbix_severity=False):
+    """
+    Map an exported problem event to the macros of the default alert message.
+    The alert event is the trigger id, so that problems of different triggers
+    with the same name are not merged and each re-fire of a trigger updates
+    the same alert, or the problem name if the export has no trigger id. The
+    problem event id is kept in the attributes.
+    """
+    hosts = problem.get('hosts') or [{}]
+    severity = ZBX_SEVERITIES[problem.get('severity', 0)]
+    macros = [
+        ('resource', hosts[0].get('name') or hosts[0].get('host')),
+        ('event', str(problem['objectid']) if 'objectid' in problem else problem['name']),
+        ('environment', environment),
+        ('severity', severity + '!!' if zabbix_severity else severity),
+        ('status', status),
+        ('service', problem.get('groups') or []),
+        ('group', 'Zabbix'),
+        ('text', '{}: {}'.format(status, problem['name'])),
+        ('tags', ['{}:{}'.format(t['tag'], t['value']) if t.get('value') else t['tag'] for t in problem.get('tags', [])]),
+        ('attributes.eventId', str(problem['eventid'])),
+    ]
+    if 'objectid' in problem:
+        macros.append(('attributes.triggerId', str(problem['objectid'])))
+    macros.append(('type', 'zabbixAlert'))
+    return macros
+
+
+class ExportReader:
+    def __init__(self, export_dir, checkpoint_path=None, max_problems=MAX_PROBLEMS):
+
+        self.export_dir = export_dir
+        self.checkpoint_path = checkpoint_path or default_checkpoint()
+        self.max_problems = max_problems
+        self.positions = {}
+        self.problems = {}
+        self._dirty = False
+        self._last_commit = 0
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+            self.positions = checkpoint['positions']
+            self.problems = checkpoint['problems']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def files(self):
+        return sorted(
+            name for name in os.listdir(self.export_dir) if name.startswith('problems-') and name.endswith('.ndjson')
+        )
+
+    def source(self, name):
+        """
+        Returns the path, inode and offset to continue reading export file
+        `name` from, finishing its rotated .old file first.
+        """
+        path = os.path.join(self.export_dir, name)
+        st = os.stat(path)
+        position = self.positions.get(name)
+        if not position:
+            return path, st.st_ino, 0
+        if position['inode'] == st.st_ino:
+            return path, st.st_ino, position['offset'] if position['offset'] <= st.st_size else 0
+        try:
+            old = os.stat(path + '.old')
+        except OSError:
+            old = None
+        if old and old.st_ino == position['inode'] and position['offset'] < old.st_size:
+            return path + '.old', old.st_ino, position['offset']
+        return path, st.st_ino, 0
+
+    def read(self, batch_size=BATCH_SIZE):
+        """
+        Returns up to batch_size (name, inode, next_offset, line) of complete
+        lines from all export files.
+        """
+        batch = []
+        for name in self.files():
+            try:
+                path, inode, offset = self.source(name)
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break  # still being written
+                        offset += len(line)
+                        batch.append((name, inode, offset, line))
+                        if len(batch) >= batch_size:
+                            return batch
+            except OSError as e:
+                LOG.warning('Failed to read export file %s: %s', name, e)
+        return batch
+
+    def alert(self, line, environment='Production', zabbix_severity=False):
+        """
+        Returns the alert for an export line, the problem event id it belongs
+        to and whether it is a recovery. The alert is None for events that
+        can't be mapped to an alert.
+        """
+        try:
+            event = json.loads(line.decode('utf-8'))
+            if event.get('value', 1) == 1:
+                status = 'PROBLEM'
+                problem = {k: event[k] for k in PROBLEM_FIELDS if k in event}
+                self.problems[str(event['eventid'])] = problem
+            else:
+                status = 'OK'
+                # forgotten once the recovery is delivered, see ingest()
+                problem = self.problems.get(str(event['p_eventid']))
+                if not problem:
+                    LOG.debug('Skipping recovery of unknown problem %s', event['p_eventid'])
+                    return None, None, False
+            macros = problem_macros(problem, status, environment, zabbix_severity)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            LOG.warning('Skipping invalid export line: %s', e)
+            return None, None, False
+        return make_alert(macros, raw_data=line.decode('utf-8')), str(problem['eventid']), status == 'OK'
+
+    def prune(self):
+
+        if len(self.problems) > self.max_problems:
+            oldest = sorted(self.problems, key=int)[:len(self.problems) - self.max_problems]
+            LOG.warning('Forgetting %d open problems, their recoveries will be skipped', len(oldest))
+            for eventid in oldest:
+                del self.problems[eventid]
+
+    def commit(self, positions, now=None):
+        """
+        Advance the file positions, and write the checkpoint if the last one
+        was written more than COMMIT_INTERVAL ago. See flush().
+        """
+        if positions:
+            self.positions.update(positions)
+            self._dirty = True
+        now = now or time.monotonic()
+        if self._dirty and now - self._last_commit >= COMMIT_INTERVAL:
+            self.flush()
+            self._last_commit = now
+
+    def flush(self):
+
+        if not self._dirty:
+            return
+        self.prune()
+        with open(self.checkpoint_path + '.tmp', 'w') as f:
+            json.dump({'positions': self.positions, 'problems': self.problems}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+        self._dirty = False
+
+
+def ingest(reader, options, executor, batch_size=BATCH_SIZE, pool_size=None, environment='Production', zabbix_severity=False):
+    """
+    Forward one batch of export events. Events for the same problem are sent
+    in order; others concurrently. Returns the number of lines processed and
+    whether all of them were delivered.
+    """
+    batch = reader.read(batch_size)
+    if not batch:
+        return 0, True
+
+    queues = {}
+    alerts = {}
+    recoveries = {}
+    for i, (_, _, _, line) in enumerate(batch):
+        alert, eventid, recovery = reader.alert(line, environment, zabbix_severity)
+        if alert:
+            alerts[i] = alert
+            queues.setdefault(eventid, []).append(i)
+            if recovery:
+                recoveries[i] = eventid
+
+    def send_in_order(indexes):
+        results = {}
+        for i in indexes:
+            results[i] = deliver(options, {'sendto': options['endpoint'], 'alert': alerts[i]}, pool_size=pool_size)
+            if not results[i]:
+                break
+        return results
+
+    results = {}
+    for r in executor.map(send_in_order, queues.values()):
+        results.update(r)
+    for i, eventid in recoveries.items():
+        if results.get(i):
+            reader.problems.pop(eventid, None)
+
+    # advance each file over its delivered prefix only
+    positions = {}
+    blocked = set()
+    for i, (name, inode, offset, _) in enumerate(batch):
+        if name in blocked:
+            continue
+        if i in alerts and not results.get(i):
+            blocked.add(name)
+            continue
+        positions[name] = {'inode': inode, 'offset': offset}
+    reader.commit(positions)
+    return len(batch), not blocked
+
+
+def follow(reader, options, workers=8, interval=0.2, batch_size=BATCH_SIZE, environment='Production', zabbix_severity=False):
+
+    retry_delay = interval
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                count, delivered = ingest(reader, options, executor, batch_size, workers, environment, zabbix_severity)
+                if count:
+                    LOG.debug('Processed %d export events', count)
+                if delivered and count >= batch_size:
+                    continue  # catching up
+                reader.commit({})  # positions held back by COMMIT_INTERVAL
+                # back off while Alerta is unavailable
+                retry_delay = interval if delivered else min(retry_delay * 2, 60.0)
+                time.sleep(retry_delay)
+    finally:
+        reader.flush()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+    zac fleet: configure the Alerta integration on many Zabbix servers
+
+    The inventory is an ini file with a section for each Zabbix server, eg.
+
+        [DEFAULT]
+        user = Admin
+        sendto = production
+
+        [zabbix-eu1]
+        server = https://zabbix-eu1.example.com
+        password_env = ZABBIX_EU1_PASSWORD
+
+    Servers are configured concurrently, each with its own timeout, and the
+    result for every server is shown in a summary table.
+"""
+
+import configparser
+import io
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from zabbix_config import ZabbixConfig
+
+OK = 'ok'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+
+INVENTORY_DEFAULTS = {
+    'user': 'Admin',
+    'password': '',
+    'password_env': '',
+    'sendto': '',
+    'trapper': '',
+    'webhook': '',
+    'json': 'no',
+    'zabbix_severity': 'no',
+    'timeout': '30',
+}
+
+
+class ThreadOutput:
+    """
+    Capture what each provisioning thread prints, so that output from
+    different servers is not interleaved.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = io.StringIO()
+        return self.local.buffer
+
+    def write(self, data):
+        return (getattr(self.local, 'buffer', None) or self.stream).write(data)
+
+    def flush(self):
+        (getattr(self.local, 'buffer', None) or self.stream).flush()
+
+
+def read_inventory(path):
+
+    inventory = configparser.ConfigParser(defaults=INVENTORY_DEFAULTS, interpolation=None)
+    if not inventory.read(os.path.expanduser(path)):
+        raise ValueError('cannot read inventory file %s' % path)
+
+    servers = []
+    for name in inventory.sections():
+        section = inventory[name]
+        if not section.get('server'):
+            raise ValueError('no server for [%s] in inventory file %s' % (name, path))
+        servers.append(
+            {
+                'name': name,
+                'server': section['server'],
+                'user': section['user'],
+                'password': section['password'] or os.environ.get(section['password_env'] or '', ''),
+                'sendto': section['sendto'],
+                'trapper': section['trapper'],
+                'webhook': section['webhook'] or None,
+                'use_json': section.getboolean('json'),
+                'zabbix_severity': section.getboolean('zabbix_severity'),
+                'timeout': section.getfloat('timeout'),
+            }
+        )
+    return servers
+
+
+def provision(server, test=False, default_password='zabbix'):
+    """
+    Create the Alerta action on one Zabbix server, and test it if asked.
+    Returns (result, message).
+    """
+    from zabbix_alerta import get_options
+
+    try:
+        zc = ZabbixConfig(
+            server['server'], server['user'], server['password'] or default_password, timeout=server['timeout']
+        )
+        zc.create_action(
+            server['sendto'],
+            server['server'],
+            server['zabbix_severity'],
+            webhook_url=server['webhook'],
+            use_json=server['use_json'],
+        )
+        if test:
+            options = get_options(server['sendto'])
+            zc.test_action(
+                server['trapper'] or server['server'].split('://')[-1].split('/')[0].split(':')[0],
+                options['endpoint'],
+                options['key'],
+                timeout=server['timeout'],
+            )
+        return OK, 'Zabbix API %s' % zc.zapi.api_version()
+    except TimeoutError as e:
+        return TIMEOUT, str(e)
+    except (Exception, SystemExit) as e:
+        return FAILED, str(e) or e.__class__.__name__
+
+
+def run(servers, workers=8, test=False, default_password='zabbix'):
+    """
+    Provision all servers with at most `workers` at a time. Returns a list
+    of (server, result, message, elapsed, output) in inventory order.
+    """
+    output = ThreadOutput(sys.stdout)
+
+    def job(server):
+        buffer = output.capture()
+        started = time.monotonic()
+        result, message = provision(server, test, default_password)
+        return server, result, message, time.monotonic() - started, buffer.getvalue()
+
+    stdout, sys.stdout = sys.stdout, output
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(job, servers))
+    finally:
+        sys.stdout = stdout
+
+
+def summary(results):
+
+    rows = [('NAME', 'SERVER', 'RESULT', 'TIME', 'MESSAGE')]
+    rows += [(s['name'], s['server'], result, '%.1fs' % elapsed, message) for s, result, message, elapsed, _ in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)) + '  ' + row[4] for row in rows]
+    failed = sum(1 for _, result, _, _, _ in results if result != OK)
+    lines.append('%d servers configured, %d failed' % (len(results) - failed, failed))
+    return '\n'.join(lines)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+    zac inventory: local index of Zabbix host inventory for alert enrichment
+
+    Host inventory fields, host groups and tags are exported from the Zabbix
+    API into a hash table file keyed by host name and visible name. Alert
+    script processes map the file and look up a host without any network
+    request. A new index is written next to the old one and renamed over
+    it, so readers never block and keep the index they opened until then.
+
+    File layout, integers little-endian:
+
+        header   magic, version, slot count, name count
+        slots    (crc32 of name, record offset, record length) per slot
+        records  JSON [name, {attribute: value}]
+"""
+
+import json
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = b'ZXIX'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')
+SLOT = struct.Struct('<III')
+
+# inventory field[=attribute name]
+DEFAULT_FIELDS = 'location,os,poc_1_name=owner,contact'
+
+CHUNK_SIZE = 500
+
+
+def parse_fields(fields):
+    """
+    Returns (inventory field, attribute) pairs for "field[=attribute],...".
+    """
+    pairs = []
+    for item in fields.split(','):
+        if item.strip():
+            field, _, attribute = item.partition('=')
+            pairs.append((field.strip(), attribute.strip() or field.strip()))
+    return pairs
+
+
+def host_attributes(host, fields):
+
+    attributes = {}
+    inventory = host.get('inventory') or {}
+    for field, attribute in fields:
+        if inventory.get(field):
+            attributes[attribute] = inventory[field]
+    groups = host.get('hostgroups') or host.get('groups') or []
+    if groups:
+        attributes['hostGroups'] = ', '.join(sorted(g['name'] for g in groups))
+    tags = host.get('tags') or []
+    if tags:
+        attributes['hostTags'] = ', '.join(sorted('%s:%s' % (t['tag'], t['value']) if t['value'] else t['tag'] for t in tags))
+    return attributes
+
+
+def export_hosts(zapi, version, fields, chunk_size=CHUNK_SIZE):
+    """
+    Yield the attributes of every host, fetched in chunks of host ids so
+    that large installations are not loaded in one request.
+    """
+    params = {
+        'output': ['hostid', 'host', 'name'],
+        'selectInventory': [field for field, _ in fields] or ['hostid'],
+    }
+    if version >= (6, 2):
+        params['selectHostGroups'] = ['name']
+    else:
+        params['selectGroups'] = ['name']
+    if version >= (4, 2):
+        params['selectTags'] = ['tag', 'value']
+
+    hostids = [h['hostid'] for h in zapi.host.get(output=['hostid'])]
+    for i in range(0, len(hostids), chunk_size):
+        for host in zapi.host.get(hostids=hostids[i:i + chunk_size], **params):
+            yield host, host_attributes(host, fields)
+
+
+def write_index(path, entries):
+    """
+    Write {name: attributes} as an index at path, replacing it atomically.
+    """
+    slot_count = 1 << max(4, (2 * len(entries)).bit_length())  # at most half full
+    slots = [(0, 0, 0)] * slot_count
+    base = HEADER.size + SLOT.size * slot_count
+    data = bytearray()
+    for name, attributes in sorted(entries.items()):
+        record = json.dumps([name, attributes], separators=(',', ':'), sort_keys=True).encode('utf-8')
+        h = zlib.crc32(name.encode('utf-8'))
+        i = h & (slot_count - 1)
+        while slots[i][2]:
+            i = (i + 1) & (slot_count - 1)
+        slots[i] = (h, base + len(data), len(record))
+        data += record
+
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, slot_count, len(entries)))
+        f.write(b''.join(SLOT.pack(*slot) for slot in slots))
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Index:
+    def __init__(self, path):
+
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.stamp = (st.st_dev, st.st_ino)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.slot_count, self.count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a host inventory index' % path)
+
+    def slot(self, i):
+        return SLOT.unpack_from(self.map, HEADER.size + i * SLOT.size)
+
+    def record(self, offset, length):
+        return json.loads(self.map[offset:offset + length].decode('utf-8'))
+
+    def get(self, name):
+
+        h = zlib.crc32(name.encode('utf-8'))
+        i = h & (self.slot_count - 1)
+        while True:
+            slot_hash, offset, length = self.slot(i)
+            if not length:
+                return None
+            if slot_hash == h:
+                record_name, attributes = self.record(offset, length)
+                if record_name == name:
+                    return attributes
+            i = (i + 1) & (self.slot_count - 1)
+
+    def __iter__(self):
+        for i in range(self.slot_count):
+            _, offset, length = self.slot(i)
+            if length:
+                yield tuple(self.record(offset, length))
+
+
+_indexes = {}
+
+
+def lookup(path, name):
+    """
+    Returns the inventory attributes of a host, or None. The index is opened
+    once per process and again only after it has been replaced.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    index = _indexes.get(path)
+    if not index or index.stamp != (st.st_dev, st.st_ino):
+        index = _indexes[path] = Index(path)
+    return index.get(name)
+
+
+def refresh(zapi, path, version, fields=DEFAULT_FIELDS):
+    """
+    Export host inventory to the index at path. The index is only replaced
+    if a host was added, changed or removed. Returns the number of hosts
+    and of names added, changed and removed.
+    """
+    fields = parse_fields(fields)
+    entries = {}
+    hosts = 0
+    for host, attributes in export_hosts(zapi, version, fields):
+        hosts += 1
+        entries[host['host']] = attributes
+        if host.get('name'):
+            entries[host['name']] = attributes
+
+    try:
+        current = dict(Index(path))
+    except (OSError, ValueError):
+        current = None
+
+    old = current or {}
+    added = len(entries.keys() - old.keys())
+    removed = len(old.keys() - entries.keys())
+    changed = sum(1 for name in entries.keys() & old.keys() if entries[name] != old[name])
+    if current is None or added or removed or changed:
+        write_index(path, entries)
+    return hosts, added, changed, removed
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+    zabbix-alerta metrics: per-phase timings and outcome counters
+
+    Metrics are only collected when a profile sets `metrics_textfile` or
+    `metrics_statsd`, or a long-running command serves them with
+    `--metrics-listen`. The alert script is short-lived, so its counters are
+    merged into a Prometheus textfile shared by all alert script processes
+    or sent to StatsD, with DogStatsD tags, in one UDP packet per alert.
+"""
+
+import atexit
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import zabbix_alerta
+
+PREFIX = 'zabbix_alerta'
+
+PHASE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 65536)
+
+METRICS = {
+    'alerts_total': ('counter', 'Alerts forwarded by outcome', None),
+    'phase_seconds': ('histogram', 'Time spent in each phase of forwarding an alert', PHASE_BUCKETS),
+    'payload_bytes': ('histogram', 'Size of the alerts sent to Alerta', SIZE_BUCKETS),
+}
+
+# textfile writes from long-running processes are batched
+FLUSH_INTERVAL = 1.0
+
+STATSD_PORT = 8125
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts.., +Inf count, sum]
+
+    def incr(self, name, labels, n=1):
+        with self.lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, labels, value):
+
+        buckets = METRICS[name][2]
+        with self.lock:
+            key = (name, labels)
+            if key not in self.histograms:
+                self.histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            h = self.histograms[key]
+            h[next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))] += 1
+            h[-1] += value
+
+    def merge(self, other):
+
+        with self.lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, value in other.histograms.items():
+                h = self.histograms.setdefault(key, [0] * len(value))
+                for i, v in enumerate(value):
+                    h[i] += v
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def dump(self):
+        with self.lock:
+            return {
+                'counters': [[name, list(labels), v] for (name, labels), v in self.counters.items()],
+                'histograms': [[name, list(labels), v] for (name, labels), v in self.histograms.items()],
+            }
+
+    @classmethod
+    def load(cls, data):
+
+        registry = cls()
+        for name, labels, value in data.get('counters', []):
+            registry.counters[(name, tuple(map(tuple, labels)))] = value
+        for name, labels, value in data.get('histograms', []):
+            if name in METRICS and len(value) == len(METRICS[name][2]) + 2:
+                registry.histograms[(name, tuple(map(tuple, labels)))] = value
+        return registry
+
+    def render(self):
+        """
+        Prometheus text exposition format.
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = []
+        for metric, (kind, help, buckets) in METRICS.items():
+            name = '%s_%s' % (PREFIX, metric)
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind)]
+            if kind == 'counter':
+                lines += ['%s%s %s' % (name, format_labels(labels), v) for (m, labels), v in counters if m == metric]
+                continue
+            for (m, labels), h in histograms:
+                if m != metric:
+                    continue
+                total = 0
+                for bound, count in zip(buckets + ('+Inf',), h):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', str(bound)),)), total))
+                lines.append('%s_sum%s %r' % (name, format_labels(labels), h[-1]))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), total))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{%s}' % ','.join('%s="%s"' % (k, v) for (k, _), v in zip(labels, escaped))
+
+
+# everything recorded by this process, for the scrape endpoint
+REGISTRY = Registry()
+
+_textfiles = {}  # path -> [registry not yet written, last write]
+_textfiles_lock = threading.Lock()
+
+
+def measure(options, alert, status, timer):
+    """
+    Returns a registry with the metrics for one forwarded alert.
+    """
+    profile = options['profile'] or ''
+    severity = alert.get('severity') or ''
+    registry = Registry()
+    registry.incr(
+        'alerts_total',
+        (('profile', profile), ('endpoint', options['endpoint']), ('severity', severity), ('status', status)),
+    )
+    for phase, seconds in timer.phases.items():
+        registry.observe('phase_seconds', (('profile', profile), ('phase', phase)), seconds)
+    registry.observe(
+        'phase_seconds', (('profile', profile), ('phase', 'total')), time.perf_counter() - timer.started
+    )
+    registry.observe('payload_bytes', (('profile', profile),), len(json.dumps(alert, default=str)))
+    return registry
+
+
+def record(options, alert, status, timer):
+    """
+    Record a forwarded alert. Never raises, metrics must not stop alerts.
+    """
+    registry = measure(options, alert, status, timer)
+    REGISTRY.merge(registry)
+
+    if options['metrics_textfile']:
+        path = os.path.expanduser(options['metrics_textfile'])
+        with _textfiles_lock:
+            if path not in _textfiles:
+                _textfiles[path] = [Registry(), 0.0]
+            pending = _textfiles[path]
+            pending[0].merge(registry)
+            due = time.monotonic() - pending[1] >= FLUSH_INTERVAL
+        if due:
+            flush_textfile(path)
+
+    if options['metrics_statsd']:
+        try:
+            send_statsd(options['metrics_statsd'], registry)
+        except (OSError, ValueError):
+            pass
+
+
+def flush_textfile(path):
+    """
+    Add the metrics not yet written to the counters kept in `path`.json and
+    write them to `path`. The file is replaced atomically so the node
+    exporter textfile collector never reads a partial file.
+    """
+    with _textfiles_lock:
+        pending = _textfiles.get(path)
+        if not pending or not (pending[0].counters or pending[0].histograms):
+            return
+        registry, pending[0], pending[1] = pending[0], Registry(), time.monotonic()
+
+    try:
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path + '.json') as f:
+                    total = Registry.load(json.load(f))
+            except (OSError, ValueError):
+                total = Registry()
+            total.merge(registry)
+
+            tmp = '%s.%d' % (path, os.getpid())
+            with open(tmp + '.json', 'w') as f:
+                json.dump(total.dump(), f)
+            os.replace(tmp + '.json', path + '.json')
+            with open(tmp, 'w') as f:
+                f.write(total.render())
+            os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+@atexit.register
+def flush_all():
+    for path in list(_textfiles):
+        flush_textfile(path)
+
+
+_statsd = {}
+
+
+def send_statsd(address, registry):
+
+    if address not in _statsd:
+        host, _, port = address.rpartition(':')
+        _statsd[address] = (socket.socket(socket.AF_INET, socket.SOCK_DGRAM), (host or 'localhost', int(port or STATSD_PORT)))
+    sock, addr = _statsd[address]
+
+    def tags(labels):
+        return '|#' + ','.join('%s:%s' % (k, str(v).replace(',', '_').replace('|', '_')) for k, v in labels)
+
+    lines = ['%s.%s:%d|c%s' % (PREFIX, name[:-6], n, tags(labels)) for (name, labels), n in registry.counters.items()]
+    for (name, labels), h in registry.histograms.items():
+        if name == 'phase_seconds':
+            lines.append('%s.phase:%.3f|ms%s' % (PREFIX, h[-1] * 1000, tags(labels)))
+        else:
+            lines.append('%s.%s:%d|h%s' % (PREFIX, name, h[-1], tags(labels)))
+    sock.sendto('\n'.join(lines).encode('utf-8'), addr)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        data = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(address):
+    """
+    Serve metrics for scraping at http://address/metrics from a background
+    thread, and start collecting them for every alert forwarded.
+    """
+    host, _, port = address.rpartition(':')
+    server = MetricsServer((host, int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    zabbix_alerta.collect_metrics = True
+    return server
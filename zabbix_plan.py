@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+    zac plan/apply: converge the Zabbix configuration for Alerta
+
+    The desired media type, Admin user media and action are compared with
+    the current ones, fetched with filtered get calls, and only the objects
+    that differ are created or updated. Running apply again makes no changes.
+"""
+
+from collections import namedtuple
+
+from zabbix_config import (ENABLED, NIWAHD, action_params, script_mediatype,
+                           webhook_mediatype)
+
+CREATE = 'create'
+UPDATE = 'update'
+UNCHANGED = 'unchanged'
+
+MEDIA_FIELDS = ['mediatypeid', 'sendto', 'active', 'severity', 'period']
+
+Change = namedtuple('Change', 'op kind name fields')
+
+
+def normalize(value):
+    """
+    Zabbix returns all values as strings and lists in its own order.
+    """
+    if isinstance(value, list):
+        return sorted(normalize(v) for v in value)
+    if isinstance(value, dict):
+        return sorted((k, normalize(v)) for k, v in value.items())
+    return str(value)
+
+
+def diff(desired, current, ignore=()):
+    """
+    Returns the desired fields that differ from the current object. Fields
+    the server does not return are not supported by its API version.
+    """
+    return [k for k, v in desired.items() if k not in ignore and k in current and normalize(v) != normalize(current[k])]
+
+
+def operation_key(operation):
+
+    opmessage = operation.get('opmessage') or {}
+    return (
+        str(operation['operationtype']),
+        str(opmessage.get('default_msg')),
+        str(opmessage.get('mediatypeid')),
+        opmessage.get('subject'),
+        opmessage.get('message'),
+        sorted(str(u['userid']) for u in operation.get('opmessage_usr') or []),
+    )
+
+
+def operations_differ(desired, current):
+    return sorted(map(operation_key, desired)) != sorted(map(operation_key, current or []))
+
+
+class Planner:
+    def __init__(self, zc, sendto, web_url, use_zabbix_severity=False, webhook_url=None, use_json=False):
+
+        self.zc = zc
+        self.zapi = zc.zapi
+        self.sendto = sendto
+        self.web_url = web_url
+        self.use_zabbix_severity = use_zabbix_severity
+        self.webhook_url = webhook_url
+        self.use_json = use_json
+
+    def mediatype(self, execute=False):
+
+        if self.webhook_url:
+            name_field = 'name'
+            desired = webhook_mediatype(self.webhook_url, self.web_url, self.use_zabbix_severity)
+        else:
+            name_field = self.zc.mediatype_name_field
+            desired = script_mediatype(name_field)
+        name = desired[name_field]
+
+        current = self.zapi.mediatype.get(output='extend', filter={name_field: name})
+        if not current:
+            media_id = self.zapi.mediatype.create(**desired)['mediatypeids'][0] if execute else None
+            return Change(CREATE, 'media type', name, []), media_id
+
+        current = current[0]
+        fields = diff(desired, current)
+        if fields and execute:
+            self.zapi.mediatype.update(mediatypeid=current['mediatypeid'], **{k: desired[k] for k in fields})
+        return Change(UPDATE if fields else UNCHANGED, 'media type', name, fields), current['mediatypeid']
+
+    def user_media(self, media_id, execute=False):
+
+        users = self.zapi.user.get(
+            output=['userid'], filter={self.zc.user_alias_field: 'Admin'}, selectMedias=MEDIA_FIELDS
+        )
+        user = users[0]
+        desired = {
+            'mediatypeid': media_id,
+            'sendto': self.sendto,
+            'active': ENABLED,
+            'severity': NIWAHD,
+            'period': '1-7,00:00-24:00',
+        }
+        name = 'Admin -> %s' % self.sendto
+
+        medias = [{k: m[k] for k in MEDIA_FIELDS if k in m} for m in user.get('medias') or []]
+        current = [m for m in medias if str(m['mediatypeid']) == str(media_id) and m.get('sendto') == self.sendto]
+        others = [m for m in medias if m not in current]
+        if len(current) == 1 and not diff(desired, current[0]):
+            return Change(UNCHANGED, 'user media', name, []), user['userid']
+
+        if current:
+            change = Change(UPDATE, 'user media', name, diff(desired, current[0]) or ['duplicates'])
+        else:
+            change = Change(CREATE, 'user media', name, [])
+        if execute:
+            self.update_medias(user['userid'], others + [desired])
+        return change, user['userid']
+
+    def update_medias(self, user_id, medias):
+
+        if self.zc.version < (4, 0):
+            self.zapi.user.updatemedia(users={'userid': user_id}, medias=medias)
+        elif self.zc.version < (5, 2):
+            self.zapi.user.update(userid=user_id, user_medias=medias)
+        else:
+            self.zapi.user.update(userid=user_id, medias=medias)
+
+    def action(self, media_id, user_id, execute=False):
+
+        desired = action_params(media_id, user_id, self.web_url, self.use_zabbix_severity, self.use_json)
+        name = desired['name']
+
+        current = self.zapi.action.get(
+            output='extend', filter={'name': name}, selectOperations='extend', selectRecoveryOperations='extend'
+        )
+        if not current:
+            if execute:
+                self.zapi.action.create(**desired)
+            return Change(CREATE, 'action', name, [])
+
+        current = current[0]
+        fields = diff(desired, current, ignore=('operations', 'recovery_operations'))
+        for ops in ('operations', 'recovery_operations'):
+            if operations_differ(desired[ops], current.get(ops)):
+                fields.append(ops)
+        if fields and execute:
+            self.zapi.action.update(actionid=current['actionid'], **{k: desired[k] for k in fields})
+        return Change(UPDATE if fields else UNCHANGED, 'action', name, fields)
+
+    def run(self, execute=False):
+        """
+        Returns the changes needed, and makes them if execute is True.
+        """
+        mediatype, media_id = self.mediatype(execute)
+        user_media, user_id = self.user_media(media_id, execute)
+        action = self.action(media_id, user_id, execute)
+        return [mediatype, user_media, action]
+
+    def plan(self):
+        return self.run(execute=False)
+
+    def apply(self):
+        return self.run(execute=True)
+
+
+def format_change(change, applied=False):
+
+    if change.op == UNCHANGED:
+        return '  %s "%s" is up to date' % (change.kind, change.name)
+    symbol = '+' if change.op == CREATE else '~'
+    verb = {CREATE: 'created' if applied else 'create', UPDATE: 'updated' if applied else 'update'}[change.op]
+    fields = ': %s' % ', '.join(change.fields) if change.fields else ''
+    return '%s %s %s "%s"%s' % (symbol, verb, change.kind, change.name, fields)
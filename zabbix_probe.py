@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+    zac probe: measure end-to-end alert delivery latency
+
+    Test values are sent to a trapper item at a fixed rate. Each value
+    triggers a problem event whose name contains the value, so it can be
+    followed through every stage of the pipeline:
+
+        send -> history -> event -> alert (Zabbix) -> alerta
+
+    Stage times are taken from the clocks recorded by Zabbix and Alerta, so
+    the hosts should be time synchronised. Polling backs off while nothing
+    is happening and speeds up again as soon as a probe advances.
+"""
+
+import calendar
+import math
+import threading
+import time
+import uuid
+
+from pyzabbix import ZabbixAPIException
+
+from zabbix_config import (ALLOW_MANUAL_CLOSE, ENABLED,
+                           GENERATE_MULTIPLE_EVENTS, INFORMATION, TEXT,
+                           ZABBIX_TRAPPER, trapper_send)
+
+PROBE_KEY = 'probe.alerta'
+PROBE_NAME = 'Alerta probe {ITEM.VALUE}'
+
+STAGES = ['send', 'history', 'event', 'alert', 'alerta']
+
+# Zabbix alert status
+ALERT_SENT = '1'
+
+# recent changes of the probe alert read from Alerta on each poll
+HISTORY_PAGE_SIZE = 1000
+
+MIN_POLL_INTERVAL = 0.1
+MAX_POLL_INTERVAL = 2.0
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a list of numbers.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(p / 100.0 * len(values)) - 1, 0)]
+
+
+def epoch(dt):
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+class Probe:
+    def __init__(self, zapi, api, trapper, host='Zabbix server'):
+
+        self.zapi = zapi
+        self.api = api
+        self.trapper = trapper
+        self.host = host
+
+        self.item_id = None
+        self.trigger_id = None
+        self.samples = {}  # value -> {stage: time}
+        self.eventids = {}  # eventid -> value
+        self.error = None
+        self.lock = threading.Lock()
+
+    def setup(self):
+
+        host_id = self.zapi.host.get(output=['hostid'], filter={'host': self.host})[0]['hostid']
+        items = self.zapi.item.get(output=['itemid'], hostids=host_id, filter={'key_': PROBE_KEY})
+        if items:
+            self.item_id = items[0]['itemid']
+        else:
+            self.item_id = self.zapi.item.create(
+                name='Alerta latency probe',
+                type=ZABBIX_TRAPPER,
+                key_=PROBE_KEY,
+                value_type=TEXT,
+                hostid=host_id,
+                status=ENABLED,
+            )['itemids'][0]
+
+        triggers = self.zapi.trigger.get(output=['triggerid'], itemids=self.item_id)
+        if triggers:
+            self.trigger_id = triggers[0]['triggerid']
+        else:
+            self.trigger_id = self.zapi.trigger.create(
+                description=PROBE_NAME,
+                expression='{%s:%s.diff()}>0' % (self.host, PROBE_KEY),
+                type=GENERATE_MULTIPLE_EVENTS,
+                priority=INFORMATION,
+                status=ENABLED,
+                manual_close=ALLOW_MANUAL_CLOSE,
+            )['triggerids'][0]
+
+    def clean_up(self):
+
+        try:
+            self.zapi.trigger.delete(self.trigger_id)
+            self.zapi.item.delete(self.item_id)
+        except ZabbixAPIException:
+            pass
+
+    def inject(self, count, rate, run_id):
+
+        try:
+            for i in range(count):
+                value = 'probe-%s-%d' % (run_id, i)
+                with self.lock:
+                    self.samples[value] = {'send': time.time()}
+                trapper_send(self.trapper, self.host, PROBE_KEY, value)
+                time.sleep(1.0 / rate)
+        except Exception as e:
+            self.error = e
+
+    def record(self, value, stage, when):
+
+        with self.lock:
+            if value in self.samples and stage not in self.samples[value]:
+                self.samples[value][stage] = when
+                return True
+        return False
+
+    def poll(self, since):
+        """
+        Check every stage once. Returns True if any probe advanced.
+        """
+        advanced = False
+        prefix = PROBE_NAME.replace('{ITEM.VALUE}', '')
+
+        for h in self.zapi.history.get(
+            itemids=[self.item_id], history=TEXT, time_from=since, output=['clock', 'ns', 'value']
+        ):
+            advanced |= self.record(h['value'], 'history', int(h['clock']) + int(h['ns']) / 1e9)
+
+        for e in self.zapi.event.get(
+            objectids=self.trigger_id, time_from=since, value=1, output=['eventid', 'clock', 'ns', 'name']
+        ):
+            value = e['name'][len(prefix):]
+            self.eventids[e['eventid']] = value
+            advanced |= self.record(value, 'event', int(e['clock']) + int(e['ns']) / 1e9)
+
+        with self.lock:
+            waiting = [eventid for eventid, value in self.eventids.items() if 'alert' not in self.samples.get(value, {})]
+        if waiting:
+            for a in self.zapi.alert.get(eventids=waiting, output=['eventid', 'clock', 'status']):
+                if a['status'] == ALERT_SENT:
+                    advanced |= self.record(self.eventids[a['eventid']], 'alert', int(a['clock']))
+
+        # every probe updates the same Alerta alert, which keeps a history entry per value
+        if self.pending():
+            for h in self.api.get_history(
+                query=[('resource', self.host), ('event', PROBE_KEY)], page_size=HISTORY_PAGE_SIZE
+            ):
+                if h.update_time:
+                    advanced |= self.received(h.value, epoch(h.update_time))
+        return advanced
+
+    def received(self, value, when):
+        """
+        Record the Alerta receive time of a probe of this run, unless it is
+        older than the probe was sent and so left over from before.
+        """
+        with self.lock:
+            sample = self.samples.get(value)
+            if not sample or when < sample['send']:
+                return False
+        return self.record(value, 'alerta', when)
+
+    def pending(self):
+
+        with self.lock:
+            return [value for value, stages in self.samples.items() if 'alerta' not in stages]
+
+    def run(self, count=10, rate=1.0, timeout=120, progress=None):
+        """
+        Send `count` probes at `rate` per second and follow them until they
+        reach Alerta or `timeout` seconds after the last one was sent.
+        """
+        since = int(time.time()) - 1
+        run_id = uuid.uuid4().hex[:8]
+        injector = threading.Thread(target=self.inject, args=(count, rate, run_id), daemon=True)
+        injector.start()
+
+        interval = MIN_POLL_INTERVAL
+        deadline = None
+        while True:
+            if self.poll(since):
+                interval = MIN_POLL_INTERVAL
+                if progress:
+                    progress(len(self.samples) - len(self.pending()), count)
+            else:
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+            if not injector.is_alive():
+                if self.error:
+                    raise self.error
+                deadline = deadline or time.time() + timeout
+                if not self.pending() or time.time() > deadline:
+                    break
+            time.sleep(interval)
+        return self.samples
+
+
+def latencies(samples):
+    """
+    Returns the latency of each stage from the previous one, and in total,
+    for all probes that reached the stage.
+    """
+    result = {}
+    for previous, stage in zip(STAGES, STAGES[1:]):
+        result['%s -> %s' % (previous, stage)] = [
+            s[stage] - s[previous] for s in samples.values() if stage in s and previous in s
+        ]
+    result['total'] = [s['alerta'] - s['send'] for s in samples.values() if 'alerta' in s]
+    return result
+
+
+def report(samples):
+
+    lines = ['%-20s %7s %9s %9s %9s' % ('STAGE', 'COUNT', 'P50', 'P95', 'P99')]
+    for stage, values in latencies(samples).items():
+        cells = ['%8.3fs' % percentile(values, p) if values else '%9s' % '-' for p in (50, 95, 99)]
+        lines.append('%-20s %7d %s' % (stage, len(values), ' '.join(cells)))
+    return '\n'.join(lines)
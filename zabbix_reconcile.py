@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""
+    zac reconcile: close or reopen Alerta alerts that disagree with Zabbix
+
+    Recovery messages that never reach Alerta leave alerts open forever. The
+    reconciler keeps the set of open Zabbix problems up to date from an event
+    id watermark, so each cycle only asks the Zabbix API for events since the
+    last one, and compares it with the open Zabbix alerts in Alerta. Every
+    `full_interval` seconds the open problems are fetched again in full.
+
+    Event ids are only unique within one Zabbix server, so only alerts
+    with the origin of that server's alert script are compared, by default
+    zabbix/<this host> for a reconciler run on the Zabbix server.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+
+from zabbix_alerta import cache_dir
+
+PAGE_SIZE = 1000
+CHUNK_SIZE = 500
+FULL_INTERVAL = 3600
+
+# event source and object for trigger events
+TRIGGERS = 0
+TRIGGER = 0
+
+OPEN_STATUS = ('open', 'ack')
+CLOSED_STATUS = ('closed', 'expired')
+NORMAL_SEVERITY = ('normal', 'ok', 'cleared')
+
+LOG = logging.getLogger('zabbix-alerta')
+
+
+def chunks(items, size=CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Reconciler:
+    def __init__(self, zapi, api, state_path=None, full_interval=FULL_INTERVAL, page_size=PAGE_SIZE, origin=None):
+
+        self.zapi = zapi
+        self.api = api
+        self.origin = origin or 'zabbix/%s' % os.uname()[1]
+        self.state_path = state_path or os.path.join(
+            cache_dir(), 'reconcile-%s.json' % re.sub(r'[^\w.-]', '_', self.origin)
+        )
+        self.full_interval = full_interval
+        self.page_size = page_size
+
+        self.watermark = 0
+        self.problems = {}  # open problem event id -> trigger id
+        self.synced = 0
+        self.unmatched = set()  # open problems with no alert in Alerta
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self.watermark = state['watermark']
+            self.problems = state['problems']
+            self.synced = state['synced']
+            self.unmatched = set(state['unmatched'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(
+                {
+                    'watermark': self.watermark,
+                    'problems': self.problems,
+                    'synced': self.synced,
+                    'unmatched': sorted(self.unmatched),
+                },
+                f,
+            )
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def paged(self, method, **params):
+        """
+        Page through a Zabbix get method in event id order.
+        """
+        eventid_from = params.pop('eventid_from', None)
+        while True:
+            if eventid_from:
+                params['eventid_from'] = eventid_from
+            results = method(sortfield=['eventid'], sortorder='ASC', limit=self.page_size, **params)
+            yield from results
+            if len(results) < self.page_size:
+                return
+            eventid_from = int(results[-1]['eventid']) + 1
+
+    def sync_full(self, now):
+
+        latest = self.zapi.event.get(
+            source=TRIGGERS, object=TRIGGER, output=['eventid'], sortfield=['eventid'], sortorder='DESC', limit=1
+        )
+        watermark = int(latest[0]['eventid']) if latest else 0
+        self.problems = {
+            p['eventid']: p['objectid']
+            for p in self.paged(self.zapi.problem.get, source=TRIGGERS, object=TRIGGER, output=['eventid', 'objectid'])
+        }
+        self.watermark = max(watermark, max(map(int, self.problems), default=0))
+        self.unmatched.clear()
+        self.synced = now
+
+    def sync_incremental(self):
+
+        watermark = self.watermark
+        for p in self.paged(
+            self.zapi.problem.get,
+            source=TRIGGERS,
+            object=TRIGGER,
+            eventid_from=self.watermark + 1,
+            output=['eventid', 'objectid'],
+        ):
+            self.problems[p['eventid']] = p['objectid']
+            watermark = max(watermark, int(p['eventid']))
+
+        # recovery events name the trigger, not the problem, so recheck the
+        # open problems of those triggers only
+        recovered = set()
+        for e in self.paged(
+            self.zapi.event.get,
+            source=TRIGGERS,
+            object=TRIGGER,
+            value=0,
+            eventid_from=self.watermark + 1,
+            output=['eventid', 'objectid'],
+        ):
+            recovered.add(e['objectid'])
+            watermark = max(watermark, int(e['eventid']))
+
+        candidates = [eventid for eventid, objectid in self.problems.items() if objectid in recovered]
+        for chunk in chunks(candidates):
+            still_open = {p['eventid'] for p in self.zapi.problem.get(eventids=chunk, output=['eventid'])}
+            for eventid in chunk:
+                if eventid not in still_open:
+                    del self.problems[eventid]
+                    self.unmatched.discard(eventid)
+        self.watermark = watermark
+
+    def sync(self, now=None):
+        """
+        Update the open Zabbix problems. Returns True for a full sync.
+        """
+        now = now or time.time()
+        if not self.synced or now - self.synced >= self.full_interval:
+            self.sync_full(now)
+            return True
+        self.sync_incremental()
+        return False
+
+    def alerts(self, status):
+        """
+        Returns (id, eventId, severity) for alerts from this Zabbix server
+        in Alerta with the given status. All pages are fetched before any
+        alert is changed.
+        """
+        alerts = []
+        page = 1
+        while True:
+            query = [('origin', self.origin)] + [('status', s) for s in status]
+            results = self.api.get_alerts(query=query, page=page, page_size=self.page_size)
+            alerts += [(a.id, str(a.attributes.get('eventId', '')), a.severity) for a in results]
+            if len(results) < self.page_size:
+                return alerts
+            page += 1
+
+    def find_closed(self, eventids):
+
+        found = []
+        for chunk in chunks(eventids):
+            query = [('origin', self.origin)] + [('status', s) for s in CLOSED_STATUS]
+            query += [('attributes.eventId', eventid) for eventid in chunk]
+            for a in self.api.get_alerts(query=query, page_size=len(chunk)):
+                found.append((a.id, str(a.attributes.get('eventId', ''))))
+        return found
+
+    def reconcile(self, dry_run=False, now=None):
+        """
+        Returns the ids of the alerts closed and reopened.
+        """
+        self.sync(now)
+
+        closed = []
+        matched = set()
+        for id, eventid, severity in self.alerts(OPEN_STATUS):
+            if not eventid.isdigit() or severity in NORMAL_SEVERITY:
+                continue
+            matched.add(eventid)
+            # problems newer than the watermark are not known yet
+            if eventid not in self.problems and int(eventid) <= self.watermark:
+                LOG.info('Closing alert %s, problem %s resolved in Zabbix', id, eventid)
+                closed.append(id)
+                if not dry_run:
+                    self.api.action(id, 'close', text='Problem resolved in Zabbix')
+
+        # only look for closed alerts of problems not checked before
+        missing = set(self.problems) - matched - self.unmatched
+        reopened = []
+        for id, eventid in self.find_closed(sorted(missing, key=int)):
+            LOG.info('Reopening alert %s, problem %s still open in Zabbix', id, eventid)
+            reopened.append(id)
+            missing.discard(eventid)
+            if not dry_run:
+                self.api.action(id, 'open', text='Problem still open in Zabbix')
+        self.unmatched |= missing
+
+        self.save()
+        return closed, reopened
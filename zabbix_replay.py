@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+    zac replay: resend historical Zabbix trigger events to Alerta
+
+    The time range is split into slices that are paged through in parallel
+    with event.get, using the last event id seen as the watermark for the
+    next page. Events are sent in time order and the position reached is
+    checkpointed after each page so that an interrupted replay can resume.
+"""
+
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from zabbix_alerta import cache_dir, make_alert
+from zabbix_export import problem_macros
+from zabbix_spool import deliver
+
+PAGE_SIZE = 1000
+PREFETCH_PAGES = 2
+
+# fixed so that a checkpoint can be resumed with any number of workers
+SLICES = 32
+
+# event source and object for trigger events
+TRIGGERS = 0
+TRIGGER = 0
+
+RELATIVE_TIME_RE = re.compile(r'^(\d+)([smhdw])$')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+LOG = logging.getLogger('zabbix-alerta')
+
+
+def parse_time(value, now=None):
+    """
+    Parse epoch seconds, a relative time ago (eg. 2h, 30m, 7d) or an ISO 8601
+    local date and time.
+    """
+    now = now or time.time()
+    if value == 'now':
+        return int(now)
+    if value.isdigit():
+        return int(value)
+    match = RELATIVE_TIME_RE.match(value)
+    if match:
+        return int(now - int(match.group(1)) * UNITS[match.group(2)])
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise ValueError('invalid time "{}", use epoch seconds, eg. 2h ago or YYYY-MM-DDTHH:MM:SS'.format(value))
+
+
+def time_slices(time_from, time_till, count):
+
+    step = max((time_till - time_from + 1) // count, 1)
+    slices = []
+    start = time_from
+    while start <= time_till:
+        end = time_till if len(slices) == count - 1 else min(start + step - 1, time_till)
+        slices.append((start, end))
+        start = end + 1
+    return slices
+
+
+def event_to_problem(event, groups):
+    """
+    Reshape an event.get result like a real-time export problem event.
+    """
+    return {
+        'eventid': event['eventid'],
+        'objectid': event['objectid'],
+        'name': event['name'],
+        'severity': int(event.get('severity') or 0),
+        'hosts': event.get('hosts') or [],
+        'groups': sorted({g for h in event.get('hosts') or [] for g in groups.get(h['hostid'], [])}),
+        'tags': event.get('tags') or [],
+    }
+
+
+class Replay:
+    def __init__(self, zapi, options, time_from, time_till, checkpoint_path=None, page_size=PAGE_SIZE):
+
+        self.zapi = zapi
+        self.options = options
+        self.time_from = time_from
+        self.time_till = time_till
+        self.page_size = page_size
+        self.checkpoint_path = checkpoint_path or os.path.join(cache_dir(), 'replay-checkpoint.json')
+
+        self._groups = {}
+        self._groups_lock = threading.Lock()
+        self._open = {}  # trigger id -> event id of its last replayed problem
+
+    def count(self):
+
+        return int(
+            self.zapi.event.get(
+                source=TRIGGERS, object=TRIGGER, time_from=self.time_from, time_till=self.time_till, countOutput=True
+            )
+        )
+
+    def fetch(self, time_from, time_till, eventid_from=None):
+        """
+        Yield pages of events in the time slice, ordered by event id.
+        """
+        while True:
+            params = dict(
+                source=TRIGGERS,
+                object=TRIGGER,
+                time_from=time_from,
+                time_till=time_till,
+                output=['eventid', 'objectid', 'clock', 'value', 'name', 'severity', 'acknowledged'],
+                selectHosts=['hostid', 'host', 'name'],
+                selectTags=['tag', 'value'],
+                sortfield=['eventid'],
+                sortorder='ASC',
+                limit=self.page_size,
+            )
+            if eventid_from:
+                params['eventid_from'] = eventid_from
+            events = self.zapi.event.get(**params)
+            if not events:
+                return
+            self.load_groups(events)
+            yield events
+            if len(events) < self.page_size:
+                return
+            eventid_from = int(events[-1]['eventid']) + 1
+
+    def load_groups(self, events):
+
+        hostids = {h['hostid'] for e in events for h in e.get('hosts') or []}
+        with self._groups_lock:
+            hostids -= set(self._groups)
+        if not hostids:
+            return
+        hosts = self.zapi.host.get(hostids=sorted(hostids), output=['hostid'], selectGroups=['name'])
+        with self._groups_lock:
+            for hostid in hostids:
+                self._groups.setdefault(hostid, [])
+            for host in hosts:
+                self._groups[host['hostid']] = [g['name'] for g in host.get('groups') or []]
+
+    def alert(self, event, environment='Production', zabbix_severity=False):
+        """
+        Returns the alert for an event, or None for the recovery of a problem
+        that was not replayed. Recoveries have the event id of their problem,
+        so call this in event order for each trigger.
+        """
+        if event['value'] == '1':
+            status = 'PROBLEM'
+            self._open[event['objectid']] = event['eventid']
+        else:
+            status = 'OK'
+            eventid = self._open.pop(event['objectid'], None)
+            if not eventid:
+                return None
+            event = dict(event, eventid=eventid)
+        with self._groups_lock:
+            problem = event_to_problem(event, self._groups)
+        macros = problem_macros(problem, status, environment, zabbix_severity)
+        macros.append(('ack', 'Yes' if event.get('acknowledged') == '1' else 'No'))
+        return make_alert(macros, raw_data=json.dumps(event))
+
+    def checkpoint(self):
+        """
+        Returns the slice and event id to resume from, if the checkpoint is
+        for the same time range.
+        """
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+            if (checkpoint['from'], checkpoint['to']) == (self.time_from, self.time_till):
+                return checkpoint['slice'], checkpoint['eventid']
+        except (OSError, ValueError, KeyError):
+            pass
+        return 0, None
+
+    def reset(self):
+
+        try:
+            os.unlink(self.checkpoint_path)
+        except OSError:
+            pass
+
+    def commit(self, slice, eventid):
+
+        with open(self.checkpoint_path + '.tmp', 'w') as f:
+            json.dump({'from': self.time_from, 'to': self.time_till, 'slice': slice, 'eventid': eventid}, f)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def pages(self, fetch_workers=4):
+        """
+        Yield (slice, events) in time order. Later slices are fetched in the
+        background while earlier ones are being sent.
+        """
+        start_slice, eventid = self.checkpoint()
+        slices = time_slices(self.time_from, self.time_till, SLICES)
+        queues = [queue.Queue(maxsize=PREFETCH_PAGES) for _ in slices]
+        stop = threading.Event()
+
+        def put(i, item):
+            while not stop.is_set():
+                try:
+                    queues[i].put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def fetch_slice(i):
+            if stop.is_set():
+                return
+            try:
+                resume = int(eventid) + 1 if i == start_slice and eventid else None
+                for events in self.fetch(*slices[i], eventid_from=resume):
+                    if not put(i, events):
+                        return
+                put(i, None)
+            except Exception as e:
+                put(i, e)
+
+        with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+            for i in range(start_slice, len(slices)):
+                executor.submit(fetch_slice, i)
+            try:
+                for i in range(start_slice, len(slices)):
+                    while True:
+                        events = queues[i].get()
+                        if events is None:
+                            break
+                        if isinstance(events, Exception):
+                            raise events
+                        yield i, events
+                    self.commit(i + 1, None)
+            finally:
+                stop.set()
+
+    def run(self, workers=8, fetch_workers=4, environment='Production', zabbix_severity=False, progress=None):
+        """
+        Send all events in the time range. Events of the same trigger are
+        sent in order. Returns the number of events sent, and raises
+        RuntimeError if Alerta is unavailable.
+        """
+        total = self.count()
+        sent = 0
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i, events in self.pages(fetch_workers):
+                queues = {}
+                for event in events:
+                    queues.setdefault(event['objectid'], []).append(event)
+
+                def send_in_order(triggers):
+                    for event in triggers:
+                        alert = self.alert(event, environment, zabbix_severity)
+                        if alert and not deliver(self.options, {'sendto': self.options['endpoint'], 'alert': alert}, pool_size=workers):
+                            return False
+                    return True
+
+                if not all(executor.map(send_in_order, queues.values())):
+                    raise RuntimeError('Alerta unavailable, replay stopped at event {}'.format(events[0]['eventid']))
+                self.commit(i, events[-1]['eventid'])
+                sent += len(events)
+                if progress:
+                    progress(sent, total, time.monotonic() - started)
+        return sent
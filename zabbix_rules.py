@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+    zabbix-alerta rules: route or drop alerts after they are parsed
+
+    Rules are sections of an ini file, tried in order, and the first rule
+    whose conditions all match decides what happens to the alert, eg.
+
+        [rule drop-info]
+        severity = informational, indeterminate
+        drop = yes
+
+        [rule databases]
+        service = Databases
+        resource = db*, ~^mysql-[0-9]+$
+        sendto = dba
+
+        [rule staging]
+        resource = stg-*
+        set_environment = Staging
+
+    A condition is a comma-separated list of values, one of which must
+    match: `value` exactly, `prefix*`, or `~regex` (one per line). For list
+    fields like service and tags any element can match.
+
+    Rules are compiled into one index per field: a hash table of exact
+    values, a prefix trie and a combined regex, each giving a bit mask of
+    the rules it matches, so the cost of a lookup does not grow with the
+    number of rules. The compiled index is cached as JSON.
+"""
+
+import configparser
+import json
+import os
+import re
+import zlib
+
+FIELDS = ('resource', 'event', 'severity', 'environment', 'service', 'tags', 'group', 'type')
+
+# bump when the compiled format changes
+FORMAT = 1
+
+
+def parse_values(value):
+
+    values = []
+    for line in value.splitlines():
+        line = line.strip()
+        if line.startswith('~'):
+            values.append(line)
+        else:
+            values += [v.strip() for v in line.split(',') if v.strip()]
+    return values
+
+
+def read_rules(path):
+    """
+    Returns a list of rules as dicts with name, conditions and actions.
+    Raises ValueError for an invalid rules file.
+    """
+    parser = configparser.RawConfigParser(interpolation=None)
+    parser.optionxform = str
+    try:
+        if not parser.read(path):
+            raise ValueError('cannot read rules file %s' % path)
+    except configparser.Error as e:
+        raise ValueError('%s: %s' % (path, e))
+
+    rules = []
+    for section in parser.sections():
+        if not section.startswith('rule '):
+            raise ValueError('[%s]: sections must be named [rule NAME]' % section)
+        rule = {'name': section[5:].strip(), 'conditions': {}, 'sendto': None, 'set_environment': None, 'drop': False}
+        for key, value in parser.items(section):
+            if key in FIELDS:
+                rule['conditions'][key] = parse_values(value)
+                for v in rule['conditions'][key]:
+                    if v.startswith('~'):
+                        try:
+                            re.compile(v[1:])
+                        except re.error as e:
+                            raise ValueError('[%s] %s: invalid regex %r: %s' % (section, key, v[1:], e))
+            elif key == 'sendto':
+                rule['sendto'] = value.strip()
+            elif key == 'set_environment':
+                rule['set_environment'] = value.strip()
+            elif key == 'drop':
+                rule['drop'] = parser.getboolean(section, key)
+            else:
+                raise ValueError('[%s]: unknown key %r' % (section, key))
+        if not (rule['sendto'] or rule['set_environment'] or rule['drop']):
+            raise ValueError('[%s]: no sendto, set_environment or drop' % section)
+        rules.append(rule)
+    return rules
+
+
+def compile_rules(rules):
+    """
+    Returns the JSON-serializable index of the rules. Bit masks are hex
+    strings so that only the ones used by a lookup are ever converted.
+    """
+    fields = {}
+    for field in FIELDS:
+        used = [(bit, rule['conditions'][field]) for bit, rule in enumerate(rules) if field in rule['conditions']]
+        if not used:
+            continue
+        index = {'any': 0, 'exact': {}, 'prefix': {}, 'regex': []}
+        constrained = 0
+        for bit, values in used:
+            constrained |= 1 << bit
+            for value in values:
+                if value.startswith('~'):
+                    index['regex'].append([bit, value[1:]])
+                elif value.endswith('*'):
+                    node = index['prefix']
+                    for ch in value[:-1]:
+                        node = node.setdefault(ch, {})
+                    node[''] = node.get('', 0) | 1 << bit
+                else:
+                    index['exact'][value] = index['exact'].get(value, 0) | 1 << bit
+        index['any'] = ((1 << len(rules)) - 1) & ~constrained
+        fields[field] = index
+
+    def to_hex(node):
+        return {k: to_hex(v) if isinstance(v, dict) else '%x' % v for k, v in node.items()}
+
+    return {
+        'rules': [{k: rule[k] for k in ('name', 'sendto', 'set_environment', 'drop')} for rule in rules],
+        'fields': {
+            field: {
+                'any': '%x' % index['any'],
+                'exact': to_hex(index['exact']),
+                'prefix': to_hex(index['prefix']),
+                'regex': index['regex'],
+            }
+            for field, index in fields.items()
+        },
+    }
+
+
+class Rules:
+    def __init__(self, compiled):
+
+        self.rules = compiled['rules']
+        self.fields = compiled['fields']
+        self.all = (1 << len(self.rules)) - 1
+        self._prefilter = {}
+        self._regex = {}
+
+    def prefilter(self, field):
+        """
+        One regex for all regex conditions of a field, so a value that
+        matches none of them is rejected with a single search. None if a
+        pattern has groups, which would change back references.
+        """
+        if field not in self._prefilter:
+            patterns = [pattern for _, pattern in self.fields[field]['regex']]
+            self._prefilter[field] = None
+            if all(self.regex(p).groups == 0 for p in patterns):
+                try:
+                    self._prefilter[field] = re.compile('|'.join('(?:%s)' % p for p in patterns))
+                except re.error:
+                    pass  # eg. inline flags
+        return self._prefilter[field]
+
+    def regex(self, pattern):
+        if pattern not in self._regex:
+            self._regex[pattern] = re.compile(pattern)
+        return self._regex[pattern]
+
+    def field_mask(self, field, value, candidates):
+
+        index = self.fields[field]
+        mask = 0
+        if value in index['exact']:
+            mask |= int(index['exact'][value], 16)
+
+        node = index['prefix']
+        for ch in value:
+            if '' in node:
+                mask |= int(node[''], 16)
+            node = node.get(ch)
+            if node is None:
+                break
+        else:
+            if '' in node:
+                mask |= int(node[''], 16)
+
+        if index['regex']:
+            prefilter = self.prefilter(field)
+            if prefilter and not prefilter.search(value):
+                return mask
+            for bit, pattern in index['regex']:
+                if candidates >> bit & 1 and self.regex(pattern).search(value):
+                    mask |= 1 << bit
+        return mask
+
+    def match(self, alert):
+        """
+        Returns the first rule that matches the alert, or None.
+        """
+        candidates = self.all
+        for field, index in self.fields.items():
+            value = alert.get(field)
+            values = value if isinstance(value, list) else [] if value is None else [value]
+            mask = int(index['any'], 16)
+            for v in values:
+                mask |= self.field_mask(field, str(v), candidates)
+            candidates &= mask
+            if not candidates:
+                return None
+        return self.rules[(candidates & -candidates).bit_length() - 1]
+
+
+_loaded = {}
+
+
+def load_rules(path, cache_dir=None):
+    """
+    Returns the compiled rules, from the cache if the rules file has not
+    changed since it was compiled.
+    """
+    st = os.stat(path)
+    stamp = [os.path.abspath(path), st.st_mtime_ns, st.st_size, FORMAT]
+    if path in _loaded and _loaded[path][0] == stamp:
+        return _loaded[path][1]
+
+    if cache_dir is None:
+        from zabbix_alerta import cache_dir as default_cache_dir
+
+        cache_dir = default_cache_dir()
+    cache_file = os.path.join(cache_dir, 'rules-%08x.json' % zlib.crc32(stamp[0].encode('utf-8')))
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached['stamp'] != stamp:
+            raise ValueError('stale')
+        compiled = cached['compiled']
+    except (OSError, ValueError, KeyError):
+        compiled = compile_rules(read_rules(path))
+        try:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            tmp_file = '{}.{}'.format(cache_file, os.getpid())
+            with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump({'stamp': stamp, 'compiled': compiled}, f, separators=(',', ':'))
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+
+    rules = Rules(compiled)
+    _loaded[path] = (stamp, rules)
+    return rules
+
+
+def describe(rule):
+
+    if rule is None:
+        return 'no rule matched, forwarded unchanged'
+    if rule['drop']:
+        return 'rule "%s": drop' % rule['name']
+    actions = []
+    if rule['sendto']:
+        actions.append('sendto %s' % rule['sendto'])
+    if rule['set_environment']:
+        actions.append('environment %s' % rule['set_environment'])
+    return 'rule "%s": %s' % (rule['name'], ', '.join(actions))
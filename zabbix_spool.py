@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""
+    zabbix-alerta spool: durable local queue of parsed alerts
+
+    Alerts are appended to numbered segment files as length-prefixed,
+    checksummed JSON records. `zabbix-alerta drain` delivers them to Alerta
+    in order and records its position in a checkpoint file so that it can
+    resume after a crash or restart. Delivery is at-least-once.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from zabbix_alerta import (CircuitOpen, FanoutFailed, Throttled, forward,
+                           get_options)
+
+# JSON records are pure ASCII so a non-ASCII magic can only be a record start
+MAGIC = b'\xa5\x5a'
+HEADER = struct.Struct('>2sII')  # magic, length, crc32
+
+SEGMENT_SIZE = 8 * 1024 * 1024
+SYNC_INTERVAL = 1.0
+BATCH_SIZE = 500
+
+LOG = logging.getLogger('zabbix-alerta')
+
+
+class Spool:
+    def __init__(self, path, segment_size=SEGMENT_SIZE, sync_interval=SYNC_INTERVAL):
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+
+        self._lock_file = open(os.path.join(path, 'spool.lock'), 'a')
+        self._file = None
+        self._segment = None
+        self._dirty = False
+        self._new_segment = False
+        self._last_sync = time.monotonic()
+
+    def segments(self):
+        return sorted(
+            int(name[8:-4]) for name in os.listdir(self.path) if name.startswith('segment-') and name.endswith('.log')
+        )
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, 'segment-%012d.log' % segment)
+
+    def append(self, record):
+
+        data = json.dumps(record, separators=(',', ':')).encode('ascii')
+        entry = HEADER.pack(MAGIC, len(data), zlib.crc32(data)) + data
+
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            segments = self.segments()
+            segment = segments[-1] if segments else 0
+            if segments:
+                size = os.path.getsize(self.segment_path(segment))
+                if size and size + len(entry) > self.segment_size:
+                    segment += 1
+
+            if segment != self._segment:
+                self._open(segment)
+            self._file.write(entry)
+            self._file.flush()
+            self._dirty = True
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+        if time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def _open(self, segment):
+
+        self.sync()
+        if self._file:
+            self._file.close()
+        path = self.segment_path(segment)
+        self._new_segment = not os.path.exists(path)
+        self._file = open(path, 'ab')
+        self._segment = segment
+
+    def sync(self):
+
+        if self._file and self._dirty:
+            os.fsync(self._file.fileno())
+            self._dirty = False
+        if self._new_segment:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._new_segment = False
+        self._last_sync = time.monotonic()
+
+    def close(self):
+
+        self.sync()
+        if self._file:
+            self._file.close()
+            self._file = None
+            self._segment = None
+        self._lock_file.close()
+
+    def read(self, segment=0, offset=0):
+        """
+        Yield (segment, next_offset, record) for every complete record from
+        the given position. Stops at a partially written record at the end
+        of the newest segment; it is picked up on the next read.
+        """
+        segments = [n for n in self.segments() if n >= segment]
+        for n in segments:
+            start = offset if n == segment else 0
+            with open(self.segment_path(n), 'rb') as f:
+                f.seek(start)
+                buf = f.read()
+
+            pos = 0
+            while pos < len(buf):
+                if len(buf) - pos < HEADER.size:
+                    if n == segments[-1]:
+                        return
+                    break
+                magic, length, crc = HEADER.unpack_from(buf, pos)
+                end = pos + HEADER.size + length
+                if magic == MAGIC and end > len(buf) and n == segments[-1]:
+                    # still being written, unless another record follows it
+                    if buf.find(MAGIC, pos + HEADER.size) == -1:
+                        return
+                data = buf[pos + HEADER.size:end]
+                if magic != MAGIC or zlib.crc32(data) != crc:
+                    # torn or corrupt record, resync on the next record start
+                    resync = buf.find(MAGIC, pos + 1)
+                    LOG.warning('Skipping corrupt spool data in segment %d at offset %d', n, start + pos)
+                    if resync == -1:
+                        break
+                    pos = resync
+                    continue
+                yield n, start + end, json.loads(data.decode('ascii'))
+                pos = end
+
+    def checkpoint(self):
+
+        try:
+            with open(os.path.join(self.path, 'checkpoint')) as f:
+                position = json.load(f)
+            return position['segment'], position['offset']
+        except (OSError, ValueError, KeyError):
+            return 0, 0
+
+    def commit(self, segment, offset):
+
+        path = os.path.join(self.path, 'checkpoint')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'segment': segment, 'offset': offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        # segments before the checkpoint have been delivered
+        for n in self.segments():
+            if n >= segment:
+                break
+            os.unlink(self.segment_path(n))
+
+
+def deliver(options, record, pool_size=None):
+    """
+    Returns True if the alert was delivered or permanently rejected, False
+    if delivery should be retried later.
+    """
+    from requests.exceptions import RequestException
+
+    try:
+        forward(options, record['alert'], pool_size=pool_size, fallback=False)
+    except (CircuitOpen, FanoutFailed, Throttled, RequestException) as e:
+        LOG.warning('Failed to send alert to %s: %s', record['sendto'], e)
+        return False
+    except Exception as e:
+        LOG.error('Alert rejected by %s, dropping: %s', record['sendto'], e)
+    return True
+
+
+def drain(spool, concurrency=4, batch_size=BATCH_SIZE):
+    """
+    Deliver spooled alerts. Alerts for the same resource and event are sent
+    in spool order; others are sent concurrently. Returns the number of
+    alerts delivered and whether the spool was fully drained.
+    """
+    delivered = 0
+    profiles = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            segment, offset = spool.checkpoint()
+            batch = []
+            for position in spool.read(segment, offset):
+                batch.append(position)
+                if len(batch) >= batch_size:
+                    break
+            if not batch:
+                return delivered, True
+
+            queues = {}
+            for i, (_, _, record) in enumerate(batch):
+                if record['sendto'] not in profiles:
+                    profiles[record['sendto']] = get_options(record['sendto'])
+                alert = record['alert']
+                key = (record['sendto'], alert.get('environment'), alert.get('resource'), alert.get('event'))
+                queues.setdefault(key, []).append(i)
+
+            def send_in_order(indexes):
+                results = {}
+                for i in indexes:
+                    record = batch[i][2]
+                    results[i] = deliver(profiles[record['sendto']], record, pool_size=concurrency)
+                    if not results[i]:
+                        break
+                return results
+
+            results = {}
+            for r in executor.map(send_in_order, queues.values()):
+                results.update(r)
+
+            # only advance the checkpoint over the delivered prefix
+            done = 0
+            while done < len(batch) and results.get(done):
+                done += 1
+            if done:
+                segment, offset, _ = batch[done - 1]
+                spool.commit(segment, offset)
+                delivered += done
+            if done < len(batch):
+                return delivered, False
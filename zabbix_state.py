@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+"""
+    zabbix-alerta state: small SQLite store shared by alert script processes
+"""
+
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from zabbix_alerta import ZBX_SEVERITY_MAP, cache_dir
+
+BUSY_TIMEOUT = 5.0
+EVICT_LIMIT = 100
+
+# PRAGMA user_version, see State.migrate()
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS suppress (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    expires REAL NOT NULL,
+    suppressed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS suppress_expires ON suppress (expires);
+CREATE TABLE IF NOT EXISTS delivered (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    delivered REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS delivered_delivered ON delivered (delivered);
+CREATE TABLE IF NOT EXISTS storm_events (
+    grp TEXT NOT NULL,
+    ts REAL NOT NULL,
+    resource TEXT
+);
+CREATE INDEX IF NOT EXISTS storm_events_grp_ts ON storm_events (grp, ts);
+CREATE TABLE IF NOT EXISTS storm (
+    grp TEXT PRIMARY KEY,
+    started REAL NOT NULL,
+    last_sent REAL NOT NULL,
+    folded INTEGER NOT NULL,
+    severity TEXT,
+    context TEXT,
+    ending REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS storm_folded (
+    grp TEXT NOT NULL,
+    key TEXT NOT NULL,
+    alert TEXT NOT NULL,
+    PRIMARY KEY (grp, key)
+);
+CREATE TABLE IF NOT EXISTS bucket (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS breaker (
+    endpoint TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL,
+    opened REAL NOT NULL,
+    probe REAL NOT NULL
+);
+'''
+
+
+def state_file():
+    return os.path.join(cache_dir(), 'state.db')
+
+
+def alert_key(options, alert):
+    return json.dumps([options['endpoint'], alert.get('environment'), alert.get('resource'), alert.get('event')])
+
+
+def delivery_key(options, alert):
+    """
+    Zabbix event id of the alert plus its severity and status, so that
+    recovery and acknowledge messages for the same event are delivered too.
+    Returns None if the message has no usable event id.
+    """
+    event_id = (alert.get('attributes') or {}).get('eventId')
+    if not event_id or event_id.startswith('{'):
+        return None
+    return json.dumps([options['endpoint'], event_id, alert.get('severity'), alert.get('status')])
+
+
+# most severe first, Alerta and Zabbix severity names
+SEVERITY_ORDER = [
+    'security',
+    'critical',
+    'Disaster',
+    'major',
+    'High',
+    'minor',
+    'Average',
+    'warning',
+    'Warning',
+    'informational',
+    'Information',
+    'indeterminate',
+    'Not classified',
+]
+
+STORM_RESOURCES = 50
+
+# seconds a process has to end a storm before another one may try again
+STORM_END_TIMEOUT = 30.0
+
+# fraction of the token bucket kept in reserve for more severe alerts, so
+# the least severe alerts are shed first as the bucket empties
+SHED_RESERVE = {
+    'major': 0.0,
+    'High': 0.0,
+    'minor': 0.25,
+    'Average': 0.25,
+    'warning': 0.5,
+    'Warning': 0.5,
+}
+DEFAULT_SHED_RESERVE = 0.75
+
+# never rate limited
+UNLIMITED_SEVERITIES = ('critical', 'Disaster', 'security', 'normal', 'ok', 'OK', 'cleared')
+
+
+def storm_group(options, alert):
+
+    value = alert.get(options['storm_key'])
+    if isinstance(value, list):
+        value = ','.join(sorted(value))
+    return value or None
+
+
+def folded_key(alert):
+    return json.dumps([alert.get('environment'), alert.get('resource'), alert.get('event')])
+
+
+def more_severe(a, b):
+
+    rank = {severity: i for i, severity in enumerate(SEVERITY_ORDER)}
+    return a if rank.get(a, len(rank)) <= rank.get(b, len(rank)) else b
+
+
+def storm_alert(group, alert, storm):
+    """
+    Rolling summary alert for an alert storm, or its clear when storm['ended'].
+    """
+    if storm['ended']:
+        # same as a recovery with or without Zabbix severities
+        severity = 'ok' if storm['severity'] in ZBX_SEVERITY_MAP else 'normal'
+        text = 'Alert storm in {} ended, {} alerts were aggregated'.format(group, storm['folded'])
+    else:
+        severity = storm['severity']
+        text = 'Alert storm in {}: {} alerts from {} resources in the last {}s'.format(
+            group, storm['count'], storm['resource_count'], int(storm['window'])
+        )
+    return {
+        'resource': group,
+        'event': 'AlertStorm',
+        'environment': alert.get('environment'),
+        'severity': severity,
+        'service': alert.get('service'),
+        'group': 'Zabbix',
+        'value': '{} alerts'.format(storm['count']),
+        'text': text,
+        'type': 'zabbixAlertStorm',
+        'origin': alert.get('origin'),
+        'attributes': {
+            'count': storm['count'],
+            'aggregated': storm['folded'],
+            'resources': ', '.join(storm['resources']),
+            'stormStarted': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(storm['started'])),
+        },
+    }
+
+
+def alert_fingerprint(alert):
+    return json.dumps([alert.get('severity'), alert.get('status'), alert.get('value'), alert.get('text')])
+
+
+class State:
+    def __init__(self, path=None):
+
+        path = path or state_file()
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            self.migrate()
+
+    def migrate(self):
+
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(storm)')]
+        for name, definition in (('context', 'TEXT'), ('ending', 'REAL NOT NULL DEFAULT 0')):
+            if name not in columns:
+                try:
+                    self.conn.execute('ALTER TABLE storm ADD COLUMN %s %s' % (name, definition))
+                except sqlite3.OperationalError:
+                    pass  # added by another process
+        self.conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    def close(self):
+        self.conn.close()
+
+    @contextmanager
+    def transaction(self):
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def incr(self, name, n=1):
+        self.conn.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)', (name,))
+        self.conn.execute('UPDATE counters SET value = value + ? WHERE name = ?', (n, name))
+
+    def counters(self):
+        return dict(self.conn.execute('SELECT name, value FROM counters ORDER BY name'))
+
+    def is_repeat(self, key, fingerprint, now=None):
+        """
+        Returns True, and counts it, if an identical alert was forwarded and
+        has not expired yet.
+        """
+        now = now or time.time()
+        with self.transaction() as conn:
+            row = conn.execute('SELECT fingerprint, expires FROM suppress WHERE key = ?', (key,)).fetchone()
+            if not row or row[0] != fingerprint or row[1] <= now:
+                return False
+            conn.execute('UPDATE suppress SET suppressed = suppressed + 1 WHERE key = ?', (key,))
+            self.incr('suppressed')
+            return True
+
+    def remember(self, key, fingerprint, ttl, now=None):
+
+        now = now or time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO suppress (key, fingerprint, expires) VALUES (?, ?, ?)',
+                (key, fingerprint, now + ttl),
+            )
+            conn.execute(
+                'DELETE FROM suppress WHERE key IN (SELECT key FROM suppress WHERE expires <= ? LIMIT ?)',
+                (now, EVICT_LIMIT),
+            )
+
+    def is_delivered(self, key, max_age, now=None):
+
+        now = now or time.time()
+        row = self.conn.execute('SELECT delivered FROM delivered WHERE key = ?', (key,)).fetchone()
+        if not row or row[0] <= now - max_age:
+            return False
+        with self.transaction():
+            self.incr('duplicates')
+        return True
+
+    def mark_delivered(self, key, max_age, max_size, now=None):
+
+        now = now or time.time()
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO delivered (key, delivered) VALUES (?, ?)', (key, now))
+            conn.execute('DELETE FROM delivered WHERE id <= (SELECT max(id) FROM delivered) - ?', (max_size,))
+            conn.execute(
+                'DELETE FROM delivered WHERE id IN (SELECT id FROM delivered WHERE delivered <= ? LIMIT ?)',
+                (now - max_age, EVICT_LIMIT),
+            )
+
+    def breaker_allow(self, endpoint, timeout, now=None):
+        """
+        Circuit breaker for the endpoint. Closed until threshold consecutive
+        failures, then open for timeout seconds, then half-open: one process
+        is allowed to send a probe and the rest fail fast until it returns.
+        """
+        now = now or time.time()
+        row = self.conn.execute('SELECT opened, probe FROM breaker WHERE endpoint = ?', (endpoint,)).fetchone()
+        if not row or not row[0]:
+            return True
+
+        with self.transaction() as conn:
+            opened, probe = conn.execute(
+                'SELECT opened, probe FROM breaker WHERE endpoint = ?', (endpoint,)
+            ).fetchone() or (0, 0)
+            if opened and (now < opened + timeout or now < probe + timeout):
+                self.incr('circuit_open')
+                return False
+            conn.execute('UPDATE breaker SET probe = ? WHERE endpoint = ?', (now, endpoint))
+        return True
+
+    def breaker_success(self, endpoint):
+        if self.conn.execute('SELECT 1 FROM breaker WHERE endpoint = ?', (endpoint,)).fetchone():
+            self.conn.execute('DELETE FROM breaker WHERE endpoint = ?', (endpoint,))
+
+    def breaker_release(self, endpoint):
+        """
+        End a half-open probe without a verdict, so the next call probes again.
+        """
+        self.conn.execute('UPDATE breaker SET probe = 0 WHERE endpoint = ?', (endpoint,))
+
+    def breaker_failure(self, endpoint, threshold, now=None):
+
+        now = now or time.time()
+        with self.transaction() as conn:
+            failures, opened, probe = conn.execute(
+                'SELECT failures, opened, probe FROM breaker WHERE endpoint = ?', (endpoint,)
+            ).fetchone() or (0, 0, 0)
+            failures += 1
+            if probe or failures >= threshold:
+                opened = now  # open, or re-open after a failed probe
+            conn.execute(
+                'INSERT OR REPLACE INTO breaker (endpoint, failures, opened, probe) VALUES (?, ?, ?, 0)',
+                (endpoint, failures, opened),
+            )
+
+    def storm_check(self, group, alert, threshold, window, interval, now=None, context=None):
+        """
+        Count the alert against its group's sliding window. Returns None if it
+        should be forwarded individually, otherwise the storm details, with
+        storm['due'] set when this process should send the summary alert. The
+        folded alert is kept to be forwarded when the storm ends, unless it
+        recovers first, see storm_unfold(). context is kept to end the storm
+        if the group goes quiet, see ended_storms().
+        """
+        now = now or time.time()
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO storm_events (grp, ts, resource) VALUES (?, ?, ?)', (group, now, alert.get('resource')))
+            conn.execute(
+                'DELETE FROM storm_events WHERE rowid IN (SELECT rowid FROM storm_events WHERE ts <= ? LIMIT ?)',
+                (now - window, EVICT_LIMIT),
+            )
+            count, resource_count = conn.execute(
+                'SELECT count(*), count(DISTINCT resource) FROM storm_events WHERE grp = ? AND ts > ?',
+                (group, now - window),
+            ).fetchone()
+            row = conn.execute(
+                'SELECT started, last_sent, folded, severity, ending FROM storm WHERE grp = ?', (group,)
+            ).fetchone()
+
+            if count < threshold:
+                if not row or now - row[4] < STORM_END_TIMEOUT:
+                    return None  # no storm, or another process is ending it
+                started, _, folded, severity, _ = row
+                conn.execute('UPDATE storm SET ending = ? WHERE grp = ?', (now, group))
+                return dict(
+                    ended=True, due=True, started=started, count=count, resource_count=resource_count,
+                    folded=folded, severity=severity, resources=[], window=window,
+                )
+
+            started, last_sent, folded, severity, _ = row or (now, 0, 0, alert.get('severity'), 0)
+            folded += 1
+            severity = more_severe(severity, alert.get('severity'))
+            # claimed in the same transaction, so only one process sends each summary
+            due = now - last_sent >= interval
+            if due:
+                last_sent = now
+            conn.execute(
+                'INSERT OR REPLACE INTO storm (grp, started, last_sent, folded, severity, context, ending) '
+                'VALUES (?, ?, ?, ?, ?, ?, 0)',
+                (group, started, last_sent, folded, severity, json.dumps(context)),
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO storm_folded (grp, key, alert) VALUES (?, ?, ?)',
+                (group, folded_key(alert), json.dumps(alert)),
+            )
+            self.incr('aggregated')
+            resources = [
+                r for r, in conn.execute(
+                    'SELECT DISTINCT resource FROM storm_events WHERE grp = ? AND ts > ? ORDER BY ts DESC LIMIT ?',
+                    (group, now - window, STORM_RESOURCES),
+                )
+            ]
+        return dict(
+            ended=False, due=due, started=started, count=count,
+            resource_count=resource_count, folded=folded, severity=severity, resources=resources, window=window,
+        )
+
+    def ended_storms(self, now=None):
+        """
+        Returns (group, storm, context) for storms whose group has had fewer
+        alerts than the threshold within the window, so that they are ended
+        even if no alert of the group arrives. Each storm is returned to one
+        process at a time, which calls storm_ended() once it is done.
+        """
+        now = now or time.time()
+        ended = []
+        with self.transaction() as conn:
+            for group, started, folded, severity, context in conn.execute(
+                'SELECT grp, started, folded, severity, context FROM storm WHERE ending <= ?',
+                (now - STORM_END_TIMEOUT,),
+            ).fetchall():
+                context = json.loads(context or 'null')
+                if not context:
+                    continue  # from an older version, ended by the next alert of the group
+                window = context['window']
+                count, resource_count = conn.execute(
+                    'SELECT count(*), count(DISTINCT resource) FROM storm_events WHERE grp = ? AND ts > ?',
+                    (group, now - window),
+                ).fetchone()
+                if count < context['threshold']:
+                    conn.execute('UPDATE storm SET ending = ? WHERE grp = ?', (now, group))
+                    storm = dict(
+                        ended=True, due=True, started=started, count=count, resource_count=resource_count,
+                        folded=folded, severity=severity, resources=[], window=window,
+                    )
+                    ended.append((group, storm, context))
+        return ended
+
+    def storm_folded(self, group):
+        """
+        Alerts folded into the group's storm that have not recovered since.
+        """
+        return [json.loads(alert) for alert, in self.conn.execute('SELECT alert FROM storm_folded WHERE grp = ?', (group,))]
+
+    def storm_unfold(self, group, alert):
+        self.conn.execute('DELETE FROM storm_folded WHERE grp = ? AND key = ?', (group, folded_key(alert)))
+
+    def storm_ended(self, group, started):
+
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM storm WHERE grp = ? AND started = ?', (group, started))
+            conn.execute('DELETE FROM storm_folded WHERE grp = ?', (group,))
+
+    def take_token(self, name, rate, burst, severity, now=None):
+        """
+        Token bucket shared by all processes. Returns False if the alert
+        should be shed. Critical alerts and recoveries are always allowed.
+        """
+        now = now or time.time()
+        with self.transaction() as conn:
+            row = conn.execute('SELECT tokens, updated FROM bucket WHERE name = ?', (name,)).fetchone()
+            tokens, updated = row or (burst, now)
+            tokens = min(burst, tokens + max(now - updated, 0) * rate)
+
+            if severity in UNLIMITED_SEVERITIES:
+                allowed = True
+                tokens = max(tokens - 1, 0)
+            else:
+                # the reserve is kept from the tokens above the one this alert takes,
+                # so a full bucket always lets one alert of any severity through
+                reserve = SHED_RESERVE.get(severity, DEFAULT_SHED_RESERVE) * max(burst - 1, 0)
+                allowed = tokens >= 1 + reserve
+                if allowed:
+                    tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO bucket (name, tokens, updated) VALUES (?, ?, ?)', (name, tokens, now))
+        return allowed
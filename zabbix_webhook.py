@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+    zabbix-alerta webhook: receive Zabbix webhook media requests
+
+    Zabbix 5.0+ webhook media types POST the alert macros as a JSON object,
+    eg. {"sendto": "production", "resource": "{HOST.NAME1}", ...}, which are
+    mapped to an alert exactly like the lines of a script media message.
+"""
+
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from zabbix_alerta import Profiles, forward, make_alert
+
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+# request fields that are not alert macros
+SENDTO = 'sendto'
+SUBJECT = 'subject'
+URL = 'url'
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    502: 'Bad Gateway',
+}
+
+# macros that may also be sent as a JSON list or object
+LIST_FIELDS = ('service', 'tags')
+OBJECT_FIELDS = ('attributes',)
+
+LOG = logging.getLogger('zabbix-alerta')
+
+
+def webhook_fields(payload):
+    """
+    Alert macros of a webhook request. Zabbix sends every value as a string,
+    numbers are taken as their text and other types are rejected.
+    """
+    fields = {}
+    for name, value in payload.items():
+        if name in (SENDTO, SUBJECT, URL):
+            continue
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        elif not (
+            isinstance(value, str)
+            or name in LIST_FIELDS and isinstance(value, list) and all(isinstance(v, str) for v in value)
+            or name in OBJECT_FIELDS and isinstance(value, dict)
+        ):
+            raise ValueError('invalid value for {}: {}'.format(name, json.dumps(value)))
+        fields[name] = value
+    return fields
+
+
+class WebhookReceiver:
+    def __init__(self, workers=8):
+
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.profiles = Profiles()
+
+    def forward(self, sendto, fields, raw_data):
+
+        options = self.profiles.get(sendto)
+        alert = make_alert(fields.items(), raw_data=raw_data, debug=options['debug'])
+        return forward(options, alert, pool_size=self.workers)
+
+    async def dispatch(self, method, path, body):
+
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        if path not in ('/', '/webhook'):
+            return 404, {'status': 'error', 'message': 'not found'}
+        if method != 'POST':
+            return 405, {'status': 'error', 'message': 'method not allowed'}
+
+        try:
+            raw_data = body.decode('utf-8')
+            payload = json.loads(raw_data)
+            if not isinstance(payload, dict):
+                raise ValueError('expected a JSON object')
+            sendto = payload.get(SENDTO) or ''
+            if not isinstance(sendto, str):
+                raise ValueError('invalid value for {}: {}'.format(SENDTO, json.dumps(sendto)))
+            fields = webhook_fields(payload)
+        except ValueError as e:
+            return 400, {'status': 'error', 'message': str(e)}
+
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self.executor, self.forward, sendto, fields, raw_data)
+        except Exception as e:
+            LOG.error('Failed to send webhook alert to %s: %s', payload.get(SENDTO), e)
+            return 502, {'status': 'error', 'message': str(e)}
+
+        return 200, {'status': 'ok', 'result': result}
+
+    async def handle(self, reader, writer):
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY_SIZE:
+                    status, response = 413, {'status': 'error', 'message': 'request too large'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, response = await self.dispatch(method, path.split('?', 1)[0], body)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                data = json.dumps(response).encode('utf-8')
+                writer.write(
+                    (
+                        'HTTP/1.1 {} {}\r\n'
+                        'Content-Type: application/json\r\n'
+                        'Content-Length: {}\r\n'
+                        'Connection: {}\r\n\r\n'
+                    )
+                    .format(status, REASONS[status], len(data), 'keep-alive' if keep_alive else 'close')
+                    .encode('latin-1')
+                    + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle, host, port)